@@ -0,0 +1,475 @@
+"""Async serving mode: the GitHub proxy routes on an event loop.
+
+Almost every request UnderLeaf serves is a wait on api.github.com. Under
+gunicorn's sync workers each of those waits holds a thread, which is why
+the sync mode needs hundreds of workers with hundreds of threads. Here the
+read-only proxy routes (user, repos, branches, tree, file, history) and
+compile job polling run as coroutines on one shared httpx client, so a
+single process keeps thousands of sessions in flight. Their GitHub reads
+are the sync mode's, from flaskapp; cache, save buffer and job store
+lookups, which hit local disk, run on a small thread pool. Everything else -
+saves, compiles, uploads, OAuth - is the unchanged Flask app, run on a
+bounded thread pool; builds still go to the compile scheduler's executor.
+
+    python asgi_app.py          # PORT and ASYNC_WORKERS from the environment
+"""
+import io
+import os
+import re
+import sys
+import json
+import time
+import socket
+import asyncio
+from datetime import datetime
+from http.cookies import SimpleCookie
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl, unquote
+
+import httpx
+from itsdangerous import BadSignature
+from werkzeug.datastructures import MultiDict
+
+import flaskapp
+import metrics
+from github_client import AsyncGitHubClient
+from github_reads import run_async
+from compression import choose_encoding, compress
+
+# Threads for the routes still served by Flask (saves, compiles, uploads, ...)
+WSGI_THREADS = int(os.environ.get('WSGI_THREADS', 64))
+# Threads for what the async routes can't do on the loop: cache, save buffer
+# and job store lookups on local disk, streamed reads of large files
+BLOCKING_THREADS = int(os.environ.get('BLOCKING_THREADS', 16))
+# Connections of the shared async GitHub client
+ASYNC_GITHUB_CONNECTIONS = int(os.environ.get('ASYNC_GITHUB_CONNECTIONS', 1000))
+# uvicorn worker processes started by serve()
+ASYNC_WORKERS = int(os.environ.get('ASYNC_WORKERS', 4))
+# JSON bodies at least this big are compressed on the WSGI thread pool
+COMPRESS_OFFLOAD_BYTES = 256 * 1024
+
+compile_jobs = flaskapp.compile_jobs
+
+
+class Request:
+    def __init__(self, scope, body):
+        self.scope = scope
+        self.method = scope['method']
+        self.path = scope['path']
+        self.body = body
+        # A MultiDict like Flask's, so flaskapp helpers can read it
+        self.args = MultiDict(parse_qsl(scope.get('query_string', b'').decode('latin-1')))
+        self.headers = {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in scope.get('headers', [])}
+        self.session = _load_session(self.headers.get('cookie', ''))
+
+    def json(self):
+        return json.loads(self.body or b'{}')
+
+    @property
+    def github_headers(self):
+        return {'Authorization': f"token {self.session['oauth_token']}"}
+
+
+def _load_session(cookie_header):
+    # Same signed cookie Flask reads; the async routes never modify the session
+    flask_app = flaskapp.app
+    cookies = SimpleCookie()
+    try:
+        cookies.load(cookie_header)
+    except Exception:
+        return {}
+    morsel = cookies.get(flask_app.config['SESSION_COOKIE_NAME'])
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    if morsel is None or serializer is None:
+        return {}
+    try:
+        return serializer.loads(morsel.value, max_age=int(flask_app.permanent_session_lifetime.total_seconds()))
+    except BadSignature:
+        return {}
+
+
+class AsyncApp:
+    """ASGI app serving the routes in self.routes natively and the rest through Flask."""
+
+    def __init__(self, wsgi_app, wsgi_threads=WSGI_THREADS, blocking_threads=BLOCKING_THREADS):
+        self.wsgi = WsgiBridge(wsgi_app, wsgi_threads)
+        self.blocking = ThreadPoolExecutor(blocking_threads, thread_name_prefix='blocking')
+        self.github = None
+        self.routes = []
+
+    def route(self, rule, methods=('GET',)):
+        # Flask-style rules so route labels in metrics match the sync mode
+        pattern = re.compile('^' + re.sub(r'<(?:(path):)?(\w+)>',
+                                          lambda m: f"(?P<{m[2]}>{'.+' if m[1] else '[^/]+'})", rule) + '$')
+
+        def register(handler):
+            self.routes.append((pattern, tuple(methods), rule, handler))
+            return handler
+        return register
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+
+        body = None
+        for pattern, methods, rule, handler in self.routes:
+            match = pattern.match(scope['path'])
+            if match and scope['method'] in methods:
+                # Native routes take small JSON bodies; everything else streams into Flask
+                body = await _read_body(receive)
+                request = Request(scope, body)
+                if 'oauth_token' not in request.session:
+                    return await _send_json(send, {'error': 'Not authenticated'}, 401, request)
+                started = time.monotonic()
+                try:
+                    result = await handler(request, **{k: unquote(v) for k, v in match.groupdict().items()})
+                except Exception as e:
+                    print(f'Error in {rule}: {e}')
+                    result = ({'error': str(e)}, 502 if isinstance(e, httpx.HTTPError) else 500)
+                if result is None:
+                    break  # the handler wants the Flask version of this route
+                if callable(result):
+                    status = await result(send)
+                else:
+                    payload, status = result
+                    await _send_json(send, payload, status, request)
+                metrics.record('http_request', time.monotonic() - started, route=rule, method=scope['method'],
+                               status=status)
+                return
+        await self.wsgi(scope, receive, send, body)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.github = AsyncGitHubClient(flaskapp.github, pool_size=ASYNC_GITHUB_CONNECTIONS)
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.github:
+                    await self.github.aclose()
+                self.wsgi.executor.shutdown(wait=False)
+                self.blocking.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def client(self):
+        # Servers without lifespan support get the client on first use
+        if self.github is None:
+            self.github = AsyncGitHubClient(flaskapp.github, pool_size=ASYNC_GITHUB_CONNECTIONS)
+        return self.github
+
+
+class WsgiBridge:
+    """Runs a WSGI app for ASGI requests on a thread pool.
+
+    The request body is read from the ASGI connection as the app consumes
+    wsgi.input, so an upload is never held in memory whole. Response bodies
+    are pulled from the WSGI iterable on the pool too, so a streaming
+    response (server-sent events, send_file) never blocks the loop.
+    """
+
+    def __init__(self, wsgi_app, threads):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix='wsgi')
+
+    async def __call__(self, scope, receive, send, body=None):
+        """Serve the request; body is given when it was already read from receive."""
+        loop = asyncio.get_running_loop()
+        stream = io.BytesIO(body) if body is not None else io.BufferedReader(_ReceiveStream(receive, loop))
+        environ = _environ(scope, stream)
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+            return lambda data: None
+
+        def first_chunk():
+            iterable = self.wsgi_app(environ, start_response)
+            iterator = iter(iterable)
+            return iterable, iterator, next(iterator, None)
+
+        iterable, iterator, chunk = await loop.run_in_executor(self.executor, first_chunk)
+        try:
+            await send({'type': 'http.response.start', 'status': started['status'], 'headers': started['headers']})
+            if chunk is None:
+                await send({'type': 'http.response.body', 'body': b''})
+            # Look one chunk ahead so the last one goes out with more_body=False;
+            # a trailing empty write stalls on delayed ACKs
+            while chunk is not None:
+                following = await loop.run_in_executor(self.executor, next, iterator, None)
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': following is not None})
+                chunk = following
+        finally:
+            if hasattr(iterable, 'close'):
+                await loop.run_in_executor(self.executor, iterable.close)
+
+
+app = AsyncApp(flaskapp.app)
+
+
+async def _run(read):
+    # The GitHub reads of flaskapp, on the loop's client
+    return await run_async(read, app.client(), app.blocking)
+
+
+async def _blocking(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(app.blocking, fn, *args)
+
+
+# -- routes
+
+@app.route('/api/user')
+async def get_user(request):
+    response = await app.client().get('https://api.github.com/user', headers=request.github_headers)
+    return response.json(), 200
+
+
+@app.route('/api/repos')
+async def get_repos(request):
+    paging = flaskapp._page_args(request.args, per_page=100)
+    if paging is None:
+        return {'error': 'page and per_page must be integers'}, 400
+    page, per_page = paging
+    response = await app.client().get(f'https://api.github.com/user/repos?per_page={per_page}&page={page}&sort=updated',
+                                       headers=request.github_headers)
+    return response.json(), 200
+
+
+@app.route('/api/branches/<path:repo>')
+async def get_branches(request, repo):
+    response = await app.client().get(f'https://api.github.com/repos/{repo}/branches', headers=request.github_headers)
+    branches = response.json()
+    if isinstance(branches, list) and len(branches) == 0:
+        return None  # Flask creates the initial commit
+    return branches, 200
+
+
+@app.route('/api/tree/<path:repo>/<branch>')
+async def get_tree(request, repo, branch):
+    return await _run(flaskapp._tree_steps(repo, branch, request.github_headers, request.args.get('format') == 'compact',
+                                           request.args.get('since')))
+
+
+@app.route('/api/file', methods=('POST',))
+async def get_file(request):
+    data = request.json()
+    return await _run(flaskapp._file_steps(data['repo'], data['branch'], data['filepath'], request.github_headers,
+                                           buffered=flaskapp.SAVE_BUFFER_ENABLED))
+
+
+@app.route('/api/commits/<path:repo>/<branch>')
+async def get_commits(request, repo, branch):
+    paging = flaskapp._page_args(request.args)
+    if paging is None:
+        return {'error': 'page and per_page must be integers'}, 400
+    page, per_page = paging
+    ascending = request.args.get('order') == 'asc'
+    try:
+        timeline = await _run(flaskapp._commit_timeline_steps(repo, branch, request.github_headers))
+    except Exception as e:
+        return {'error': str(e)}, 502
+    if timeline is None:
+        return {'error': 'Branch not found'}, 404
+    return [timeline.commit(i) for i in timeline.page(page, per_page, ascending)], 200
+
+
+@app.route('/api/commit-at-time/<path:repo>/<branch>/<timestamp>')
+async def get_commit_at_time(request, repo, branch, timestamp):
+    target_time = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+    try:
+        timeline = await _run(flaskapp._commit_timeline_steps(repo, branch, request.github_headers))
+    except Exception as e:
+        return {'error': str(e)}, 502
+    if timeline is None:
+        return {'error': 'Branch not found'}, 404
+    selected = timeline.at(int(target_time.timestamp()))
+    if selected is None:
+        return {'error': 'No commits found before this time'}, 404
+    return {'commit': timeline.commit(selected)}, 200
+
+
+@app.route('/api/tree-at-commit/<path:repo>/<commit_sha>')
+async def get_tree_at_commit(request, repo, commit_sha):
+    return await _run(flaskapp._tree_at_commit_steps(repo, commit_sha, request.github_headers))
+
+
+@app.route('/api/file-at-commit', methods=('POST',))
+async def get_file_at_commit(request):
+    data = request.json()
+    repo, headers = data['repo'], request.github_headers
+    if await _run(flaskapp._repo_access_steps(repo, headers)) is None:
+        return {'error': 'Repository not found'}, 404
+    return await _run(flaskapp._file_steps(repo, data['commit'], data['filepath'], headers))
+
+
+def _job_status(request, job):
+    status = {k: job.get(k) for k in ('job_id', 'status', 'phase', 'log_tail', 'error', 'limit')}
+    if job['status'] == 'done':
+        status['pdf_url'] = f"{request.scope.get('root_path', '')}/api/pdf/{flaskapp._pdf_key(job['pdf_path'])}"
+    return status
+
+
+async def _load_job(request, job_id):
+    job = await _blocking(compile_jobs.get, job_id)
+    if job is None or job.get('user') != flaskapp._user_key(request.session['oauth_token']):
+        return None
+    return job
+
+
+@app.route('/api/compile/jobs/<job_id>')
+async def get_compile_job(request, job_id):
+    job = await _load_job(request, job_id)
+    if job is None:
+        return {'error': 'Job not found'}, 404
+    return _job_status(request, job), 200
+
+
+@app.route('/api/compile/jobs/<job_id>/events')
+async def stream_compile_job(request, job_id):
+    if await _load_job(request, job_id) is None:
+        return {'error': 'Job not found'}, 404
+
+    # An open event stream costs a sleeping coroutine, not a thread
+    async def stream(send):
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/event-stream; charset=utf-8'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no'),
+        ]})
+        last = None
+        while True:
+            job = await _blocking(compile_jobs.get, job_id)
+            if job is None:
+                break
+            status = _job_status(request, job)
+            if status != last:
+                await send({'type': 'http.response.body', 'body': f'data: {json.dumps(status)}\n\n'.encode(),
+                            'more_body': True})
+                last = status
+            if job['status'] in ('done', 'failed'):
+                break
+            await asyncio.sleep(0.5)
+        await send({'type': 'http.response.body', 'body': b''})
+        return 200
+    return stream
+
+
+# -- ASGI plumbing
+
+async def _read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            break
+    return b''.join(chunks)
+
+
+class _ReceiveStream(io.RawIOBase):
+    """The ASGI request body as a blocking file, for wsgi.input on a pool thread."""
+
+    def __init__(self, receive, loop):
+        self.receive = receive
+        self.loop = loop
+        self.chunk = memoryview(b'')
+        self.done = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.chunk and not self.done:
+            message = asyncio.run_coroutine_threadsafe(self.receive(), self.loop).result()
+            if message['type'] == 'http.disconnect':
+                self.done = True
+            else:
+                self.chunk = memoryview(message.get('body', b''))
+                self.done = not message.get('more_body')
+        count = min(len(buffer), len(self.chunk))
+        buffer[:count] = self.chunk[:count]
+        self.chunk = self.chunk[count:]
+        return count
+
+
+async def _send_json(send, payload, status, request=None):
+    body = json.dumps(payload).encode('utf-8')
+    headers = [(b'content-type', b'application/json'), (b'vary', b'Accept-Encoding')]
+    encoding = choose_encoding(request.headers.get('accept-encoding')) if request else None
+    if encoding and len(body) >= flaskapp.RESPONSE_COMPRESSION_MIN_BYTES:
+        # Big trees take a while to compress - keep that off the event loop
+        if len(body) >= COMPRESS_OFFLOAD_BYTES:
+            body = await asyncio.get_running_loop().run_in_executor(app.wsgi.executor, compress, body, encoding)
+        else:
+            body = compress(body, encoding)
+        headers.append((b'content-encoding', encoding.encode()))
+    headers.append((b'content-length', str(len(body)).encode()))
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def _environ(scope, stream):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': stream,
+        # The stream ends with the body, chunked uploads included
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            environ[name] = value
+        else:
+            key = 'HTTP_' + name
+            environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+def serve(host='0.0.0.0', port=7860, workers=ASYNC_WORKERS):
+    """Run app under uvicorn on a listening socket created here.
+
+    asyncio only sets TCP_NODELAY on accepted connections when the listening
+    socket's proto is IPPROTO_TCP, and the one uvicorn binds itself has proto
+    0 - every response sent as headers then body would wait ~40ms on the
+    client's delayed ACK. Binding the socket ourselves avoids that.
+    """
+    import uvicorn
+    from uvicorn.supervisors import Multiprocess
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    config = uvicorn.Config('asgi_app:app', host=host, port=port, workers=workers, access_log=False,
+                            timeout_keep_alive=75)
+    server = uvicorn.Server(config)
+    if workers > 1:
+        Multiprocess(config, sockets=[sock]).run()
+    else:
+        server.run(sockets=[sock])
+
+
+if __name__ == '__main__':
+    serve(os.environ.get('HOST', '0.0.0.0'), int(os.environ.get('PORT', 7860)))
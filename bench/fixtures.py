@@ -0,0 +1,118 @@
+"""Canned LaTeX projects for the benchmark, generated deterministically.
+
+Each size is a bare repository with a main.tex that \\input's its sections,
+figures, a bibliography and a README, plus a history of small edits spread
+over the year before BASE_TIME - the shape of a real paper or thesis.
+"""
+import os
+import random
+import subprocess
+
+BASE_TIME = 1700000000  # history ends here, so runs are reproducible
+
+SIZES = {
+    'small': {'sections': 4, 'figures': 2, 'figure_kb': 20, 'commits': 30},
+    'medium': {'sections': 20, 'figures': 15, 'figure_kb': 120, 'commits': 400},
+    'large': {'sections': 80, 'figures': 120, 'figure_kb': 300, 'commits': 3000},
+}
+
+WORDS = ('latency throughput cache commit branch compile preamble section figure table equation theorem '
+         'proof lemma result method dataset baseline experiment evaluation analysis model error bound').split()
+
+
+def make_repo(path, size, seed=0):
+    """Create the bare repository for size at path; returns a description of it."""
+    spec = SIZES[size]
+    rng = random.Random(f'{size}-{seed}')
+    subprocess.run(['git', 'init', '-q', '--bare', '-b', 'main', path], check=True)
+
+    sections = {f'sections/sec{i:02d}.tex': _section(rng, i, spec['figures']) for i in range(spec['sections'])}
+    files = {
+        'main.tex': _main(spec['sections']),
+        'refs.bib': _bibliography(rng),
+        'README.md': f'# Benchmark project ({size})\n\n' + _paragraph(rng) + '\n',
+    }
+    files.update(sections)
+    for i in range(spec['figures']):
+        # PNG signature and random payload - compiles never decode it
+        files[f'figures/fig{i:02d}.png'] = b'\x89PNG\r\n\x1a\n' + rng.randbytes(spec['figure_kb'] * 1024)
+
+    stream = []
+    start = BASE_TIME - 365 * 24 * 3600
+    step = 365 * 24 * 3600 // spec['commits']
+    for n in range(spec['commits']):
+        if n == 0:
+            changed = files
+            message = 'Initial project'
+        else:
+            # Most edits touch one section, like a day of writing
+            path_changed = rng.choice(sorted(sections))
+            sections[path_changed] += _paragraph(rng) + '\n\n'
+            changed = {path_changed: sections[path_changed]}
+            message = f'Edit {os.path.basename(path_changed)}'
+        stream.append(_commit(n, start + n * step + rng.randrange(step), message, changed))
+    subprocess.run(['git', 'fast-import', '--quiet'], cwd=path, input=b''.join(stream), check=True)
+    return {'size': size, 'files': sorted(files), 'sections': sorted(sections), 'first': start,
+            'last': start + spec['commits'] * step}
+
+
+def add_branches(path, names, start='main'):
+    """Point refs/heads/<name> at start for every name (one per simulated user)."""
+    commands = ''.join(f'create refs/heads/{name} {start}\n' for name in names)
+    subprocess.run(['git', 'update-ref', '--stdin'], cwd=path, input=commands.encode(), check=True)
+
+
+def _commit(n, timestamp, message, files):
+    out = [f'commit refs/heads/main\nmark :{n + 1}\n'.encode(),
+           f'author Benchmark User <bench@example.com> {timestamp} +0000\n'.encode(),
+           f'committer Benchmark User <bench@example.com> {timestamp} +0000\n'.encode(),
+           _data(message.encode())]
+    if n:
+        out.append(f'from :{n}\n'.encode())
+    for path, content in sorted(files.items()):
+        out.append(f'M 100644 inline {path}\n'.encode())
+        out.append(_data(content if isinstance(content, bytes) else content.encode('utf-8')))
+    out.append(b'\n')
+    return b''.join(out)
+
+
+def _data(content):
+    return f'data {len(content)}\n'.encode() + content + b'\n'
+
+
+def _main(sections):
+    inputs = '\n'.join(f'\\input{{sections/sec{i:02d}}}' for i in range(sections))
+    return ('\\documentclass[11pt]{article}\n'
+            '\\usepackage[utf8]{inputenc}\n'
+            '\\usepackage{amsmath,amssymb}\n'
+            '\\usepackage{graphicx}\n'
+            '\\usepackage{hyperref}\n'
+            '\\graphicspath{{figures/}}\n'
+            '\\title{Benchmark Project}\n'
+            '\\author{Benchmark User}\n\n'
+            '\\begin{document}\n'
+            '\\maketitle\n\n'
+            f'{inputs}\n\n'
+            '\\end{document}\n')
+
+
+def _section(rng, i, figures):
+    body = [f'\\section{{Section {i}}}\\label{{sec:{i}}}\n']
+    for _ in range(rng.randint(3, 8)):
+        body.append(_paragraph(rng) + '\n')
+    if figures:
+        figure = rng.randrange(figures)
+        body.append('\\begin{figure}[h]\n\\centering\n'
+                    f'\\includegraphics[width=0.6\\linewidth]{{fig{figure:02d}}}\n'
+                    f'\\caption{{Figure for section {i}.}}\\label{{fig:{i}}}\n\\end{{figure}}\n')
+    body.append(f'As shown in Section~\\ref{{sec:{i}}}, $E = \\sum_{{k=1}}^{{{i + 2}}} k^2$.\n\n')
+    return '\n'.join(body)
+
+
+def _paragraph(rng):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(40, 120))).capitalize() + '.'
+
+
+def _bibliography(rng):
+    return '\n'.join(f'@article{{ref{i},\n  title={{{_paragraph(rng)[:60]}}},\n  author={{Author {i}}},\n'
+                     f'  year={{{2000 + i}}}\n}}\n' for i in range(20))
@@ -0,0 +1,575 @@
+"""A local stand-in for api.github.com and GitHub's git-over-HTTP.
+
+Serves the bare repositories under a directory (<root>/<owner>/<name>.git)
+through the parts of the REST API UnderLeaf calls - refs, the git data API,
+contents, commit listings and compares - and smart HTTP at /git/<owner>/<name>.git
+for compiles, so the app can be load tested offline and without rate limits.
+Any Authorization header is accepted. GETs carry ETags and answer
+If-None-Match with 304 like GitHub does.
+
+    python bench/github_stub.py --root /tmp/repos --port 8765 --latency 0.05
+"""
+import os
+import re
+import sys
+import json
+import time
+import base64
+import hashlib
+import argparse
+import tempfile
+import threading
+import subprocess
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, unquote
+
+NOT_FOUND = (404, {'message': 'Not Found'})
+ZERO_SHA = '0' * 40
+RAW_MEDIA_TYPE = 'application/vnd.github.raw'
+# Record separator for git log output - commit messages may contain anything else
+RECORD = '\x1e'
+FIELD = '\x1f'
+COMMIT_FORMAT = FIELD.join(['%H', '%T', '%P', '%an', '%ae', '%ad', '%cn', '%ce', '%cd', '%B']) + RECORD
+
+
+class GitError(Exception):
+    pass
+
+
+class GitHubStub:
+    """The REST API over bare repositories; one instance is shared by all request threads."""
+
+    def __init__(self, root, latency=0.0, tree_limit=100000):
+        self.root = os.path.abspath(root)
+        self.latency = latency
+        self.tree_limit = tree_limit  # entries in a recursive listing before it is truncated, like GitHub's
+        self.counts = {}  # (method, endpoint) -> calls
+        self._lock = threading.Lock()
+        self._ref_locks = {}
+        self.routes = [
+            ('GET', r'/user', self.get_user),
+            ('GET', r'/user/repos', self.list_repos),
+            ('GET', r'/repos/{repo}', self.get_repo),
+            ('GET', r'/repos/{repo}/branches', self.list_branches),
+            ('GET', r'/repos/{repo}/branches/(?P<branch>.+)', self.get_branch),
+            ('GET', r'/repos/{repo}/git/ref/(?P<ref>.+)', self.get_ref),
+            ('POST', r'/repos/{repo}/git/refs', self.create_ref),
+            ('PATCH', r'/repos/{repo}/git/refs/(?P<ref>.+)', self.update_ref),
+            ('GET', r'/repos/{repo}/git/commits/(?P<sha>[0-9a-f]+)', self.get_commit),
+            ('POST', r'/repos/{repo}/git/commits', self.create_commit),
+            ('GET', r'/repos/{repo}/git/trees/(?P<sha>[0-9a-f]+)', self.get_tree),
+            ('POST', r'/repos/{repo}/git/trees', self.create_tree),
+            ('GET', r'/repos/{repo}/git/blobs/(?P<sha>[0-9a-f]+)', self.get_blob),
+            ('POST', r'/repos/{repo}/git/blobs', self.create_blob),
+            ('GET', r'/repos/{repo}/commits', self.list_commits),
+            ('GET', r'/repos/{repo}/compare/(?P<base>.+?)\.\.\.(?P<head>.+)', self.compare),
+            ('GET', r'/repos/{repo}/contents/(?P<path>.*)', self.get_contents),
+            ('PUT', r'/repos/{repo}/contents/(?P<path>.+)', self.put_contents),
+            ('DELETE', r'/repos/{repo}/contents/(?P<path>.+)', self.delete_contents),
+        ]
+        # Counted under a readable name: /repos/{repo}/git/blobs/{sha}
+        self.routes = [(method, re.compile('^' + pattern.replace('{repo}', r'(?P<owner>[^/]+)/(?P<name>[^/]+)') + '$'),
+                        handler, re.sub(r'\(\?P<(\w+)>[^)]*\)', r'{\1}', pattern).replace('\\.', '.'))
+                       for method, pattern, handler in self.routes]
+
+    def dispatch(self, method, path, query, body):
+        """Return (status, JSON-able payload) for one API request."""
+        for route_method, pattern, handler, endpoint in self.routes:
+            match = pattern.match(path)
+            if match and route_method == method:
+                with self._lock:
+                    self.counts[(method, endpoint)] = self.counts.get((method, endpoint), 0) + 1
+                args = {k: unquote(v) for k, v in match.groupdict().items()}
+                if 'owner' in args:
+                    repo_dir = os.path.join(self.root, args.pop('owner'), args.pop('name') + '.git')
+                    if not os.path.isdir(repo_dir):
+                        return NOT_FOUND
+                    args['repo_dir'] = repo_dir
+                try:
+                    return handler(query=query, body=body, **args)
+                except GitError:
+                    return NOT_FOUND
+        return NOT_FOUND
+
+    # -- users and repositories
+
+    def get_user(self, query, body):
+        return 200, {'login': 'bench', 'id': 1, 'name': 'Benchmark User', 'avatar_url': '', 'type': 'User'}
+
+    def list_repos(self, query, body):
+        repos = []
+        for owner in sorted(os.listdir(self.root)):
+            if not os.path.isdir(os.path.join(self.root, owner)):
+                continue
+            for name in sorted(os.listdir(os.path.join(self.root, owner))):
+                if name.endswith('.git'):
+                    repos.append(self._repo(owner, name[:-4]))
+        per_page, page = _paging(query)
+        return 200, repos[(page - 1) * per_page:page * per_page]
+
+    def get_repo(self, repo_dir, query, body):
+        owner = os.path.basename(os.path.dirname(repo_dir))
+        return 200, self._repo(owner, os.path.basename(repo_dir)[:-4])
+
+    def _repo(self, owner, name):
+        repo_dir = os.path.join(self.root, owner, name + '.git')
+        head = _git(repo_dir, 'symbolic-ref', '--short', 'HEAD', check=False).strip() or 'main'
+        return {
+            'id': int(hashlib.sha1(f'{owner}/{name}'.encode()).hexdigest()[:8], 16),
+            'name': name,
+            'full_name': f'{owner}/{name}',
+            'owner': {'login': owner},
+            'private': False,
+            'default_branch': head,
+            'updated_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(os.path.getmtime(repo_dir))),
+            'permissions': {'admin': True, 'push': True, 'pull': True},
+        }
+
+    # -- refs
+
+    def list_branches(self, repo_dir, query, body):
+        output = _git(repo_dir, 'for-each-ref', '--format=%(refname:strip=2) %(objectname)', 'refs/heads')
+        branches = []
+        for line in output.splitlines():
+            name, sha = line.rsplit(' ', 1)
+            branches.append({'name': name, 'commit': {'sha': sha}, 'protected': False})
+        per_page, page = _paging(query)
+        return 200, branches[(page - 1) * per_page:page * per_page]
+
+    def get_branch(self, repo_dir, branch, query, body):
+        sha = _resolve(repo_dir, 'refs/heads/' + branch)
+        if not sha:
+            return NOT_FOUND
+        return 200, {'name': branch, 'commit': self._listed_commit(self._commits(repo_dir, [sha, '-1'])[0]),
+                     'protected': False}
+
+    def get_ref(self, repo_dir, ref, query, body):
+        sha = _resolve(repo_dir, 'refs/' + ref)
+        if not sha:
+            return NOT_FOUND
+        return 200, {'ref': 'refs/' + ref, 'object': {'sha': sha, 'type': 'commit'}}
+
+    def create_ref(self, repo_dir, query, body):
+        ref, sha = body.get('ref', ''), body.get('sha', '')
+        if not ref.startswith('refs/') or not _resolve(repo_dir, sha):
+            return 422, {'message': 'Reference update failed'}
+        with self._ref_lock(repo_dir):
+            if _resolve(repo_dir, ref):
+                return 422, {'message': 'Reference already exists'}
+            _git(repo_dir, 'update-ref', ref, sha)
+        return 201, {'ref': ref, 'object': {'sha': sha, 'type': 'commit'}}
+
+    def update_ref(self, repo_dir, ref, query, body):
+        ref = 'refs/' + ref
+        sha = body.get('sha', '')
+        if not _resolve(repo_dir, sha):
+            return 422, {'message': 'Object does not exist'}
+        with self._ref_lock(repo_dir):
+            current = _resolve(repo_dir, ref)
+            if not current:
+                return 422, {'message': 'Reference does not exist'}
+            if not body.get('force') and not _is_ancestor(repo_dir, current, sha):
+                return 422, {'message': 'Update is not a fast forward'}
+            _git(repo_dir, 'update-ref', ref, sha, current)
+        return 200, {'ref': ref, 'object': {'sha': sha, 'type': 'commit'}}
+
+    def _ref_lock(self, repo_dir):
+        with self._lock:
+            return self._ref_locks.setdefault(repo_dir, threading.Lock())
+
+    # -- git data API
+
+    def get_commit(self, repo_dir, sha, query, body):
+        if _git(repo_dir, 'cat-file', '-t', sha, check=False).strip() != 'commit':
+            return NOT_FOUND
+        commit = self._commits(repo_dir, [sha, '-1'])[0]
+        return 200, {
+            'sha': commit['sha'],
+            'tree': {'sha': commit['tree']},
+            'parents': [{'sha': parent} for parent in commit['parents']],
+            'message': commit['message'],
+            'author': commit['author'],
+            'committer': commit['committer'],
+        }
+
+    def create_commit(self, repo_dir, query, body):
+        args = ['commit-tree', body['tree']]
+        for parent in body.get('parents', []):
+            args += ['-p', parent]
+        author = body.get('author') or {}
+        env = dict(os.environ,
+                   GIT_AUTHOR_NAME=author.get('name', 'Benchmark User'),
+                   GIT_AUTHOR_EMAIL=author.get('email', 'bench@example.com'),
+                   GIT_COMMITTER_NAME='Benchmark User',
+                   GIT_COMMITTER_EMAIL='bench@example.com')
+        try:
+            sha = _git(repo_dir, *args, input=body.get('message', '').encode('utf-8'), env=env).strip()
+        except GitError as e:
+            return 422, {'message': str(e)}
+        return 201, {'sha': sha, 'tree': {'sha': body['tree']}, 'message': body.get('message', '')}
+
+    def get_tree(self, repo_dir, sha, query, body):
+        if _git(repo_dir, 'cat-file', '-t', sha, check=False).strip() not in ('tree', 'commit'):
+            return NOT_FOUND
+        recursive = query.get('recursive', ['0'])[0] not in ('0', '', 'false')
+        return 200, self._tree(repo_dir, sha, recursive)
+
+    def _tree(self, repo_dir, sha, recursive):
+        args = ['ls-tree', '-l', '-z'] + (['-r', '-t'] if recursive else []) + [sha]
+        entries = []
+        for record in _git_bytes(repo_dir, *args).split(b'\0'):
+            if not record:
+                continue
+            info, path = record.split(b'\t', 1)
+            mode, kind, object_sha, size = info.decode().split()
+            entry = {'path': path.decode('utf-8', errors='surrogateescape'), 'mode': mode, 'type': kind,
+                     'sha': object_sha}
+            if kind == 'blob':
+                entry['size'] = int(size)
+            entries.append(entry)
+        tree_sha = _git(repo_dir, 'rev-parse', sha + '^{tree}').strip()
+        truncated = recursive and len(entries) > self.tree_limit
+        return {'sha': tree_sha, 'tree': entries[:self.tree_limit] if truncated else entries, 'truncated': truncated}
+
+    def create_tree(self, repo_dir, query, body):
+        fd, index = tempfile.mkstemp(prefix='stub-index-')
+        os.close(fd)
+        os.remove(index)
+        env = dict(os.environ, GIT_INDEX_FILE=index)
+        try:
+            base = body.get('base_tree')
+            _git(repo_dir, 'read-tree', *([base] if base else ['--empty']), env=env)
+            lines = []
+            for item in body.get('tree', []):
+                if item.get('sha') is None and 'content' not in item:
+                    lines.append(f"0 {ZERO_SHA}\t{item['path']}")
+                    continue
+                sha = item.get('sha')
+                if sha is None:
+                    sha = _git(repo_dir, 'hash-object', '-w', '--stdin', input=item['content'].encode('utf-8')).strip()
+                lines.append(f"{item.get('mode', '100644')} {sha}\t{item['path']}")
+            _git(repo_dir, 'update-index', '--index-info', input=('\n'.join(lines) + '\n').encode('utf-8'), env=env)
+            sha = _git(repo_dir, 'write-tree', env=env).strip()
+        except GitError as e:
+            return 422, {'message': str(e)}
+        finally:
+            if os.path.exists(index):
+                os.remove(index)
+        return 201, self._tree(repo_dir, sha, False)
+
+    def get_blob(self, repo_dir, sha, query, body):
+        if _git(repo_dir, 'cat-file', '-t', sha, check=False).strip() != 'blob':
+            return NOT_FOUND
+        content = _git_bytes(repo_dir, 'cat-file', 'blob', sha)
+        return 200, {'sha': sha, 'size': len(content), 'encoding': 'base64', 'content': _encode(content)}
+
+    def create_blob(self, repo_dir, query, body):
+        content = body.get('content', '')
+        data = base64.b64decode(content) if body.get('encoding') == 'base64' else content.encode('utf-8')
+        sha = _git(repo_dir, 'hash-object', '-w', '--stdin', input=data).strip()
+        return 201, {'sha': sha}
+
+    # -- history
+
+    def list_commits(self, repo_dir, query, body):
+        ref = query.get('sha', ['HEAD'])[0]
+        if not _resolve(repo_dir, ref):
+            return NOT_FOUND
+        per_page, page = _paging(query)
+        args = [ref, f'--skip={(page - 1) * per_page}', f'--max-count={per_page}']
+        if query.get('path'):
+            args += ['--', query['path'][0]]
+        return 200, [self._listed_commit(commit) for commit in self._commits(repo_dir, args)]
+
+    def compare(self, repo_dir, base, head, query, body):
+        base_sha, head_sha = _resolve(repo_dir, base), _resolve(repo_dir, head)
+        if not base_sha or not head_sha:
+            return NOT_FOUND
+        ahead_by = int(_git(repo_dir, 'rev-list', '--count', f'{base_sha}..{head_sha}'))
+        behind_by = int(_git(repo_dir, 'rev-list', '--count', f'{head_sha}..{base_sha}'))
+        status = ('identical' if not ahead_by and not behind_by else 'ahead' if not behind_by
+                  else 'behind' if not ahead_by else 'diverged')
+        # GitHub lists at most 250 commits, oldest first
+        commits = self._commits(repo_dir, ['--reverse', f'{base_sha}..{head_sha}']) if ahead_by <= 250 else \
+            self._commits(repo_dir, [f'{base_sha}..{head_sha}', '--max-count=250'])[::-1]
+        return 200, {'status': status, 'ahead_by': ahead_by, 'behind_by': behind_by,
+                     'total_commits': ahead_by, 'commits': [self._listed_commit(commit) for commit in commits]}
+
+    def _commits(self, repo_dir, args):
+        env = dict(os.environ, TZ='UTC')
+        output = _git(repo_dir, 'log', f'--format={COMMIT_FORMAT}', '--date=format-local:%Y-%m-%dT%H:%M:%SZ',
+                      *args, env=env)
+        commits = []
+        for record in output.split(RECORD):
+            record = record.lstrip('\n')
+            if not record:
+                continue
+            sha, tree, parents, an, ae, ad, cn, ce, cd, message = record.split(FIELD)
+            commits.append({
+                'sha': sha, 'tree': tree, 'parents': parents.split(), 'message': message.rstrip('\n'),
+                'author': {'name': an, 'email': ae, 'date': ad},
+                'committer': {'name': cn, 'email': ce, 'date': cd},
+            })
+        return commits
+
+    def _listed_commit(self, commit):
+        return {
+            'sha': commit['sha'],
+            'commit': {
+                'author': commit['author'],
+                'committer': commit['committer'],
+                'message': commit['message'],
+                'tree': {'sha': commit['tree']},
+            },
+            'parents': [{'sha': parent} for parent in commit['parents']],
+        }
+
+    # -- contents API
+
+    def get_contents(self, repo_dir, path, query, body):
+        ref = query.get('ref', ['HEAD'])[0]
+        sha = _resolve(repo_dir, f'{ref}:{path}', kind=None)
+        if not sha:
+            return NOT_FOUND
+        if _git(repo_dir, 'cat-file', '-t', sha).strip() == 'tree':
+            entries = self._tree(repo_dir, sha, False)['tree']
+            return 200, [{'name': entry['path'], 'path': f'{path}/{entry["path"]}'.lstrip('/'),
+                          'sha': entry['sha'], 'type': 'file' if entry['type'] == 'blob' else 'dir',
+                          'size': entry.get('size', 0)} for entry in entries]
+        content = _git_bytes(repo_dir, 'cat-file', 'blob', sha)
+        return 200, {'type': 'file', 'name': os.path.basename(path), 'path': path, 'sha': sha,
+                     'size': len(content), 'encoding': 'base64', 'content': _encode(content)}
+
+    def put_contents(self, repo_dir, path, query, body):
+        return self._write_contents(repo_dir, path, body, base64.b64decode(body.get('content', '')))
+
+    def delete_contents(self, repo_dir, path, query, body):
+        return self._write_contents(repo_dir, path, body, None)
+
+    def _write_contents(self, repo_dir, path, body, content):
+        branch = body.get('branch') or _git(repo_dir, 'symbolic-ref', '--short', 'HEAD').strip()
+        ref = 'refs/heads/' + branch
+        with self._ref_lock(repo_dir):
+            head = _resolve(repo_dir, ref)
+            existing = _resolve(repo_dir, f'{head}:{path}', kind=None) if head else None
+            if existing and body.get('sha') != existing:
+                return 409 if body.get('sha') else 422, {'message': f'{path} does not match {body.get("sha")}'}
+            if content is None and not existing:
+                return NOT_FOUND
+
+            item = {'path': path, 'mode': '100644', 'sha': None}
+            if content is not None:
+                item['sha'] = _git(repo_dir, 'hash-object', '-w', '--stdin', input=content).strip()
+            status, tree = self.create_tree(repo_dir, {}, {'base_tree': head, 'tree': [item]})
+            if status != 201:
+                return status, tree
+            status, commit = self.create_commit(repo_dir, {}, {'message': body.get('message', ''), 'tree': tree['sha'],
+                                                               'parents': [head] if head else []})
+            if status != 201:
+                return status, commit
+            _git(repo_dir, 'update-ref', ref, commit['sha'], head or ZERO_SHA)
+            if not head:
+                _git(repo_dir, 'symbolic-ref', 'HEAD', ref)
+
+        if content is None:
+            return 200, {'content': None, 'commit': {'sha': commit['sha']}}
+        return 200 if existing else 201, {
+            'content': {'name': os.path.basename(path), 'path': path, 'sha': item['sha'], 'size': len(content)},
+            'commit': {'sha': commit['sha']},
+        }
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counts)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are separate writes; don't let Nagle hold the body back
+    disable_nagle_algorithm = True
+    server_version = 'GitHubStub/1.0'
+    verbose = False
+
+    def do_GET(self):
+        self._handle()
+
+    do_POST = do_PUT = do_PATCH = do_DELETE = do_GET
+
+    def _handle(self):
+        url = urlsplit(self.path)
+        body = self._read_body()
+        if url.path.startswith('/git/'):
+            return self._smart_http(url.path[len('/git'):], url.query, body)
+
+        if not self.headers.get('Authorization'):
+            return self._send_json(401, {'message': 'Requires authentication'})
+        stub = self.server.stub
+        if stub.latency:
+            time.sleep(stub.latency)
+        try:
+            payload = json.loads(body) if body else {}
+        except ValueError:
+            return self._send_json(400, {'message': 'Problems parsing JSON'})
+        status, result = stub.dispatch(self.command, url.path.rstrip('/') or '/', parse_qs(url.query), payload)
+        # The raw media type answers blob and file reads with the bytes themselves
+        if (self.headers.get('Accept') == RAW_MEDIA_TYPE and status == 200 and isinstance(result, dict)
+                and result.get('encoding') == 'base64'):
+            return self._send_raw(base64.b64decode(result['content']), result['sha'])
+        self._send_json(status, result)
+
+    def _send_raw(self, data, sha):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('ETag', f'"{sha}"')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_json(self, status, payload):
+        data = json.dumps(payload).encode('utf-8')
+        headers = {
+            'Content-Type': 'application/json; charset=utf-8',
+            'X-RateLimit-Limit': '5000',
+            'X-RateLimit-Remaining': '4999',
+            'X-RateLimit-Reset': str(int(time.time()) + 3600),
+        }
+        if self.command == 'GET' and status == 200:
+            etag = '"' + hashlib.sha1(data).hexdigest() + '"'
+            headers['ETag'] = etag
+            if self.headers.get('If-None-Match') == etag:
+                status, data = 304, b''
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _smart_http(self, path_info, query, body):
+        # git's own CGI does the pack negotiation; partial clones need filters
+        # and fetching by SHA enabled, which GitHub allows
+        env = dict(os.environ,
+                   GIT_PROJECT_ROOT=self.server.stub.root,
+                   GIT_HTTP_EXPORT_ALL='1',
+                   PATH_INFO=path_info,
+                   QUERY_STRING=query,
+                   REQUEST_METHOD=self.command,
+                   CONTENT_TYPE=self.headers.get('Content-Type', ''),
+                   CONTENT_LENGTH=str(len(body)),
+                   REMOTE_ADDR=self.client_address[0],
+                   GIT_CONFIG_COUNT='2',
+                   GIT_CONFIG_KEY_0='uploadpack.allowFilter',
+                   GIT_CONFIG_VALUE_0='true',
+                   GIT_CONFIG_KEY_1='uploadpack.allowAnySHA1InWant',
+                   GIT_CONFIG_VALUE_1='true')
+        if self.headers.get('Content-Encoding'):
+            env['HTTP_CONTENT_ENCODING'] = self.headers['Content-Encoding']
+        if self.headers.get('Git-Protocol'):
+            env['GIT_PROTOCOL'] = self.headers['Git-Protocol']
+        output = subprocess.run(['git', 'http-backend'], input=body, env=env, capture_output=True).stdout
+
+        separator = b'\r\n\r\n' if b'\r\n\r\n' in output else b'\n\n'
+        head, _, data = output.partition(separator)
+        status = 200
+        headers = []
+        for line in head.decode('latin-1').splitlines():
+            name, _, value = line.partition(':')
+            if name.lower() == 'status':
+                status = int(value.split()[0])
+            elif name:
+                headers.append((name, value.strip()))
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0].strip() or b'0', 16)
+                if not size:
+                    # Trailers end with an empty line
+                    while self.rfile.readline() not in (b'\r\n', b'\n', b''):
+                        pass
+                    return b''.join(chunks)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def log_message(self, format, *args):
+        if self.verbose:
+            super().log_message(format, *args)
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, address, stub):
+        super().__init__(address, StubHandler)
+        self.stub = stub
+
+    def handle_error(self, request, client_address):
+        # The app closes streamed downloads early once it has seen enough
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def serve(root, host='127.0.0.1', port=0, latency=0.0, tree_limit=100000):
+    """Start the stub on a background thread; returns the server (server_address has the port)."""
+    server = StubServer((host, port), GitHubStub(root, latency, tree_limit))
+    threading.Thread(target=server.serve_forever, name='github-stub', daemon=True).start()
+    return server
+
+
+def _git_bytes(repo_dir, *args, input=None, env=None, check=True):
+    result = subprocess.run(['git', *args], cwd=repo_dir, input=input, capture_output=True, env=env)
+    if check and result.returncode != 0:
+        raise GitError(result.stderr.decode('utf-8', errors='replace').strip())
+    return result.stdout
+
+
+def _git(repo_dir, *args, **kwargs):
+    return _git_bytes(repo_dir, *args, **kwargs).decode('utf-8', errors='replace')
+
+
+def _resolve(repo_dir, name, kind='commit'):
+    if not name:
+        return None
+    spec = f'{name}^{{{kind}}}' if kind else name
+    return _git(repo_dir, 'rev-parse', '--verify', '-q', spec, check=False).strip() or None
+
+
+def _is_ancestor(repo_dir, ancestor, descendant):
+    return subprocess.run(['git', 'merge-base', '--is-ancestor', ancestor, descendant], cwd=repo_dir,
+                          capture_output=True).returncode == 0
+
+
+def _encode(content):
+    # GitHub wraps base64 content at 60 columns
+    encoded = base64.b64encode(content).decode('ascii')
+    return '\n'.join(encoded[i:i + 60] for i in range(0, len(encoded), 60))
+
+
+def _paging(query):
+    per_page = min(int(query.get('per_page', ['30'])[0]), 100)
+    page = max(int(query.get('page', ['1'])[0]), 1)
+    return per_page, page
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--root', required=True, help='directory of <owner>/<name>.git bare repositories')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every API response')
+    parser.add_argument('--tree-limit', type=int, default=100000, help='entries before recursive trees are truncated')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+    StubHandler.verbose = args.verbose
+    server = StubServer((args.host, args.port), GitHubStub(args.root, args.latency, args.tree_limit))
+    print(f'GitHub stub for {args.root} on http://{args.host}:{server.server_address[1]}')
+    server.serve_forever()
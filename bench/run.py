@@ -0,0 +1,347 @@
+"""Reproducible load and latency benchmark for UnderLeaf.
+
+Starts the app against a local GitHub stub (bench/github_stub.py) serving
+generated projects (bench/fixtures.py), then runs simulated editor sessions:
+open a repo, load its tree, open files, then autosave and compile every few
+seconds, now and then browsing the history. Prints throughput and latency
+percentiles per endpoint. Runs fully offline; with --fake-tex the compiles
+use the stand-ins in bench/fakebin instead of a TeX installation.
+
+    python bench/run.py --users 20 --duration 60 --size small --size medium --fake-tex
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+from datetime import datetime, timezone
+
+import requests
+from flask import Flask
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.dirname(BENCH_DIR)
+sys.path[:0] = [BENCH_DIR, APP_DIR]
+
+import fixtures  # noqa: E402
+import github_stub  # noqa: E402
+from save_buffer import git_blob_sha  # noqa: E402
+
+STATE_DIRS = ('WORKSPACE_CACHE_DIR', 'PDF_CACHE_DIR', 'PAGE_CACHE_DIR', 'FORMAT_CACHE_DIR', 'PACKAGE_STATE_DIR',
+              'COMPILE_SLOTS_DIR', 'COMPILE_JOBS_DIR', 'COMMIT_INDEX_DIR', 'SAVE_BUFFER_DIR', 'SHARED_CACHE_DIR',
+              'METRICS_DIR')
+
+
+class Recorder:
+    """Latencies per endpoint, shared by all simulated users."""
+
+    def __init__(self, warmup_until=0):
+        self.warmup_until = warmup_until
+        self.samples = {}  # endpoint -> [seconds]
+        self.errors = {}   # endpoint -> count
+        self._lock = threading.Lock()
+
+    def add(self, endpoint, seconds, ok=True):
+        if time.monotonic() < self.warmup_until:
+            return
+        with self._lock:
+            self.samples.setdefault(endpoint, []).append(seconds)
+            if not ok:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def report(self, duration):
+        rows = []
+        with self._lock:
+            for endpoint, samples in sorted(self.samples.items()):
+                samples = sorted(samples)
+                rows.append({
+                    'endpoint': endpoint,
+                    'count': len(samples),
+                    'errors': self.errors.get(endpoint, 0),
+                    'rps': len(samples) / duration,
+                    'p50_ms': _percentile(samples, 50) * 1000,
+                    'p95_ms': _percentile(samples, 95) * 1000,
+                    'p99_ms': _percentile(samples, 99) * 1000,
+                    'max_ms': samples[-1] * 1000,
+                })
+        return rows
+
+
+class Session:
+    """One simulated editor tab: a logged-in HTTP session working on one branch."""
+
+    def __init__(self, base_url, cookie, recorder, repo, branch, info, args, seed):
+        self.base_url = base_url
+        self.recorder = recorder
+        self.repo = repo
+        self.branch = branch
+        self.info = info
+        self.args = args
+        self.rng = random.Random(seed)
+        self.http = requests.Session()
+        self.http.cookies.set('session', cookie)
+        self.contents = {}
+        self.shas = {}
+        self.tree_sha = None
+        self.edits = 0
+
+    def call(self, endpoint, method, path, ok=(200,), **kwargs):
+        start = time.monotonic()
+        try:
+            response = self.http.request(method, self.base_url + path, timeout=300, **kwargs)
+        except requests.RequestException:
+            self.recorder.add(endpoint, time.monotonic() - start, ok=False)
+            return None
+        self.recorder.add(endpoint, time.monotonic() - start, ok=response.status_code in ok)
+        return response
+
+    def run(self, deadline):
+        self.open()
+        next_at = time.monotonic()
+        while True:
+            next_at += self.args.interval
+            if next_at >= deadline:
+                break
+            time.sleep(max(0, next_at - time.monotonic()))
+            self.autosave_and_compile()
+            if self.rng.random() < self.args.history:
+                self.browse_history()
+            if self.rng.random() < 0.2:
+                self.load_tree()
+                self.open_file(self.rng.choice(self.info['sections']))
+
+    def open(self):
+        self.call('GET /api/user', 'GET', '/api/user')
+        self.call('GET /api/repos', 'GET', '/api/repos?page=1&per_page=100')
+        self.call('GET /api/branches/<repo>', 'GET', f'/api/branches/{self.repo}')
+        self.load_tree()
+        self.open_file('main.tex')
+        self.open_file(self.rng.choice(self.info['sections']))
+
+    def load_tree(self):
+        # Like the editor: the full compact tree first, then diffs against its SHA
+        if self.tree_sha:
+            endpoint, query = 'GET /api/tree/<repo>/<branch> (diff)', f'&since={self.tree_sha}'
+        else:
+            endpoint, query = 'GET /api/tree/<repo>/<branch>', ''
+        response = self.call(endpoint, 'GET', f'/api/tree/{self.repo}/{self.branch}?format=compact{query}')
+        if response is not None and response.status_code == 200:
+            self.tree_sha = response.json()['sha']
+
+    def open_file(self, path):
+        response = self.call('POST /api/file', 'POST', '/api/file',
+                             json={'repo': self.repo, 'branch': self.branch, 'filepath': path})
+        if response is not None and response.status_code == 200:
+            data = response.json()
+            self.contents[path] = data.get('content', '')
+            self.shas[path] = data.get('sha')
+            self.current = path
+
+    def autosave_and_compile(self):
+        path = getattr(self, 'current', None)
+        if path is None:
+            return
+        self.edits += 1
+        # Like the editor, save only the edit against the last saved version
+        added = f'\nEdit {self.edits} of {self.branch}: the {self.rng.choice(fixtures.WORDS)} changed.\n'
+        edit = {'offset': len(self.contents[path].encode('utf-16-le')) // 2, 'length': 0, 'text': added}
+        self.contents[path] += added
+        content_sha = git_blob_sha(self.contents[path].encode('utf-8'))
+        target = {'repo': self.repo, 'branch': self.branch, 'filepath': path}
+        response = self.call('POST /api/save', 'POST', '/api/save', ok=(200, 409),
+                             json={**target, 'base_sha': self.shas[path], 'edits': [edit], 'content_sha': content_sha})
+        if response is not None and response.status_code == 409:
+            response = self.call('POST /api/save (full)', 'POST', '/api/save',
+                                 json={**target, 'sha': self.shas[path], 'content': self.contents[path]})
+        if response is not None and response.status_code == 200:
+            self.shas[path] = response.json()['sha']
+
+        # Same requests as the editor's auto-compile: a preview of the open file
+        start = time.monotonic()
+        preview = {'base_sha': self.shas[path], 'edits': [], 'content_sha': content_sha}
+        response = self.call('POST /api/compile/jobs', 'POST', '/api/compile/jobs', ok=(202,),
+                             json={'repo': self.repo, 'branch': self.branch, 'filepath': 'main.tex',
+                                   'autosave': True, 'files': {path: preview}})
+        if response is None or response.status_code != 202:
+            return
+        job = response.json()
+        while job.get('status') not in ('done', 'failed', 'superseded'):
+            time.sleep(self.args.poll)
+            response = self.call('GET /api/compile/jobs/<id>', 'GET', f"/api/compile/jobs/{job['job_id']}")
+            if response is None or response.status_code != 200:
+                break
+            job = response.json()
+        self.recorder.add('compile (queued to PDF)', time.monotonic() - start, ok=job.get('status') == 'done')
+        if job.get('status') == 'done':
+            self.call('GET /api/pdf/<key>', 'GET', job['pdf_url'])
+
+    def browse_history(self):
+        response = self.call('GET /api/commits/<repo>/<branch>', 'GET',
+                             f'/api/commits/{self.repo}/{self.branch}?per_page=1&order=asc')
+        if response is None or response.status_code != 200:
+            return
+        moment = self.rng.randrange(self.info['first'], self.info['last'])
+        iso = datetime.fromtimestamp(moment, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        response = self.call('GET /api/commit-at-time/<repo>/<branch>/<time>', 'GET',
+                             f'/api/commit-at-time/{self.repo}/{self.branch}/{iso}')
+        if response is None or response.status_code != 200:
+            return
+        commit = response.json()['commit']['sha']
+        self.call('GET /api/tree-at-commit/<repo>/<sha>', 'GET', f'/api/tree-at-commit/{self.repo}/{commit}')
+        self.call('POST /api/file-at-commit', 'POST', '/api/file-at-commit',
+                  json={'repo': self.repo, 'commit': commit, 'filepath': self.rng.choice(self.info['sections'])})
+
+
+def session_cookie(secret_key, token):
+    """A session cookie the app accepts as logged in with token, signed like Flask does."""
+    app = Flask('bench')
+    app.secret_key = secret_key
+    return app.session_interface.get_signing_serializer(app).dumps({'oauth_token': token})
+
+
+def start_app(args, work_dir, stub_url, port):
+    env = dict(os.environ,
+               GITHUB_API_URL=stub_url,
+               GITHUB_GIT_URL=stub_url + '/git',
+               SECRET_KEY=args.secret_key,
+               SAVE_FLUSH_INTERVAL=str(args.flush_interval),
+               FAKE_TEX_SECONDS=str(args.tex_seconds))
+    for name in STATE_DIRS:
+        env[name] = os.path.join(work_dir, 'state', name.lower())
+    if args.fake_tex:
+        env['PATH'] = os.path.join(BENCH_DIR, 'fakebin') + os.pathsep + env.get('PATH', '')
+    if args.server == 'gunicorn':
+        cmd = ['gunicorn', '--bind', f'127.0.0.1:{port}', f'--workers={args.workers}', f'--threads={args.threads}',
+               '--timeout', '600', 'flaskapp:app']
+    elif args.server == 'uvicorn':
+        # The async serving mode (asgi_app.py)
+        env.update(HOST='127.0.0.1', PORT=str(port), ASYNC_WORKERS=str(args.workers))
+        cmd = [sys.executable, 'asgi_app.py']
+    else:
+        cmd = [sys.executable, '-c',
+               f'from flaskapp import app; app.run(host="127.0.0.1", port={port}, threaded=True)']
+    log = open(os.path.join(work_dir, 'app.log'), 'wb')
+    process = subprocess.Popen(cmd, cwd=APP_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f'App exited with {process.returncode}, see {log.name}')
+        try:
+            requests.get(f'http://127.0.0.1:{port}/metrics', timeout=1)
+            return process
+        except requests.RequestException:
+            time.sleep(0.2)
+    process.terminate()
+    raise SystemExit(f'App did not start, see {log.name}')
+
+
+def print_report(rows, duration, upstream):
+    header = f"{'endpoint':<48} {'count':>7} {'err':>5} {'req/s':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}"
+    print(header)
+    print('-' * len(header))
+    for row in rows:
+        print(f"{row['endpoint']:<48} {row['count']:>7} {row['errors']:>5} {row['rps']:>7.2f} {row['p50_ms']:>8.1f} "
+              f"{row['p95_ms']:>8.1f} {row['p99_ms']:>8.1f} {row['max_ms']:>8.1f}")
+    total = sum(row['count'] for row in rows if not row['endpoint'].startswith('compile '))
+    print(f'\n{total} requests in {duration:.1f}s ({total / duration:.1f} req/s)')
+    print(f'{sum(upstream.values())} GitHub API calls:')
+    for (method, endpoint), count in sorted(upstream.items(), key=lambda item: -item[1]):
+        print(f'  {count:>7}  {method} {endpoint}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=10, help='simulated editor sessions')
+    parser.add_argument('--duration', type=float, default=60, help='seconds each session runs')
+    parser.add_argument('--warmup', type=float, default=0, help='seconds at the start not counted')
+    parser.add_argument('--interval', type=float, default=2.0, help='seconds between autosave + compile')
+    parser.add_argument('--poll', type=float, default=0.25, help='seconds between compile job polls')
+    parser.add_argument('--history', type=float, default=0.1, help='chance per autosave of browsing the history')
+    parser.add_argument('--size', action='append', choices=sorted(fixtures.SIZES),
+                        help='project sizes, users are spread over them (default: small)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds the stub adds to every API call')
+    parser.add_argument('--fake-tex', action='store_true', help='compile with bench/fakebin instead of TeX')
+    parser.add_argument('--tex-seconds', type=float, default=0.2, help='seconds per fake TeX/pandoc run')
+    parser.add_argument('--flush-interval', type=int, default=10, help='SAVE_FLUSH_INTERVAL for the app')
+    parser.add_argument('--server', choices=('gunicorn', 'uvicorn', 'flask'), default='gunicorn' if shutil.which('gunicorn') else 'flask')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=50)
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--secret-key', default='bench-secret-key')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--keep', action='store_true', help='keep the work directory (repos, caches, app.log)')
+    args = parser.parse_args()
+    sizes = args.size or ['small']
+
+    work_dir = tempfile.mkdtemp(prefix='underleaf-bench-')
+    print(f'Work directory: {work_dir}')
+    process = None
+    try:
+        repos = {}
+        branches = [f'user-{i}' for i in range(args.users)]
+        for size in sizes:
+            started = time.monotonic()
+            path = os.path.join(work_dir, 'repos', 'bench', f'{size}.git')
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            repos[size] = fixtures.make_repo(path, size, args.seed)
+            fixtures.add_branches(path, branches)
+            print(f'Generated {size} project ({len(repos[size]["files"])} files) in {time.monotonic() - started:.1f}s')
+
+        stub = github_stub.serve(os.path.join(work_dir, 'repos'), latency=args.latency)
+        stub_url = f'http://127.0.0.1:{stub.server_address[1]}'
+        process = start_app(args, work_dir, stub_url, args.port)
+        print(f'App ({args.server}) on port {args.port}, GitHub stub on {stub_url}')
+
+        start = time.monotonic()
+        recorder = Recorder(start + args.warmup)
+        deadline = start + args.duration
+        threads = []
+        for i, branch in enumerate(branches):
+            size = sizes[i % len(sizes)]
+            user = Session(f'http://127.0.0.1:{args.port}', session_cookie(args.secret_key, f'bench-token-{i}'),
+                           recorder, f'bench/{size}', branch, repos[size], args, seed=args.seed * 100000 + i)
+            # Stagger the sessions over one interval so autosaves don't arrive in lockstep
+            thread = threading.Thread(target=lambda user=user, delay=i * args.interval / args.users:
+                                      (time.sleep(delay), user.run(deadline)), daemon=True)
+            threads.append(thread)
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duration = time.monotonic() - max(start, recorder.warmup_until)
+
+        rows = recorder.report(duration)
+        upstream = stub.stub.stats()
+        print()
+        print_report(rows, duration, upstream)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({
+                    'config': {k: v for k, v in vars(args).items() if k != 'secret_key'},
+                    'duration': duration,
+                    'endpoints': rows,
+                    'github_calls': [{'method': m, 'endpoint': e, 'count': c} for (m, e), c in upstream.items()],
+                }, f, indent=2)
+    finally:
+        if process:
+            process.terminate()
+            process.wait(30)
+        if args.keep:
+            print(f'Kept {work_dir}')
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def _percentile(samples, percent):
+    # Nearest rank on sorted samples
+    return samples[max(0, min(len(samples) - 1, int(round(percent / 100 * len(samples))) - 1))]
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+import os
+import json
+import hashlib
+import threading
+from array import array
+from bisect import bisect_right
+from datetime import datetime, timezone
+
+from node_files import FileLock, write_atomically
+
+
+class CommitTimeline:
+    """The commits of one branch sorted by author timestamp.
+
+    Timestamps live in an array('q') and SHAs in one bytearray of 20-byte
+    digests, so even long histories stay small and a lookup by time is a
+    binary search. Only the author and the message's first line are kept
+    for listing.
+    """
+
+    def __init__(self, head=None, complete=True):
+        self.head = head
+        self.complete = complete  # False if the history was cut off when it was built
+        self.timestamps = array('q')
+        self.shas = bytearray()
+        self.authors = []  # (name, email)
+        self.subjects = []
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def sha(self, i):
+        return self.shas[20 * i:20 * i + 20].hex()
+
+    def at(self, timestamp):
+        """Index of the newest commit at or before timestamp, or None."""
+        i = bisect_right(self.timestamps, timestamp) - 1
+        return i if i >= 0 else None
+
+    def add(self, commits):
+        """Insert commits given as (timestamp, sha, name, email, subject)."""
+        commits = sorted(commits)
+        if not commits:
+            return
+        if len(self) and commits[0][0] < self.timestamps[-1]:
+            # Back-dated commits - merge into the sorted order
+            commits = sorted(commits + [self._entry(i) for i in range(len(self))])
+            self.timestamps = array('q')
+            self.shas = bytearray()
+            self.authors = []
+            self.subjects = []
+        for timestamp, sha, name, email, subject in commits:
+            self.timestamps.append(timestamp)
+            self.shas += bytes.fromhex(sha)
+            self.authors.append((name, email))
+            self.subjects.append(subject)
+
+    def copy(self):
+        timeline = CommitTimeline(self.head, self.complete)
+        timeline.timestamps = array('q', self.timestamps)
+        timeline.shas = bytearray(self.shas)
+        timeline.authors = list(self.authors)
+        timeline.subjects = list(self.subjects)
+        return timeline
+
+    def _entry(self, i):
+        name, email = self.authors[i]
+        return (self.timestamps[i], self.sha(i), name, email, self.subjects[i])
+
+    def page(self, page, per_page, ascending=False):
+        """Indexes of one page of commits, newest first unless ascending."""
+        start = (page - 1) * per_page
+        if ascending:
+            return range(start, min(start + per_page, len(self)))
+        return range(len(self) - 1 - start, max(len(self) - 1 - start - per_page, -1), -1)
+
+    def commit(self, i):
+        """Commit i in the shape of GitHub's commit listing (the fields the editor uses)."""
+        name, email = self.authors[i]
+        date = datetime.fromtimestamp(self.timestamps[i], timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        return {
+            'sha': self.sha(i),
+            'commit': {
+                'author': {'name': name, 'email': email, 'date': date},
+                'message': self.subjects[i],
+            },
+        }
+
+
+class CommitIndex:
+    """Per-branch commit timelines on local disk, shared by all workers.
+
+    update() extends a timeline from its last known head; the caller decides
+    how to get the new commits (and whether history was rewritten).
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.builds = 0
+        self.extends = 0
+        self._cache = {}  # key -> (mtime, timeline)
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def _key(self, repo, branch):
+        return hashlib.sha256(f'{repo}\0{branch}'.encode('utf-8')).hexdigest()[:32]
+
+    def update(self, repo, branch, head, fetch):
+        """Return the timeline of repo/branch at head.
+
+        fetch(timeline) is called when the stored head differs (timeline is
+        None if there is none yet) and returns (commits, rebuild, complete):
+        the missing commits, whether they replace the timeline (force-push,
+        first build) and whether the history is complete.
+        """
+        timeline = self.current(repo, branch, head)
+        if timeline is not None:
+            return timeline
+
+        key = self._key(repo, branch)
+        lock = self._locked(key)
+        try:
+            # Another worker may have caught up while we waited for the lock
+            timeline = self._load(key)
+            if timeline is not None and timeline.head == head:
+                return timeline
+            commits, rebuild, complete = fetch(timeline)
+            if rebuild or timeline is None:
+                timeline = CommitTimeline()
+                self._count('builds')
+            else:
+                # Other threads may be reading the cached one
+                timeline = timeline.copy()
+                self._count('extends')
+            timeline.add(commits)
+            timeline.head = head
+            timeline.complete = complete
+            self._save(key, timeline)
+            return timeline
+        finally:
+            lock.release()
+
+    def current(self, repo, branch, head):
+        """The stored timeline if it is already at head, else None - never blocks on other workers."""
+        timeline = self._load(self._key(repo, branch))
+        return timeline if timeline is not None and timeline.head == head else None
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def _paths(self, key):
+        return os.path.join(self.root, key + '.json'), os.path.join(self.root, key + '.bin')
+
+    def _load(self, key):
+        meta_path, data_path = self._paths(key)
+        try:
+            mtime = os.path.getmtime(meta_path)
+        except OSError:
+            return None
+        with self._lock:
+            cached = self._cache.get(key)
+        if cached and cached[0] == mtime:
+            return cached[1]
+
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            with open(data_path, 'rb') as f:
+                data = f.read()
+        except (OSError, ValueError):
+            return None
+        count = len(meta['subjects'])
+        # Written data file first, metadata last - a mismatch is a half-written update
+        if len(data) != count * 28:
+            return None
+        timeline = CommitTimeline(meta['head'], meta['complete'])
+        timeline.timestamps.frombytes(data[:count * 8])
+        timeline.shas = bytearray(data[count * 8:])
+        timeline.authors = [tuple(author) for author in meta['authors']]
+        timeline.subjects = meta['subjects']
+        with self._lock:
+            self._cache[key] = (mtime, timeline)
+        return timeline
+
+    def _save(self, key, timeline):
+        meta_path, data_path = self._paths(key)
+        write_atomically(data_path, timeline.timestamps.tobytes() + bytes(timeline.shas))
+        write_atomically(meta_path, json.dumps({
+            'head': timeline.head,
+            'complete': timeline.complete,
+            'authors': timeline.authors,
+            'subjects': timeline.subjects,
+        }).encode('utf-8'))
+        with self._lock:
+            self._cache[key] = (os.path.getmtime(meta_path), timeline)
+
+    def _locked(self, key):
+        lock = FileLock(os.path.join(self.root, key + '.lock'))
+        lock.acquire()
+        return lock
+
+    def stats(self):
+        with self._lock:
+            return {
+                'branches': len(self._cache),
+                'commits': sum(len(timeline) for mtime, timeline in self._cache.values()),
+                'builds': self.builds,
+                'extends': self.extends,
+            }
@@ -0,0 +1,89 @@
+import os
+import json
+import time
+import uuid
+
+from node_files import write_atomically
+
+LOG_TAIL_CHARS = 4000
+
+
+class JobStore:
+    """Compile job state on local disk so any gunicorn worker can answer a poll.
+
+    Each job points at a build record; deduplicated jobs share one build and
+    therefore see the same phase and log tail.
+    """
+
+    def __init__(self, root, ttl_seconds=3600):
+        self.root = root
+        self.ttl_seconds = ttl_seconds
+        os.makedirs(os.path.join(root, 'jobs'), exist_ok=True)
+        os.makedirs(os.path.join(root, 'builds'), exist_ok=True)
+
+    def _path(self, kind, name):
+        # Ids come from URLs - keep them to a single path component
+        return os.path.join(self.root, kind, os.path.basename(name) + '.json')
+
+    def _read(self, kind, name):
+        try:
+            with open(self._path(kind, name)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, kind, name, record):
+        write_atomically(self._path(kind, name), json.dumps(record).encode('utf-8'))
+
+    def create(self, user, build_id):
+        self._expire()
+        job_id = uuid.uuid4().hex
+        self._write('jobs', job_id, {
+            'job_id': job_id,
+            'user': user,
+            'build': build_id,
+            'status': 'queued',
+            'created_at': time.time(),
+        })
+        return job_id
+
+    def update(self, job_id, **fields):
+        record = self._read('jobs', job_id) or {'job_id': job_id}
+        record.update(fields)
+        record['updated_at'] = time.time()
+        self._write('jobs', job_id, record)
+
+    def progress(self, build_id, phase, log=None):
+        # 'fetching' starts a new run of the build - forget the last run's log
+        record = {} if phase == 'fetching' else self._read('builds', build_id) or {}
+        record['phase'] = phase
+        if log is not None:
+            record['log_tail'] = log[-LOG_TAIL_CHARS:]
+        record['updated_at'] = time.time()
+        self._write('builds', build_id, record)
+
+    def get(self, job_id):
+        job = self._read('jobs', job_id)
+        if job is None:
+            return None
+        build = self._read('builds', job['build']) or {}
+        job.setdefault('phase', 'queued')
+        job.setdefault('log_tail', '')
+        # A finished build record belongs to an earlier run of the same inputs
+        if job['status'] in ('queued', 'running') and build.get('phase') not in (None, 'done'):
+            job['phase'] = build['phase']
+            job['log_tail'] = build.get('log_tail', '')
+            job['status'] = 'running'
+        return job
+
+    def _expire(self):
+        cutoff = time.time() - self.ttl_seconds
+        for kind in ('jobs', 'builds'):
+            directory = os.path.join(self.root, kind)
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                try:
+                    if os.path.getmtime(path) < cutoff:
+                        os.remove(path)
+                except OSError:
+                    pass
@@ -0,0 +1,321 @@
+import os
+import time
+import select
+import hashlib
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+import metrics
+from node_files import FileLock, remove
+
+try:
+    import fcntl
+except ImportError:  # Windows - no cross-process queue
+    fcntl = None
+
+# A holder killed mid-build never hands its slot on; waiters check for that this often
+RECHECK_SECONDS = 1.0
+
+
+class _Job:
+    def __init__(self, user, key, fn, supersede_key):
+        self.user = user
+        self.key = key
+        self.fn = fn
+        self.supersede_key = supersede_key
+        self.future = Future()
+        self.enqueued_at = time.monotonic()
+        # The submitting request's trace gets the job's spans
+        self.trace = metrics.current_trace()
+
+
+class NodeSlots:
+    """Cross-process semaphore with a node-wide, per-user fair queue.
+
+    Every gunicorn worker has its own scheduler, so the TeX concurrency cap
+    for the whole box is enforced here rather than by the thread count.
+    A waiter is a FIFO in waiting/ named after its arrival time and user,
+    flock'ed by its owner for as long as it lives. Whoever changes the
+    queue - a new waiter or a released slot - hands free slots out under
+    queue.lock: to the user holding the fewest slots, oldest ticket first,
+    by moving the ticket to running/ and writing a byte to its FIFO, which
+    its owner is blocked reading. A ticket whose flock can be taken belongs
+    to a dead process and is dropped.
+    """
+
+    def __init__(self, root, count):
+        self.root = root
+        self.count = count
+        self.waiting = os.path.join(root, 'waiting')
+        self.running = os.path.join(root, 'running')
+        self._semaphore = None if fcntl else threading.BoundedSemaphore(count)
+        os.makedirs(self.waiting, exist_ok=True)
+        os.makedirs(self.running, exist_ok=True)
+
+    def acquire(self, user=None):
+        if self._semaphore:
+            self._semaphore.acquire()
+            return True
+        name = f'{time.time_ns():020d}-{_user_tag(user)}-{os.getpid()}-{threading.get_ident()}'
+        ticket = _Ticket(name, os.path.join(self.waiting, '.' + name))
+        try:
+            # Dot names are skipped by the queue until the flock is in place
+            os.rename(ticket.path, os.path.join(self.waiting, name))
+            self._dispatch()
+            while not select.select([ticket.fd], [], [], RECHECK_SECONDS)[0]:
+                self._dispatch()
+            os.read(ticket.fd, 1)
+        except BaseException:
+            self.release(ticket)
+            raise
+        return ticket
+
+    def release(self, slot):
+        if self._semaphore:
+            self._semaphore.release()
+            return
+        if slot:
+            remove(os.path.join(self.running, slot.name))
+            remove(os.path.join(self.waiting, slot.name))
+            slot.close()
+            self._dispatch()
+
+    def _dispatch(self):
+        with FileLock(os.path.join(self.root, 'queue.lock')):
+            running = self._live(self.running)
+            waiting = self._live(self.waiting)
+            while waiting and len(running) < self.count:
+                users = {}
+                for name in running:
+                    users[_ticket_user(name)] = users.get(_ticket_user(name), 0) + 1
+                name = min(waiting, key=lambda name: (users.get(_ticket_user(name), 0), name))
+                waiting.remove(name)
+                path = os.path.join(self.running, name)
+                try:
+                    os.rename(os.path.join(self.waiting, name), path)
+                except OSError:
+                    continue
+                if _wake(path):
+                    running.append(name)
+                else:
+                    remove(path)
+
+    def _live(self, directory):
+        # Tickets whose owner is still there, i.e. still holds their flock
+        names = []
+        for name in os.listdir(directory):
+            if name.startswith('.'):
+                continue
+            path = os.path.join(directory, name)
+            try:
+                fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+            except OSError:
+                continue
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                names.append(name)
+            else:
+                remove(path)
+            finally:
+                os.close(fd)
+        return names
+
+    def stats(self):
+        if self._semaphore:
+            return {'node_slots': self.count}
+        running = _listdir(self.running)
+        waiting = _listdir(self.waiting)
+        now = time.time_ns()
+        return {
+            'node_slots': self.count,
+            'node_running': len(running),
+            'node_queue_depth': len(waiting),
+            'node_queued_users': len({_ticket_user(name) for name in waiting}),
+            'node_oldest_wait_seconds': max((now - int(name.split('-')[0])) / 1e9 for name in waiting) if waiting else 0.0,
+        }
+
+
+class _Ticket:
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        os.mkfifo(path)
+        self.fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+        # Our own writer end keeps the FIFO from reading as closed before the wake-up
+        self._writer = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+
+    def close(self):
+        remove(self.path)
+        os.close(self._writer)
+        os.close(self.fd)
+
+
+def _wake(path):
+    # False if the owner is gone
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+    except OSError:
+        return False
+    try:
+        os.write(fd, b'\0')
+    finally:
+        os.close(fd)
+    return True
+
+
+def _user_tag(user):
+    return hashlib.sha256(str(user).encode('utf-8')).hexdigest()[:16]
+
+
+def _ticket_user(name):
+    return name.split('-')[1]
+
+
+def _listdir(directory):
+    return [name for name in os.listdir(directory) if not name.startswith('.')]
+
+
+class CompileScheduler:
+    """Bounded compile queue with per-user round-robin, dedup and supersede.
+
+    - jobs with the same key (same inputs) share one build and one result
+    - a queued job is replaced by a newer one with the same supersede_key
+      (autosave of the same file); its waiters receive the newer result
+    - users are served round-robin so one busy user can't starve the rest
+
+    Jobs take a node slot with slot() only around the build itself, so a
+    job waiting for another worker to finish the same build holds none.
+    """
+
+    def __init__(self, max_workers, slots=None):
+        self.max_workers = max_workers
+        self.slots = slots
+        self._cond = threading.Condition()
+        self._queues = OrderedDict()  # user -> deque of queued jobs, in round-robin order
+        self._by_key = {}             # key -> queued or running job
+        self._by_supersede = {}       # supersede_key -> queued job
+        self._running = 0
+        self.submitted = 0
+        self.deduplicated = 0
+        self.superseded = 0
+        self.completed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        for i in range(max_workers):
+            threading.Thread(target=self._worker, name=f'compile-{i}', daemon=True).start()
+
+    def submit(self, user, key, fn, supersede_key=None):
+        """Queue fn() and return a Future for its result."""
+        with self._cond:
+            self.submitted += 1
+            existing = self._by_key.get(key)
+            if existing:
+                self.deduplicated += 1
+                return existing.future
+
+            job = _Job(user, key, fn, supersede_key)
+
+            if supersede_key is not None:
+                stale = self._by_supersede.pop(supersede_key, None)
+                if stale:
+                    self._remove_queued(stale)
+                    self.superseded += 1
+                    _chain(job.future, stale.future)
+                self._by_supersede[supersede_key] = job
+
+            self._by_key[key] = job
+            self._queues.setdefault(user, deque()).append(job)
+            self._cond.notify()
+            return job.future
+
+    def _remove_queued(self, job):
+        queue = self._queues.get(job.user)
+        if queue is not None:
+            queue.remove(job)
+            if not queue:
+                del self._queues[job.user]
+        if self._by_key.get(job.key) is job:
+            del self._by_key[job.key]
+
+    def _next_job(self):
+        # Take the head of the first user's queue, then move that user to the back
+        user, queue = next(iter(self._queues.items()))
+        job = queue.popleft()
+        del self._queues[user]
+        if queue:
+            self._queues[user] = queue
+        if job.supersede_key is not None and self._by_supersede.get(job.supersede_key) is job:
+            del self._by_supersede[job.supersede_key]
+        return job
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._queues:
+                    self._cond.wait()
+                job = self._next_job()
+                self._running += 1
+
+            wait = time.monotonic() - job.enqueued_at
+            try:
+                with metrics.continue_trace(job.trace):
+                    metrics.record('compile_phase', wait, phase='queue', outcome='ok')
+                    result = job.fn()
+            except BaseException as e:
+                job.future.set_exception(e)
+            else:
+                job.future.set_result(result)
+            finally:
+                with self._cond:
+                    self._running -= 1
+                    self.completed += 1
+                    self.total_wait += wait
+                    self.max_wait = max(self.max_wait, wait)
+                    if self._by_key.get(job.key) is job:
+                        del self._by_key[job.key]
+
+    @contextmanager
+    def slot(self, user=None):
+        """Hold one of the node-wide slots for the duration of the block; user takes its turn in the node's queue."""
+        started = time.monotonic()
+        slot = self.slots.acquire(user) if self.slots else None
+        metrics.record('compile_phase', time.monotonic() - started, phase='slot', outcome='ok')
+        try:
+            yield
+        finally:
+            if self.slots:
+                self.slots.release(slot)
+
+    def stats(self):
+        with self._cond:
+            now = time.monotonic()
+            queued = [job for queue in self._queues.values() for job in queue]
+            return {
+                'max_workers': self.max_workers,
+                'queue_depth': len(queued),
+                'queued_users': len(self._queues),
+                'running': self._running,
+                'oldest_wait_seconds': max((now - job.enqueued_at for job in queued), default=0.0),
+                'avg_wait_seconds': self.total_wait / self.completed if self.completed else 0.0,
+                'max_wait_seconds': self.max_wait,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'deduplicated': self.deduplicated,
+                'superseded': self.superseded,
+                # The queue above is this worker's; node is every worker's
+                'node': self.slots.stats() if self.slots else None,
+            }
+
+
+def _chain(source, target):
+    # Resolve target with whatever source ends up with
+    def copy(done):
+        if done.exception() is not None:
+            target.set_exception(done.exception())
+        else:
+            target.set_result(done.result())
+    source.add_done_callback(copy)
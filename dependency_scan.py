@@ -0,0 +1,125 @@
+import os
+import re
+
+from latex_build import build_dir_for
+
+INPUT_PATTERN = re.compile(
+    r'\\(input|include|subfile|InputIfFileExists|lstinputlisting|verbatiminput|includepdf|includegraphics'
+    r'|bibliography|addbibresource)\*?\s*(?:\[[^\]]*\]\s*)*\{([^}]*)\}'
+)
+GRAPHICSPATH_PATTERN = re.compile(r'\\graphicspath\s*\{((?:\s*\{[^}]*\})*)\s*\}')
+COMMENT_PATTERN = re.compile(r'(?<!\\)%.*')
+MISSING_PATTERNS = [
+    re.compile(r"! LaTeX Error: File `([^']+)' not found"),
+    re.compile(r"! I can't find file `([^']+)'"),
+    re.compile(r"Error: File `([^']+)' not found"),
+    re.compile(r"I couldn't open (?:database|style) file (\S+)"),
+]
+
+GRAPHICS_EXTENSIONS = ('', '.pdf', '.png', '.jpg', '.jpeg', '.eps', '.PNG', '.JPG', '.JPEG', '.PDF')
+# Small files TeX may pull in by name without an \input - always checked out
+SUPPORT_EXTENSIONS = ('.sty', '.cls', '.clo', '.cfg', '.def', '.bst', '.bbx', '.cbx', '.lbx', '.bib', '.ist',
+                      'latexmkrc')
+SOURCE_EXTENSIONS = ('.tex', '.ltx', '.sty', '.cls')
+
+
+class Dependencies:
+    """The files of a checkout one LaTeX main file needs.
+
+    Called with (workspace, tree_paths) it returns the repository paths
+    needed so far: the main file, style/bibliography files, whatever the
+    checked out sources \\input, \\include or \\includegraphics, everything the
+    last build recorded in its .fls, and files added by add_missing().
+    """
+
+    def __init__(self, main, extra=()):
+        self.main = main
+        self.main_dir = os.path.dirname(main)
+        self.extra = set(extra)
+
+    def __call__(self, workspace, tree_paths):
+        needed = {self.main} | (self.extra & tree_paths)
+        needed |= {path for path in tree_paths if path.endswith(SUPPORT_EXTENSIONS)}
+        needed |= self._recorded(workspace, tree_paths)
+        # Follow the sources already checked out; the rest are read next round
+        pending = list(needed)
+        while pending:
+            path = pending.pop()
+            if not path.endswith(SOURCE_EXTENSIONS):
+                continue
+            try:
+                with open(os.path.join(workspace, path), encoding='utf-8', errors='replace') as f:
+                    source = f.read()
+            except OSError:
+                continue
+            for referenced in self._referenced(source, tree_paths) - needed:
+                needed.add(referenced)
+                pending.append(referenced)
+        return needed
+
+    def add_missing(self, log, workspace, tree_paths):
+        """Add the inputs a TeX/BibTeX log reports as not found.
+
+        Returns True if any of them is in the tree but not checked out yet.
+        """
+        added = False
+        for pattern in MISSING_PATTERNS:
+            for name in pattern.findall(log or ''):
+                path = self._resolve(name, ('', '.tex') + GRAPHICS_EXTENSIONS, tree_paths)
+                if path and not os.path.exists(os.path.join(workspace, path)):
+                    self.extra.add(path)
+                    added = True
+        return added
+
+    def _referenced(self, source, tree_paths):
+        source = COMMENT_PATTERN.sub('', source)
+        prefixes = ['']
+        for group in GRAPHICSPATH_PATTERN.findall(source):
+            prefixes += re.findall(r'\{([^}]*)\}', group)
+
+        paths = set()
+        for command, argument in INPUT_PATTERN.findall(source):
+            for name in argument.split(',') if command == 'bibliography' else [argument]:
+                name = name.strip()
+                if not name:
+                    continue
+                if command == 'includegraphics':
+                    candidates = [(prefix + name, GRAPHICS_EXTENSIONS) for prefix in prefixes]
+                elif command == 'bibliography':
+                    candidates = [(name, ('.bib', ''))]
+                else:
+                    candidates = [(name, ('', '.tex'))]
+                for name, extensions in candidates:
+                    path = self._resolve(name, extensions, tree_paths)
+                    if path:
+                        paths.add(path)
+                        break
+        return paths
+
+    def _recorded(self, workspace, tree_paths):
+        # TeX records project files relative to its working directory
+        paths = set()
+        build_dir = build_dir_for(workspace, self.main)
+        try:
+            names = [name for name in os.listdir(build_dir) if name.endswith('.fls')]
+        except OSError:
+            return paths
+        for name in names:
+            try:
+                with open(os.path.join(build_dir, name), encoding='utf-8', errors='replace') as f:
+                    lines = f.read().splitlines()
+            except OSError:
+                continue
+            for line in lines:
+                if line.startswith('INPUT ') and not os.path.isabs(line[6:]):
+                    path = self._resolve(line[6:], ('',), tree_paths)
+                    if path:
+                        paths.add(path)
+        return paths
+
+    def _resolve(self, name, extensions, tree_paths):
+        for extension in extensions:
+            path = os.path.normpath(os.path.join(self.main_dir, name + extension)).replace(os.sep, '/')
+            if path in tree_paths:
+                return path
+        return None
@@ -1,14 +1,39 @@
 import os
+import re
 import tempfile
 import shutil
 import subprocess
 from datetime import datetime
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for
+from contextlib import nullcontext
+from flask import Flask, render_template, request, jsonify, session, redirect, url_for, send_file, Response, stream_with_context, g
 from requests_oauthlib import OAuth2Session
-import requests
 import base64
 import zipfile
 import io
+import hashlib
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from workspace_cache import WorkspaceCache
+from latex_build import build_latex, build_dir_for
+from governor import Governor
+from format_cache import FormatCache
+from package_manager import PackageManager, scan_packages, scan_directory
+from dependency_scan import Dependencies
+from commit_index import CommitIndex
+import metrics
+from pdf_cache import PdfCache, pdf_cache_key
+from pdf_pages import PageRenderer, changed_pages
+from compile_scheduler import CompileScheduler, NodeSlots
+from compile_jobs import JobStore
+from github_client import GitHubClient
+from github_reads import Get, Fill, Call, run
+from object_cache import ObjectCache
+from shared_cache import SharedCache
+from save_buffer import SaveBuffer, SaveConflict, git_blob_sha
+from text_delta import apply_edits, DeltaError
+from compression import choose_encoding, compressible, compress
+from raw_files import RAW_MEDIA_TYPE, SNIFF_BYTES, CHUNK_BYTES, looks_like_text, content_type, raw_url, file_payload, base64_json_body
 
 # Allow OAuth over HTTP for local development (REMOVE IN PRODUCTION)
 os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
@@ -44,6 +69,173 @@ AUTHORIZATION_BASE_URL = 'https://github.com/login/oauth/authorize'
 TOKEN_URL = 'https://github.com/login/oauth/access_token'
 REDIRECT_URI  = os.environ.get('REDIRECT_URI', 'https://cryptane-underleaf.hf.space/callback')
 
+# One pooled keep-alive client with an ETag cache for every GitHub API call;
+# the cache holds at most GITHUB_CACHE_MAX_BYTES of responses per worker
+GITHUB_API_URL = os.environ.get('GITHUB_API_URL', 'https://api.github.com')
+GITHUB_CACHE_MAX_BYTES = int(os.environ.get('GITHUB_CACHE_MAX_BYTES', 32 * 1024 ** 2))
+github = GitHubClient(GITHUB_API_URL, cache_max_bytes=GITHUB_CACHE_MAX_BYTES)
+# Where compiles clone from; a local git server in benchmarks
+GITHUB_GIT_URL = os.environ.get('GITHUB_GIT_URL', 'https://github.com').rstrip('/')
+
+# Node-wide cache tier (SQLite on local disk) shared by all gunicorn workers:
+# git objects, branch heads and repo access checks, filled by one worker at a time
+SHARED_CACHE_DIR = os.environ.get('SHARED_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'underleaf-cache'))
+SHARED_CACHE_MAX_BYTES = int(os.environ.get('SHARED_CACHE_MAX_BYTES', 2 * 1024 ** 3))
+shared_cache = SharedCache(SHARED_CACHE_DIR, SHARED_CACHE_MAX_BYTES)
+
+# Immutable git objects (trees, blobs, commit->tree links) cached by SHA,
+# in memory in front of the shared tier
+OBJECT_CACHE_MAX_BYTES = int(os.environ.get('OBJECT_CACHE_MAX_BYTES', 64 * 1024 ** 2))
+objects = ObjectCache(OBJECT_CACHE_MAX_BYTES, shared_cache)
+
+# Files bigger than this are sniffed through GitHub's raw media type before
+# being read whole; binaries are then served by URL from /api/raw
+FILE_INLINE_MAX_BYTES = int(os.environ.get('FILE_INLINE_MAX_BYTES', 1024 ** 2))
+COMMIT_SHA_PATTERN = re.compile(r'[0-9a-f]{40}')
+
+# How long a successful repo access check is trusted before asking GitHub again
+REPO_ACCESS_TTL = int(os.environ.get('REPO_ACCESS_TTL', 300))
+# How long a branch head is served without asking GitHub; the app's own
+# commits update it right away, pushes from elsewhere show up within this
+REF_CACHE_TTL = int(os.environ.get('REF_CACHE_TTL', 10))
+
+# Concurrent blob uploads for multi-file commits
+BLOB_UPLOAD_WORKERS = int(os.environ.get('BLOB_UPLOAD_WORKERS', 8))
+blob_uploads = ThreadPoolExecutor(BLOB_UPLOAD_WORKERS, thread_name_prefix='blob-upload')
+
+# Persistent working copies reused across compiles instead of a fresh clone
+WORKSPACE_CACHE_DIR = os.environ.get('WORKSPACE_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'underleaf-workspaces'))
+WORKSPACE_CACHE_MAX_BYTES = int(os.environ.get('WORKSPACE_CACHE_MAX_BYTES', 5 * 1024 ** 3))
+workspaces = WorkspaceCache(WORKSPACE_CACHE_DIR, WORKSPACE_CACHE_MAX_BYTES)
+
+# Compiled PDFs addressed by (main file, compiler, tree/commit SHA of the inputs)
+PDF_CACHE_DIR = os.environ.get('PDF_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'underleaf-pdfs'))
+PDF_CACHE_MAX_BYTES = int(os.environ.get('PDF_CACHE_MAX_BYTES', 1024 ** 3))
+compiled_pdfs = PdfCache(PDF_CACHE_DIR, PDF_CACHE_MAX_BYTES)
+
+# Limits on the TeX, BibTeX and pandoc processes of one compile; CPU and
+# wall-clock time are budgets for the whole compile. 0 disables a limit.
+# Per-compile usage goes to COMPILE_USAGE_LOG_PATH as JSON lines if set
+COMPILE_CPU_SECONDS = int(os.environ.get('COMPILE_CPU_SECONDS', 120))
+COMPILE_MEMORY_BYTES = int(os.environ.get('COMPILE_MEMORY_BYTES', 2 * 1024 ** 3))
+COMPILE_OUTPUT_BYTES = int(os.environ.get('COMPILE_OUTPUT_BYTES', 512 * 1024 ** 2))
+COMPILE_MAX_PROCESSES = int(os.environ.get('COMPILE_MAX_PROCESSES', 32))
+COMPILE_WALL_SECONDS = int(os.environ.get('COMPILE_WALL_SECONDS', 300))
+COMPILE_USAGE_LOG_PATH = os.environ.get('COMPILE_USAGE_LOG_PATH')
+governor = Governor(COMPILE_CPU_SECONDS or None, COMPILE_MEMORY_BYTES or None, COMPILE_OUTPUT_BYTES or None,
+                    COMPILE_MAX_PROCESSES or None, COMPILE_WALL_SECONDS or None, usage_log=COMPILE_USAGE_LOG_PATH)
+
+# Precompiled preambles (.fmt) so passes skip re-reading packages; set
+# FORMAT_CACHE_ENABLED=0 to always compile from scratch
+FORMAT_CACHE_ENABLED = os.environ.get('FORMAT_CACHE_ENABLED', '1') != '0'
+FORMAT_CACHE_DIR = os.environ.get('FORMAT_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'underleaf-formats'))
+FORMAT_CACHE_MAX_BYTES = int(os.environ.get('FORMAT_CACHE_MAX_BYTES', 2 * 1024 ** 3))
+formats = FormatCache(FORMAT_CACHE_DIR, FORMAT_CACHE_MAX_BYTES, governor) if FORMAT_CACHE_ENABLED else None
+
+# TeX packages a project needs are installed when it is opened rather than
+# mid-compile; MIKTEX_REPOSITORY points at a local mirror for offline installs.
+# Installs taking longer than PACKAGE_INSTALL_TIMEOUT seconds are given up on
+PACKAGE_STATE_DIR = os.environ.get('PACKAGE_STATE_DIR', os.path.join(tempfile.gettempdir(), 'underleaf-packages'))
+MIKTEX_REPOSITORY = os.environ.get('MIKTEX_REPOSITORY')
+PACKAGE_SCAN_MAX_FILES = int(os.environ.get('PACKAGE_SCAN_MAX_FILES', 50))
+PACKAGE_INSTALL_TIMEOUT = int(os.environ.get('PACKAGE_INSTALL_TIMEOUT', 120))
+packages = PackageManager(PACKAGE_STATE_DIR, MIKTEX_REPOSITORY, PACKAGE_INSTALL_TIMEOUT)
+packages.configure()
+package_scans = ThreadPoolExecutor(2, thread_name_prefix='package-scan')
+_scanned_trees = set()
+
+# At most COMPILE_MAX_CONCURRENCY TeX builds at once across all gunicorn workers on the node
+COMPILE_MAX_CONCURRENCY = int(os.environ.get('COMPILE_MAX_CONCURRENCY', os.cpu_count() or 2))
+COMPILE_SLOTS_DIR = os.environ.get('COMPILE_SLOTS_DIR', os.path.join(tempfile.gettempdir(), 'underleaf-compile-slots'))
+compile_scheduler = CompileScheduler(COMPILE_MAX_CONCURRENCY, NodeSlots(COMPILE_SLOTS_DIR, COMPILE_MAX_CONCURRENCY))
+
+# Page images of compiled PDFs for the paged preview, shared between builds by
+# content hash; Ghostscript takes a compile slot and runs under the compile limits
+PAGE_CACHE_DIR = os.environ.get('PAGE_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'underleaf-pages'))
+PAGE_CACHE_MAX_BYTES = int(os.environ.get('PAGE_CACHE_MAX_BYTES', 1024 ** 3))
+PREVIEW_PAGE_DPI = int(os.environ.get('PREVIEW_PAGE_DPI', 110))
+page_images = PageRenderer(PAGE_CACHE_DIR, PAGE_CACHE_MAX_BYTES, PREVIEW_PAGE_DPI, governor, compile_scheduler.slot)
+
+# Asynchronous compile job state, shared by all workers through local disk
+COMPILE_JOBS_DIR = os.environ.get('COMPILE_JOBS_DIR', os.path.join(tempfile.gettempdir(), 'underleaf-jobs'))
+compile_jobs = JobStore(COMPILE_JOBS_DIR)
+
+# Requests slower than this many seconds get their spans (GitHub calls,
+# compile phases) written to TRACE_LOG_PATH, or stdout; unset to disable
+SLOW_REQUEST_SECONDS = float(os.environ['SLOW_REQUEST_SECONDS']) if os.environ.get('SLOW_REQUEST_SECONDS') else None
+TRACE_LOG_PATH = os.environ.get('TRACE_LOG_PATH')
+
+# JSON and text responses at least this big are sent gzip or brotli compressed
+RESPONSE_COMPRESSION_MIN_BYTES = int(os.environ.get('RESPONSE_COMPRESSION_MIN_BYTES', 1024))
+
+# Write-behind buffer for /api/save: autosaves are acknowledged from local disk
+# and squashed into one commit every SAVE_FLUSH_INTERVAL seconds. Acknowledged
+# saves live only in SAVE_BUFFER_DIR until then, so the buffer is off unless
+# that is set - point it at a persistent volume, not the container's /tmp
+SAVE_BUFFER_DIR = os.environ.get('SAVE_BUFFER_DIR')
+SAVE_BUFFER_ENABLED = bool(SAVE_BUFFER_DIR) and os.environ.get('SAVE_BUFFER_ENABLED', '1') == '1'
+SAVE_FLUSH_INTERVAL = int(os.environ.get('SAVE_FLUSH_INTERVAL', 60))
+
+# Per-branch commit timelines for history lookups, extended from the last known head
+COMMIT_INDEX_DIR = os.environ.get('COMMIT_INDEX_DIR', os.path.join(tempfile.gettempdir(), 'underleaf-commits'))
+COMMIT_INDEX_MAX_PAGES = int(os.environ.get('COMMIT_INDEX_MAX_PAGES', 100))
+commit_index = CommitIndex(COMMIT_INDEX_DIR)
+
+@app.before_request
+def _start_request_timer():
+    g.request_started = time.monotonic()
+    if SLOW_REQUEST_SECONDS is not None:
+        metrics.start_trace()
+
+@app.after_request
+def _record_request(response):
+    elapsed = time.monotonic() - g.request_started
+    trace = metrics.finish_trace()
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.record('http_request', elapsed, route=route, method=request.method, status=response.status_code)
+    if trace is not None and elapsed >= SLOW_REQUEST_SECONDS:
+        _log_trace({
+            'time': datetime.utcnow().isoformat() + 'Z',
+            'method': request.method,
+            'path': request.path,
+            'route': route,
+            'status': response.status_code,
+            'seconds': round(elapsed, 4),
+            'spans': trace,
+        })
+    return response
+
+def _log_trace(entry):
+    line = json.dumps(entry)
+    if TRACE_LOG_PATH:
+        with open(TRACE_LOG_PATH, 'a') as f:
+            f.write(line + '\n')
+    else:
+        print(f'Slow request: {line}')
+
+@app.after_request
+def _compress_response(response):
+    # Files (PDFs, pages, raw downloads) are passed through or streamed and left alone
+    if (response.direct_passthrough or response.is_streamed or 'Content-Encoding' in response.headers
+            or response.status_code in (204, 206, 304) or not compressible(response.content_type)):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = choose_encoding(request.headers.get('Accept-Encoding'))
+    if encoding is None or response.content_length is None or response.content_length < RESPONSE_COMPRESSION_MIN_BYTES:
+        return response
+    response.set_data(compress(response.get_data(), encoding))
+    response.headers['Content-Encoding'] = encoding
+    # A strong ETag names the uncompressed bytes
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+@app.route('/metrics')
+def prometheus_metrics():
+    # Histograms of all workers on this node in Prometheus' text format
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/')
 def index():
     if 'oauth_token' not in session:
@@ -79,7 +271,7 @@ def get_user():
         return jsonify({'error': 'Not authenticated'}), 401
     
     headers = {'Authorization': f"token {session['oauth_token']}"}
-    response = requests.get('https://api.github.com/user', headers=headers)
+    response = github.get('https://api.github.com/user', headers=headers)
     return jsonify(response.json())
 
 @app.route('/api/repos')
@@ -87,20 +279,30 @@ def get_repos():
     if 'oauth_token' not in session:
         return jsonify({'error': 'Not authenticated'}), 401
     
-    page = request.args.get('page', 1, type=int)
-    per_page = request.args.get('per_page', 100, type=int)
+    paging = _page_args(request.args, per_page=100)
+    if paging is None:
+        return jsonify({'error': 'page and per_page must be integers'}), 400
+    page, per_page = paging
     
     headers = {'Authorization': f"token {session['oauth_token']}"}
-    response = requests.get(f'https://api.github.com/user/repos?per_page={per_page}&page={page}&sort=updated', headers=headers)
+    response = github.get(f'https://api.github.com/user/repos?per_page={per_page}&page={page}&sort=updated', headers=headers)
     return jsonify(response.json())
 
+def _page_args(args, per_page=50):
+    """(page, per_page) from the query string, per_page at most 100; None if either isn't an integer."""
+    page_arg = args.get('page', type=int)
+    per_page_arg = args.get('per_page', type=int)
+    if (page_arg is None and 'page' in args) or (per_page_arg is None and 'per_page' in args):
+        return None
+    return max(page_arg or 1, 1), min(per_page_arg or per_page, 100)
+
 @app.route('/api/branches/<path:repo>')
 def get_branches(repo):
     if 'oauth_token' not in session:
         return jsonify({'error': 'Not authenticated'}), 401
     
     headers = {'Authorization': f"token {session['oauth_token']}"}
-    response = requests.get(f'https://api.github.com/repos/{repo}/branches', headers=headers)
+    response = github.get(f'https://api.github.com/repos/{repo}/branches', headers=headers)
     
     branches = response.json()
     
@@ -119,7 +321,7 @@ Visit [underleaf.pages.dev](https://underleaf.pages.dev) to start using it.
             '''
             readme_content = base64.b64encode(content_txt.encode()).decode('utf-8')
             
-            create_response = requests.put(
+            create_response = github.put(
                 f'https://api.github.com/repos/{repo}/contents/README.md',
                 headers=headers,
                 json={
@@ -130,6 +332,7 @@ Visit [underleaf.pages.dev](https://underleaf.pages.dev) to start using it.
             )
             
             if create_response.status_code == 201:
+                _ref_changed(repo, 'main', create_response.json()['commit']['sha'])
                 # Return the newly created main branch
                 return jsonify([{'name': 'main'}])
         except Exception as e:
@@ -137,23 +340,269 @@ Visit [underleaf.pages.dev](https://underleaf.pages.dev) to start using it.
     
     return jsonify(branches)
 
+def _repo_access(repo, headers):
+    """b'push' or b'pull' for what this token may do in repo, None if it can't see it; cached for REPO_ACCESS_TTL."""
+    return run(_repo_access_steps(repo, headers), github)
+
+def _repo_access_steps(repo, headers):
+    def check():
+        response = yield Get(f'https://api.github.com/repos/{repo}', headers)
+        if response.status_code != 200:
+            return None
+        return b'push' if response.json().get('permissions', {}).get('push') else b'pull'
+    
+    key = f"permission:{hashlib.sha256(headers['Authorization'].encode('utf-8')).hexdigest()}:{repo}"
+    return (yield Fill(shared_cache, (key,), check, {'ttl': REPO_ACCESS_TTL}))
+
+def _can_read(repo, headers):
+    # Cached objects skip GitHub entirely, so make sure this token can see the repo
+    return _repo_access(repo, headers) is not None
+
+def _can_push(repo, headers):
+    # Buffered saves are committed later with the token of whoever saved or
+    # flushed last, so only tokens that may push get to touch the buffer
+    return _repo_access(repo, headers) == b'push'
+
+def _branch_sha(repo, branch, headers):
+    """Head commit SHA of branch, shared by all workers for REF_CACHE_TTL seconds; None if it can't be read."""
+    return run(_branch_sha_steps(repo, branch, headers), github)
+
+def _branch_sha_steps(repo, branch, headers):
+    # A cached head says nothing about this token's access
+    if (yield from _repo_access_steps(repo, headers)) is None:
+        return None
+    
+    def fetch():
+        response = yield Get(f'https://api.github.com/repos/{repo}/git/ref/heads/{branch}', headers)
+        return response.json()['object']['sha'].encode() if response.status_code == 200 else None
+    
+    head = yield Fill(shared_cache, (_ref_key(repo, branch),), fetch, {'ttl': REF_CACHE_TTL})
+    return head.decode() if head else None
+
+def _ref_key(repo, branch):
+    return f'ref:{repo}:{branch}'
+
+def _ref_changed(repo, branch, head=None):
+    # The app moved branch itself: remember the new head, or forget the old one
+    if head:
+        shared_cache.put(_ref_key(repo, branch), head.encode(), ttl=REF_CACHE_TTL)
+    else:
+        shared_cache.delete(_ref_key(repo, branch))
+
+def _commit_tree_sha(repo, commit_sha, headers):
+    return run(_commit_tree_sha_steps(repo, commit_sha, headers), github)
+
+def _commit_tree_sha_steps(repo, commit_sha, headers):
+    # Cached objects skip GitHub, so the token must be able to see the repo they were stored under
+    if (yield from _repo_access_steps(repo, headers)) is None:
+        return None
+    resolved = []
+    
+    def fetch():
+        commit_response = yield Get(f'https://api.github.com/repos/{repo}/git/commits/{commit_sha}', headers)
+        if commit_response.status_code != 200:
+            return None
+        commit_data = commit_response.json()
+        resolved.append(commit_data['tree']['sha'])
+        # Only a full SHA is an immutable name - an abbreviation may become ambiguous
+        return commit_data['tree']['sha'].encode() if commit_data['sha'] == commit_sha else None
+    
+    tree_sha = yield Fill(objects, (repo, 'commit-tree', commit_sha), fetch)
+    if tree_sha:
+        return tree_sha.decode()
+    return resolved[0] if resolved else None
+
+def _recursive_tree(repo, tree_sha, headers):
+    """Return (tree JSON, status code) for tree_sha, from the object cache when possible."""
+    return run(_recursive_tree_steps(repo, tree_sha, headers), github)
+
+def _recursive_tree_steps(repo, tree_sha, headers):
+    if (yield from _repo_access_steps(repo, headers)) is None:
+        return {'message': 'Not Found'}, 404
+    failed = []
+    
+    def fetch():
+        tree_response = yield Get(f'https://api.github.com/repos/{repo}/git/trees/{tree_sha}?recursive=1', headers)
+        if tree_response.status_code == 200:
+            return tree_response.content
+        failed.append(tree_response)
+        return None
+    
+    content = yield Fill(objects, (repo, 'tree', tree_sha), fetch)
+    if content is None:
+        return failed[0].json(), failed[0].status_code
+    return json.loads(content), 200
+
+def _blob(repo, blob_sha, headers):
+    return run(_blob_steps(repo, blob_sha, headers), github)
+
+def _blob_steps(repo, blob_sha, headers):
+    if (yield from _repo_access_steps(repo, headers)) is None:
+        return None
+    
+    def fetch():
+        blob_response = yield Get(f'https://api.github.com/repos/{repo}/git/blobs/{blob_sha}', headers)
+        if blob_response.status_code != 200:
+            return None
+        return base64.b64decode(blob_response.json()['content'])
+    
+    return (yield Fill(objects, (repo, 'blob', blob_sha), fetch))
+
+def _tree_entry(repo, commit_sha, filepath, headers):
+    return run(_tree_entry_steps(repo, commit_sha, filepath, headers), github)
+
+def _tree_entry_steps(repo, commit_sha, filepath, headers):
+    # The blob entry for filepath in commit_sha's (cached) tree, or None
+    tree_sha = yield from _commit_tree_sha_steps(repo, commit_sha, headers)
+    if not tree_sha:
+        return None
+    
+    tree, status = yield from _recursive_tree_steps(repo, tree_sha, headers)
+    if status != 200:
+        return None
+    
+    return next((item for item in tree.get('tree', []) if item['path'] == filepath and item['type'] == 'blob'), None)
+
+def _file_steps(repo, ref, filepath, headers, buffered=False):
+    """(payload, status) for filepath at ref, a branch or commit SHA.
+
+    With buffered, a save not yet flushed to GitHub wins over the committed
+    version. Otherwise the file is read from cached tree and blob objects,
+    falling back to the Contents API for what the tree can't resolve
+    (truncated tree, ...). Binary files are returned as a URL of the raw
+    endpoint for ref.
+    """
+    if buffered:
+        access = yield from _repo_access_steps(repo, headers)
+        content = (yield Call(save_buffer.read, (repo, ref, filepath))) if access is not None else None
+        if content is not None:
+            # After a conflict the editor gets the branch's blob SHA, so its
+            # next save knowingly replaces the change made elsewhere
+            conflict = yield Call(save_buffer.conflict, (repo, ref, filepath))
+            return {'content': content.decode('utf-8'), 'sha': conflict or git_blob_sha(content), 'type': 'text',
+                    'buffered': True, 'conflict': bool(conflict)}, 200
+        commit_sha = yield from _branch_sha_steps(repo, ref, headers)
+    else:
+        commit_sha = ref
+    
+    file_url = raw_url(repo, ref, filepath)
+    entry = (yield from _tree_entry_steps(repo, commit_sha, filepath, headers)) if commit_sha else None
+    if entry is not None:
+        if entry.get('size', 0) > FILE_INLINE_MAX_BYTES:
+            payload = yield Call(_sniffed_file, (f"https://api.github.com/repos/{repo}/git/blobs/{entry['sha']}", entry['sha'], file_url, headers))
+        else:
+            content = yield from _blob_steps(repo, entry['sha'], headers)
+            payload = file_payload(content, entry['sha'], file_url) if content is not None else None
+        if payload is not None:
+            return payload, 200
+    
+    # Fallback for files the tree can't resolve
+    url = f'https://api.github.com/repos/{repo}/contents/{filepath}?ref={ref}'
+    response = yield Get(url, headers)
+    if response.status_code != 200:
+        return {'error': 'File not found'}, 404
+    
+    data = response.json()
+    if data.get('type') != 'file':
+        return data, 200
+    
+    # Files over the Contents API's 1 MB limit come back without content
+    if not data.get('content') and data.get('size'):
+        payload = yield Call(_sniffed_file, (url, data['sha'], file_url, headers))
+        if payload is None:
+            return {'error': 'File not found'}, 404
+        return payload, 200
+    return file_payload(base64.b64decode(data.get('content', '')), data['sha'], file_url), 200
+
+def _sniffed_file(url, sha, file_url, headers):
+    """File payload for a large file, read past its first chunk only if that looks like text."""
+    response = github.get(url, headers={**headers, 'Accept': RAW_MEDIA_TYPE}, stream=True)
+    try:
+        if response.status_code != 200:
+            return None
+        chunks = response.iter_content(CHUNK_BYTES)
+        first = next(chunks, b'')
+        if not looks_like_text(first[:SNIFF_BYTES]):
+            return {'sha': sha, 'type': 'binary', 'url': file_url}
+        return file_payload(first + b''.join(chunks), sha, file_url)
+    finally:
+        response.close()
+
 @app.route('/api/tree/<path:repo>/<branch>')
 def get_tree(repo, branch):
     if 'oauth_token' not in session:
         return jsonify({'error': 'Not authenticated'}), 401
     
     headers = {'Authorization': f"token {session['oauth_token']}"}
+    payload, status = run(_tree_steps(repo, branch, headers, request.args.get('format') == 'compact', request.args.get('since')), github)
+    return jsonify(payload), status
+
+def _tree_steps(repo, branch, headers, compact=False, since=None):
+    """(payload, status) for the tree route: the recursive tree at branch's head, in compact form if asked."""
+    # Get branch SHA - the only mutable lookup, everything below is cached by SHA
+    sha = yield from _branch_sha_steps(repo, branch, headers)
+    if not sha:
+        return {'error': 'Branch not found'}, 404
     
-    # Get branch SHA
-    branch_response = requests.get(f'https://api.github.com/repos/{repo}/git/ref/heads/{branch}', headers=headers)
-    if branch_response.status_code != 200:
-        return jsonify({'error': 'Branch not found'}), 404
-    
-    sha = branch_response.json()['object']['sha']
+    tree_sha = yield from _commit_tree_sha_steps(repo, sha, headers)
+    if not tree_sha:
+        return {'error': 'Commit not found'}, 404
     
     # Get recursive tree
-    tree_response = requests.get(f'https://api.github.com/repos/{repo}/git/trees/{sha}?recursive=1', headers=headers)
-    return jsonify(tree_response.json())
+    tree, status = yield from _recursive_tree_steps(repo, tree_sha, headers)
+    if status == 200 and packages.mpm and tree_sha not in _scanned_trees:
+        if len(_scanned_trees) > 10000:
+            _scanned_trees.clear()
+        _scanned_trees.add(tree_sha)
+        package_scans.submit(_prefetch_packages, repo, tree, headers)
+    if status != 200 or not compact:
+        return tree, status
+    
+    # The tree the client already has is usually still cached by SHA
+    base = None
+    if since and COMMIT_SHA_PATTERN.fullmatch(since):
+        base, base_status = yield from _recursive_tree_steps(repo, since, headers)
+        if base_status != 200:
+            base = None
+    return _tree_payload(tree, tree_sha, base, since), 200
+
+def _tree_payload(tree, tree_sha, base=None, base_sha=None):
+    """Compact form of a recursive tree: a [path, type, size, sha] list per entry.
+
+    Given base, the tree the client has, only the entries added or changed
+    since and the paths removed are sent - unless either listing is
+    truncated, where a diff would report unlisted paths as removed.
+    """
+    entries = [[item['path'], item['type'], item.get('size'), item['sha']] for item in tree.get('tree', [])]
+    payload = {'sha': tree_sha, 'truncated': tree.get('truncated', False)}
+    if base is None or payload['truncated'] or base.get('truncated'):
+        payload['entries'] = entries
+        return payload
+    
+    previous = {item['path']: item['sha'] for item in base.get('tree', [])}
+    current = {entry[0] for entry in entries}
+    payload['base'] = base_sha
+    payload['added'] = [entry for entry in entries if entry[0] not in previous]
+    payload['changed'] = [entry for entry in entries if entry[0] in previous and previous[entry[0]] != entry[3]]
+    payload['removed'] = [path for path in previous if path not in current]
+    return payload
+
+def _prefetch_packages(repo, tree, headers):
+    """Scan an opened project's TeX sources and install the packages it uses."""
+    try:
+        entries = [item for item in tree.get('tree', []) if item['type'] == 'blob']
+        local = {os.path.basename(item['path']) for item in entries}
+        sources = [item for item in entries if item['path'].endswith(('.tex', '.sty', '.cls'))
+                   and item.get('size', 0) < 1024 * 1024]
+        files = set()
+        # Blobs land in the object cache, so opening these files later is free
+        for item in sources[:PACKAGE_SCAN_MAX_FILES]:
+            content = _blob(repo, item['sha'], headers)
+            if content is not None:
+                files |= scan_packages(content.decode('utf-8', errors='replace'))
+        packages.prefetch(files - local)
+    except Exception as e:
+        print(f'Package scan failed for {repo}: {e}')
 
 @app.route('/api/file', methods=['POST'])
 def get_file():
@@ -161,39 +610,90 @@ def get_file():
         return jsonify({'error': 'Not authenticated'}), 401
     
     data = request.json
-    repo = data['repo']
-    branch = data['branch']
-    filepath = data['filepath']
-    
     headers = {'Authorization': f"token {session['oauth_token']}"}
-    url = f'https://api.github.com/repos/{repo}/contents/{filepath}?ref={branch}'
-    
-    print(f"Fetching: {url}")  # Debug line
-    response = requests.get(url, headers=headers)
+    payload, status = run(_file_steps(data['repo'], data['branch'], data['filepath'], headers, buffered=SAVE_BUFFER_ENABLED), github)
+    return jsonify(payload), status
+
+@app.route('/api/raw/<path:repo>')
+def get_raw_file(repo):
+    """Stream a file's bytes with its content type; ?ref= is a branch or commit SHA, ?path= the file."""
+    if 'oauth_token' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
     
-    print(f"Status: {response.status_code}")  # Debug line
+    ref = request.args.get('ref')
+    filepath = request.args.get('path')
+    if not ref or not filepath:
+        return jsonify({'error': 'ref and path are required'}), 400
     
-    if response.status_code != 200:
-        print(f"Error: {response.text}")  # Debug line
-        return jsonify({'error': 'File not found'}), 404
+    headers = {'Authorization': f"token {session['oauth_token']}"}
+    if not _can_read(repo, headers):
+        return jsonify({'error': 'Repository not found'}), 404
+    immutable = bool(COMMIT_SHA_PATTERN.fullmatch(ref))
+    if immutable:
+        commit_sha = ref
+    else:
+        if SAVE_BUFFER_ENABLED:
+            buffered = save_buffer.read(repo, ref, filepath)
+            if buffered is not None:
+                return _send_raw(filepath, git_blob_sha(buffered), iter([buffered]), len(buffered), False)
+        commit_sha = _branch_sha(repo, ref, headers)
+        if not commit_sha:
+            return jsonify({'error': 'Branch not found'}), 404
+    
+    entry = _tree_entry(repo, commit_sha, filepath, headers)
+    if entry is not None:
+        if entry['sha'] in request.if_none_match:
+            return _raw_headers(Response(status=304), entry['sha'], immutable)
+        content = objects.get(repo, 'blob', entry['sha'])
+        if content is not None:
+            return _send_raw(filepath, entry['sha'], iter([content]), len(content), immutable)
+        url = f"https://api.github.com/repos/{repo}/git/blobs/{entry['sha']}"
+    else:
+        url = f'https://api.github.com/repos/{repo}/contents/{filepath}?ref={ref}'
     
+    # Chunks go straight from GitHub to the client, never the whole file in memory
+    response = github.get(url, headers={**headers, 'Accept': RAW_MEDIA_TYPE}, stream=True)
     if response.status_code != 200:
+        response.close()
         return jsonify({'error': 'File not found'}), 404
+    length = response.headers.get('Content-Length') if 'Content-Encoding' not in response.headers else None
     
-    data = response.json()
-    
-    # Decode content if it's a file
-    if data.get('type') == 'file' and 'content' in data:
+    def chunks():
         try:
-            content = base64.b64decode(data['content']).decode('utf-8')
-            print(f"Text file: {filepath}")
-            return jsonify({'content': content, 'sha': data['sha'], 'type': 'text'})
-        except UnicodeDecodeError:
-            # Binary file - return base64 as-is
-            print(f"Binary file: {filepath}")
-            return jsonify({'content': data['content'], 'sha': data['sha'], 'type': 'binary'})
+            yield from response.iter_content(CHUNK_BYTES)
+        finally:
+            response.close()
     
-    return jsonify(data)
+    return _send_raw(filepath, entry['sha'] if entry else None, chunks(), length, immutable)
+
+def _send_raw(filepath, sha, chunks, length, immutable):
+    # The first chunk decides the content type
+    first = next(chunks, b'')
+    
+    def body():
+        yield first
+        yield from chunks
+    
+    response = Response(body(), content_type=content_type(filepath, first[:SNIFF_BYTES]))
+    if length is not None:
+        response.headers['Content-Length'] = str(length)
+    return _raw_headers(response, sha, immutable)
+
+def _raw_headers(response, sha, immutable):
+    # Repository files are served from our origin - never let them run as a page
+    # (browsers refuse to show a sandboxed PDF, which runs no page script anyway)
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    if response.mimetype != 'application/pdf':
+        response.headers['Content-Security-Policy'] = 'sandbox'
+    if sha:
+        response.set_etag(sha)
+    response.cache_control.private = True
+    if immutable:
+        response.cache_control.max_age = 31536000
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
 
 @app.route('/api/save', methods=['POST'])
 def save_file():
@@ -204,16 +704,38 @@ def save_file():
     repo = data['repo']
     branch = data['branch']
     filepath = data['filepath']
-    content = data['content']
     sha = data.get('sha')
     
     headers = {'Authorization': f"token {session['oauth_token']}"}
     
+    # Either the whole text, or editor edits against base_sha plus the
+    # blob SHA of the result; a delta that doesn't reproduce it is refused
+    # with 409 and the editor resends the whole file
+    if 'edits' in data:
+        try:
+            content = _apply_delta(repo, branch, filepath, data['base_sha'], data['edits'], headers, data['content_sha'])
+        except DeltaError as e:
+            return jsonify({'error': f'{e}, send the full content', 'resync': True}), 409
+    else:
+        content = data['content'].encode('utf-8')
+    
+    # Acknowledge from the local buffer; the commit happens on the next flush.
+    # sha names the version the editor changed, checked again at flush time
+    if SAVE_BUFFER_ENABLED:
+        if not _can_push(repo, headers):
+            return jsonify({'error': 'No push access to this repository'}), 403
+        try:
+            buffered_sha = save_buffer.save(repo, branch, filepath, content, session['oauth_token'],
+                                            sha or data.get('base_sha'))
+        except SaveConflict as e:
+            return jsonify({'error': 'File was changed elsewhere, reload it', 'sha': e.conflicts[filepath]}), 409
+        return jsonify({'success': True, 'sha': buffered_sha, 'buffered': True})
+    
     # Create commit message with timestamp
     commit_message = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     
     # Encode content
-    encoded_content = base64.b64encode(content.encode('utf-8')).decode('utf-8')
+    encoded_content = base64.b64encode(content).decode('utf-8')
     
     payload = {
         'message': commit_message,
@@ -224,13 +746,14 @@ def save_file():
     if sha:
         payload['sha'] = sha
     
-    response = requests.put(
+    response = github.put(
         f'https://api.github.com/repos/{repo}/contents/{filepath}',
         headers=headers,
         json=payload
     )
     
     if response.status_code in [200, 201]:
+        _ref_changed(repo, branch, response.json()['commit']['sha'])
         return jsonify({'success': True, 'sha': response.json()['content']['sha']})
     else:
         return jsonify({'error': response.json()}), response.status_code
@@ -246,6 +769,12 @@ def create_file():
     filepath = data['filepath']
     content = data.get('content', '')
     
+    # Commit buffered saves first so they can't land on top of this change
+    try:
+        _flush_pending(repo, branch)
+    except Exception as e:
+        return jsonify({'error': f'Could not flush pending saves: {e}'}), 502
+    
     headers = {'Authorization': f"token {session['oauth_token']}"}
     
     commit_message = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
@@ -257,13 +786,14 @@ def create_file():
         'branch': branch
     }
     
-    response = requests.put(
+    response = github.put(
         f'https://api.github.com/repos/{repo}/contents/{filepath}',
         headers=headers,
         json=payload
     )
     
     if response.status_code == 201:
+        _ref_changed(repo, branch, response.json()['commit']['sha'])
         return jsonify({'success': True, 'sha': response.json()['content']['sha']})
     else:
         return jsonify({'error': response.json()}), response.status_code
@@ -273,67 +803,123 @@ def upload_file():
     if 'oauth_token' not in session:
         return jsonify({'error': 'Not authenticated'}), 401
     
-    data = request.json
+    # Either JSON with base64 content, or the raw file as the body with
+    # repo, branch and filepath in the query string
+    raw = not request.is_json
+    data = request.args if raw else request.json
     repo = data['repo']
     branch = data['branch']
     filepath = data['filepath']
-    content = data['content']  # Already base64 encoded from frontend
+    
+    # Commit buffered saves first so they can't land on top of this change
+    try:
+        _flush_pending(repo, branch)
+    except Exception as e:
+        return jsonify({'error': f'Could not flush pending saves: {e}'}), 502
     
     headers = {'Authorization': f"token {session['oauth_token']}"}
     
     commit_message = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    
-    payload = {
-        'message': commit_message,
-        'content': content,  # Use as-is since it's already base64
-        'branch': branch
-    }
-    
-    response = requests.put(
-        f'https://api.github.com/repos/{repo}/contents/{filepath}',
-        headers=headers,
-        json=payload
-    )
+    url = f'https://api.github.com/repos/{repo}/contents/{filepath}'
+    
+    if raw:
+        # Encoded chunk by chunk on the way to GitHub, so the file never sits in memory whole
+        body = base64_json_body({'message': commit_message, 'branch': branch}, 'content',
+                                request.stream, request.content_length)
+        headers['Content-Type'] = 'application/json'
+        response = github.put(url, headers=headers, data=body)
+    else:
+        payload = {
+            'message': commit_message,
+            'content': data['content'],  # Already base64 encoded from frontend
+            'branch': branch
+        }
+        response = github.put(url, headers=headers, json=payload)
     
     if response.status_code == 201:
+        _ref_changed(repo, branch, response.json()['commit']['sha'])
         return jsonify({'success': True, 'sha': response.json()['content']['sha']})
     else:
         return jsonify({'error': response.json()}), response.status_code
 
-@app.route('/api/compile', methods=['POST'])
-def compile_file():
-    if 'oauth_token' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
-    
-    data = request.json
-    repo = data['repo']
-    branch = data['branch']
-    filepath = data['filepath']
-    commit = data.get('commit')
-    
-    # Create temp directory
-    temp_dir = tempfile.mkdtemp()
-    
-    try:
-        # Clone repository
-        clone_url = f"https://{session['oauth_token']}@github.com/{repo}.git"
-        
-        if commit:
-            # Clone and checkout specific commit
-            subprocess.run(['git', 'clone', clone_url, temp_dir], 
-                          check=True, capture_output=True)
-            subprocess.run(['git', 'checkout', commit], 
-                          cwd=temp_dir, check=True, capture_output=True)
-        else:
-            # Clone specific branch
-            subprocess.run(['git', 'clone', '-b', branch, '--depth', '1', clone_url, temp_dir], 
-                          check=True, capture_output=True)
+class CompileError(Exception):
+    def __init__(self, message, status_code=400, limit=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.limit = limit  # name of the resource limit that stopped the build
+
+def _user_key(token):
+    # Stable per-user id for scheduling without keeping the token around
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()[:16]
+
+def _clone_url(repo, token):
+    scheme, sep, rest = GITHUB_GIT_URL.partition('://')
+    if scheme in ('http', 'https'):
+        return f"{scheme}://{token}@{rest}/{repo}.git"
+    return f"{GITHUB_GIT_URL}/{repo}.git"
+
+def _overlay_sha(source_sha, overlay):
+    """Fold uncommitted file contents into the SHA identifying a build's inputs."""
+    if not overlay:
+        return source_sha
+    digest = hashlib.sha256(source_sha.encode('utf-8'))
+    for path in sorted(overlay):
+        digest.update(f'\0{path}\0{git_blob_sha(overlay[path])}'.encode('utf-8'))
+    return digest.hexdigest()
+
+def _write_overlay(root, overlay):
+    # Lay uncommitted contents over the checkout; the next checkout resets them
+    root = os.path.realpath(root)
+    for path, content in overlay.items():
+        target = os.path.realpath(os.path.join(root, path))
+        if not target.startswith(root + os.sep):
+            raise CompileError(f'Invalid path: {path}', 400)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, 'wb') as f:
+            f.write(content)
+
+def run_compile(repo, branch, filepath, commit, token, compiler, source_sha, progress=None, overlay=None):
+    """Build filepath and return the path of its PDF in the compiled PDF cache.
+
+    overlay maps paths to contents that replace the committed files (pending saves).
+    """
+    # Workers asked for the same inputs build them once; the others wait
+    # without holding a node slot and then find the PDF in the cache
+    key = pdf_cache_key(filepath, compiler, source_sha, repo if commit else None) if source_sha else None
+    lock = shared_cache.locked(f'compile:{key}') if key else nullcontext()
+    with lock:
+        if key:
+            cached_pdf = compiled_pdfs.get(key, record=False)
+            if cached_pdf:
+                return cached_pdf
+        with compile_scheduler.slot(_user_key(token)), governor.job(repo=repo, filepath=filepath, compiler=compiler), metrics.span('compile', compiler=compiler):
+            return _run_compile(repo, branch, filepath, commit, token, compiler, source_sha, progress, overlay)
+
+def _run_compile(repo, branch, filepath, commit, token, compiler, source_sha, progress, overlay):
+    progress = progress or (lambda phase, log=None: None)
+    overlay = overlay or {}
+    
+    clone_url = _clone_url(repo, token)
+    
+    # LaTeX builds only check out the files the document pulls in; pandoc
+    # gets the whole tree
+    deps = Dependencies(filepath, extra=overlay) if compiler == 'pdflatex' else None
+    
+    # Reuse the cached working copy - only fetches what changed since the last compile
+    progress('fetching')
+    checkout_started = time.monotonic()
+    with workspaces.checkout(repo, clone_url, branch=branch, commit=commit, sparse=deps) as temp_dir:
+        _write_overlay(temp_dir, overlay)
+        if deps and overlay and workspaces.widen(temp_dir, clone_url, deps):
+            # Unsaved edits may \input files the committed version didn't
+            _write_overlay(temp_dir, overlay)
+        metrics.record('compile_phase', time.monotonic() - checkout_started, phase='checkout', outcome='ok')
         
         # Full path to file
         file_path = os.path.join(temp_dir, filepath)
         
         if not os.path.exists(file_path):
-            return jsonify({'error': 'File not found in repository'}), 404
+            raise CompileError('File not found in repository', 404)
         
         # Get the directory where the file is located
         file_dir = os.path.dirname(file_path)
@@ -342,141 +928,697 @@ def compile_file():
         # Use file's directory as working directory (or temp_dir if file is at root)
         working_dir = file_dir if file_dir else temp_dir
         
-        # Detect file type and choose appropriate compilation
-        file_ext = os.path.splitext(file_path)[1].lower()
-        
         # Configure environment for MikTeX
         env = os.environ.copy()
         env['MIKTEX_AUTOINSTALL'] = 'yes'  # Auto-install missing packages
         
-        if file_ext in ['.tex', '.latex']:
-            # For LaTeX files, compile directly with pdflatex/xelatex
-            # Output PDF will be in the same directory as the source file
-            output_pdf = os.path.join(working_dir, os.path.splitext(file_name)[0] + '.pdf')
+        if compiler == 'pdflatex':
+            # Install missing packages up front, one install at a time per
+            # node, instead of letting concurrent TeX runs race on them
+            if packages.mpm:
+                progress('packages')
+                with metrics.span('compile_phase', phase='packages'):
+                    packages.ensure(scan_directory(temp_dir), env)
             
-            # Run twice for references and TOC
-            for i in range(2):
-                result = subprocess.run(
-                    ['pdflatex', '-interaction=nonstopmode', file_name],
-                    cwd=working_dir,
-                    capture_output=True,
-                    text=True,
-                    env=env
-                )
+            # For LaTeX files, compile incrementally with pdflatex - aux files
+            # are kept between compiles so only the passes actually needed run
+            build_dir = build_dir_for(temp_dir, filepath)
+            result, output_pdf, passes = build_latex(working_dir, file_name, build_dir, env, progress=progress,
+                                                   formats=formats, governor=governor)
+            
+            # Inputs the scan missed (macros building file names, ...) are
+            # fetched when TeX asks for them, then the build is retried
+            for _ in range(3):
+                if result.limit or not deps.add_missing(result.stdout, temp_dir, workspaces.tree_paths(temp_dir)):
+                    break
+                progress('fetching')
+                with metrics.span('compile_phase', phase='fetch_missing'):
+                    workspaces.widen(temp_dir, clone_url, deps)
+                _write_overlay(temp_dir, overlay)
+                result, output_pdf, passes = build_latex(working_dir, file_name, build_dir, env, progress=progress,
+                                                       formats=formats, governor=governor)
         else:
             # For other formats (Markdown, etc.), use Pandoc
             # Output in same directory as source
+            progress('pandoc')
             output_pdf = os.path.join(working_dir, os.path.splitext(file_name)[0] + '.pdf')
-            result = subprocess.run(
-                ['pandoc', file_name, '-o', os.path.basename(output_pdf), '--pdf-engine=xelatex'],
-                cwd=working_dir,
-                capture_output=True,
-                text=True,
-                env=env
-            )
+            with metrics.span('compile_phase', phase='pandoc'):
+                result = governor.run(
+                    ['pandoc', file_name, '-o', os.path.basename(output_pdf), '--pdf-engine=xelatex'],
+                    cwd=working_dir,
+                    env=env
+                )
         
         # Don't check return code - only check if PDF exists
         # This handles cases where compilers return non-zero but still produce PDFs
         
+        # A build stopped at a limit may have left a partial PDF behind
+        if result.limit:
+            raise CompileError(f'Compilation stopped: {governor.describe(result.limit)}.\n\n{result.stdout[-2000:]}',
+                               400, limit=result.limit)
+        
         # Check if PDF was actually created
         if not os.path.exists(output_pdf):
-            return jsonify({'error': f'Compilation failed: PDF not generated.\n\n{result.stderr}'}), 400
+            raise CompileError(f'Compilation failed: PDF not generated.\n\n{result.stderr}', 400)
         
-        # Read PDF and encode to base64
-        with open(output_pdf, 'rb') as f:
-            pdf_content = base64.b64encode(f.read()).decode('utf-8')
+        # Store under the tree actually built - the branch may have moved since the lookup
+        with metrics.span('compile_phase', phase='store'):
+            tree_sha = subprocess.run(['git', 'rev-parse', 'HEAD^{tree}'], cwd=temp_dir,
+                                      check=True, capture_output=True).stdout.decode().strip()
+            pdf_path = compiled_pdfs.put(pdf_cache_key(filepath, compiler, _overlay_sha(tree_sha, overlay)), output_pdf)
+            if commit:
+                pdf_path = compiled_pdfs.put(pdf_cache_key(filepath, compiler, commit, repo), output_pdf)
+        return pdf_path
+
+def _preview_overlay(repo, branch, files, headers):
+    """Turn preview file contents from the editor into {path: bytes}.
+
+    Each value is either the full text or {'base_sha': blob sha, 'edits': [...],
+    'content_sha': blob sha of the result} with editor edits against that
+    version (buffered or committed).
+    """
+    overlay = {}
+    for path, value in files.items():
+        if isinstance(value, str):
+            overlay[path] = value.encode('utf-8')
+            continue
+        try:
+            overlay[path] = _apply_delta(repo, branch, path, value['base_sha'], value.get('edits', []), headers,
+                                         value.get('content_sha'))
+        except DeltaError as e:
+            raise CompileError(f'{e}, send the full content', 409)
+    return overlay
+
+def _apply_delta(repo, branch, path, base_sha, edits, headers, content_sha=None):
+    """Rebuild a file from editor edits against base_sha, a buffered save or committed blob.
+
+    content_sha, when given, is the blob SHA the editor has for the result;
+    raises DeltaError if the base is unknown or the result differs.
+    """
+    base = save_buffer.read(repo, branch, path) if SAVE_BUFFER_ENABLED and _can_read(repo, headers) else None
+    if base is None or git_blob_sha(base) != base_sha:
+        base = _blob(repo, base_sha, headers)
+    if base is None:
+        raise DeltaError(f'Unknown base version of {path}')
+    try:
+        content = apply_edits(base.decode('utf-8'), edits).encode('utf-8')
+    except UnicodeDecodeError:
+        raise DeltaError(f'Base version of {path} is not text')
+    if content_sha and git_blob_sha(content) != content_sha:
+        raise DeltaError(f'Edits to {path} do not reproduce the editor contents')
+    return content
+
+def queue_compile(data, token):
+    """Resolve a compile request's inputs and queue the build unless the PDF is cached.
+
+    data['files'] optionally carries unsaved editor contents to compile as a
+    preview - they are laid over the checkout but never committed.
+    Returns (pdf_path, future, build_id); exactly one of pdf_path and future is set.
+    """
+    repo = data['repo']
+    branch = data['branch']
+    filepath = data['filepath']
+    commit = data.get('commit')
+    
+    headers = {'Authorization': f"token {token}"}
+    
+    # Cached PDFs and workspaces are shared between users, so access is
+    # checked before either is looked at
+    if not _can_read(repo, headers):
+        raise CompileError('Repository not found', 404)
+    
+    # Detect file type and choose appropriate compilation
+    file_ext = os.path.splitext(filepath)[1].lower()
+    compiler = 'pdflatex' if file_ext in ['.tex', '.latex'] else 'pandoc'
+    
+    # Identify the inputs by SHA so an unchanged build is served without git
+    # or TeX; a commit named by the client only counts within this repo
+    if commit:
+        source_sha = commit
+    else:
+        source_sha = None
+        branch_response = github.get(f'https://api.github.com/repos/{repo}/branches/{branch}', headers=headers)
+        if branch_response.status_code == 200:
+            source_sha = branch_response.json()['commit']['commit']['tree']['sha']
+    
+    # Compiles see buffered saves that haven't been committed yet, and
+    # preview compiles the editor's current contents on top of those
+    overlay = save_buffer.overlay(repo, branch) if SAVE_BUFFER_ENABLED and not commit else {}
+    if data.get('files') and not commit:
+        overlay.update(_preview_overlay(repo, branch, data['files'], headers))
+    
+    if source_sha:
+        source_sha = _overlay_sha(source_sha, overlay)
+        build_id = pdf_cache_key(filepath, compiler, source_sha, repo if commit else None)
+        pdf_path = compiled_pdfs.get(build_id)
+        if pdf_path:
+            return pdf_path, None, build_id
+    else:
+        build_id = _overlay_sha(hashlib.sha256(f'{repo}\0{commit or branch}\0{filepath}'.encode('utf-8')).hexdigest(), overlay)
+    
+    # Identical in-flight builds share one job; a newer autosave of the
+    # same file replaces one that is still waiting in the queue
+    user = _user_key(token)
+    supersede_key = (user, repo, branch, filepath) if data.get('autosave') else None
+    progress = lambda phase, log=None: compile_jobs.progress(build_id, phase, log)
+    future = compile_scheduler.submit(
+        user, build_id,
+        lambda: run_compile(repo, branch, filepath, commit, token, compiler, source_sha, progress, overlay),
+        supersede_key=supersede_key
+    )
+    return None, future, build_id
+
+@app.route('/api/compile', methods=['POST'])
+def compile_file():
+    if 'oauth_token' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    try:
+        pdf_path, future, build_id = queue_compile(request.json, session['oauth_token'])
+        if future:
+            pdf_path = future.result()
         
-        return jsonify({'success': True, 'pdf': pdf_content})
+        # The PDF itself is streamed from /api/pdf instead of inlined as base64
+        key = _pdf_key(pdf_path)
+        return jsonify({'success': True, 'pdf_url': url_for('get_pdf', key=key), 'etag': key})
         
+    except CompileError as e:
+        return jsonify({'error': str(e), 'limit': e.limit}), e.status_code
     except subprocess.CalledProcessError as e:
         return jsonify({'error': f'Git/Pandoc error: {e.stderr.decode()}'}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
-    finally:
-        # Cleanup
-        shutil.rmtree(temp_dir, ignore_errors=True)
 
-@app.route('/api/upload-zip', methods=['POST'])
-def upload_zip():
+def _finish_job(job_id, build_id, future):
+    # Runs on the compile thread once the (possibly shared) build completes
+    compile_jobs.progress(build_id, 'done')
+    error = future.exception()
+    if error is None:
+        compile_jobs.update(job_id, status='done', phase='done', pdf_path=future.result())
+    elif isinstance(error, CompileError):
+        compile_jobs.update(job_id, status='failed', phase='failed', error=str(error), status_code=error.status_code,
+                            limit=error.limit)
+    elif isinstance(error, subprocess.CalledProcessError):
+        compile_jobs.update(job_id, status='failed', phase='failed', error=f'Git/Pandoc error: {error.stderr.decode()}', status_code=400)
+    else:
+        compile_jobs.update(job_id, status='failed', phase='failed', error=str(error), status_code=500)
+
+def _pdf_key(pdf_path):
+    # Cached PDFs are named by their content address, which doubles as a strong ETag
+    return os.path.splitext(os.path.basename(pdf_path))[0]
+
+def _send_pdf(pdf_path):
+    # conditional=True answers If-None-Match with 304 and serves Range requests;
+    # the file is handed to the server's file wrapper (sendfile) rather than read here
+    response = send_file(pdf_path, mimetype='application/pdf', conditional=True,
+                         etag=_pdf_key(pdf_path), max_age=86400)
+    response.cache_control.public = False
+    response.cache_control.private = True
+    return response
+
+def _job_status(job):
+    status = {k: job.get(k) for k in ('job_id', 'status', 'phase', 'log_tail', 'error', 'limit')}
+    if job['status'] == 'done':
+        status['pdf_url'] = url_for('get_pdf', key=_pdf_key(job['pdf_path']))
+    return status
+
+def _load_job(job_id):
+    job = compile_jobs.get(job_id)
+    if job is None or job.get('user') != _user_key(session['oauth_token']):
+        return None
+    return job
+
+@app.route('/api/compile/jobs', methods=['POST'])
+def create_compile_job():
     if 'oauth_token' not in session:
         return jsonify({'error': 'Not authenticated'}), 401
     
-    data = request.json
-    repo = data['repo']
-    branch = data['branch']
-    zip_data = data['zip_data']
+    token = session['oauth_token']
+    try:
+        pdf_path, future, build_id = queue_compile(request.json, token)
+    except CompileError as e:
+        return jsonify({'error': str(e)}), e.status_code
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
     
-    headers = {'Authorization': f"token {session['oauth_token']}"}
+    job_id = compile_jobs.create(_user_key(token), build_id)
+    if future:
+        future.add_done_callback(lambda done: _finish_job(job_id, build_id, done))
+    else:
+        compile_jobs.update(job_id, status='done', phase='done', pdf_path=pdf_path)
     
+    return jsonify(_job_status(compile_jobs.get(job_id))), 202
+
+@app.route('/api/compile/jobs/<job_id>')
+def get_compile_job(job_id):
+    if 'oauth_token' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    job = _load_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(_job_status(job))
+
+@app.route('/api/compile/jobs/<job_id>/events')
+def stream_compile_job(job_id):
+    if 'oauth_token' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    if _load_job(job_id) is None:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    def events():
+        last = None
+        while True:
+            job = compile_jobs.get(job_id)
+            if job is None:
+                return
+            status = _job_status(job)
+            if status != last:
+                yield f"data: {json.dumps(status)}\n\n"
+                last = status
+            if job['status'] in ('done', 'failed'):
+                return
+            time.sleep(0.5)
+    
+    # The status dict needs the request context for url_for
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/compile/jobs/<job_id>/pdf')
+def get_compile_job_pdf(job_id):
+    if 'oauth_token' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    job = _load_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if job['status'] != 'done':
+        return jsonify({'error': 'PDF not ready', 'status': job['status']}), 409
+    if not os.path.exists(job['pdf_path']):
+        return jsonify({'error': 'PDF expired from cache, recompile'}), 410
+    return _send_pdf(job['pdf_path'])
+
+@app.route('/api/pdf/<key>')
+def get_pdf(key):
+    if 'oauth_token' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    pdf_path = compiled_pdfs.get(os.path.basename(key), record=False)
+    if not pdf_path:
+        return jsonify({'error': 'PDF expired from cache, recompile'}), 404
+    return _send_pdf(pdf_path)
+
+@app.route('/api/pdf/<key>/pages')
+def get_pdf_pages(key):
+    if 'oauth_token' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    key = os.path.basename(key)
+    pdf_path = compiled_pdfs.get(key, record=False)
+    if not pdf_path:
+        return jsonify({'error': 'PDF expired from cache, recompile'}), 404
     try:
-        # 1. Decode and unzip in memory
-        zip_bytes = base64.b64decode(zip_data)
-        z = zipfile.ZipFile(io.BytesIO(zip_bytes))
+        pages = page_images.pages(key, pdf_path, _user_key(session['oauth_token']))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    
+    # Only pages that differ from the build the client is showing need fetching
+    since = request.args.get('since')
+    changed = changed_pages(pages, page_images.manifest(since) if since else None)
+    return jsonify({
+        'key': key,
+        'page_count': len(pages),
+        'changed': [{'page': i, 'url': url_for('get_page_image', page=pages[i])} for i in changed],
+    })
+
+@app.route('/api/page/<page>')
+def get_page_image(page):
+    if 'oauth_token' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    path = page_images.image_path(page)
+    if not os.path.exists(path):
+        return jsonify({'error': 'Page expired from cache'}), 404
+    # Named by content hash, so the browser may keep it for good
+    response = send_file(path, mimetype='image/png', conditional=True, etag=os.path.basename(page), max_age=31536000)
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.immutable = True
+    return response
+
+@app.route('/api/compile/queue')
+def get_compile_queue():
+    if 'oauth_token' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    return jsonify({**compile_scheduler.stats(), 'governor': governor.stats()})
+
+@app.route('/api/cache/stats')
+def get_cache_stats():
+    if 'oauth_token' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    return jsonify({'workspaces': workspaces.stats(), 'pdfs': compiled_pdfs.stats(), 'pages': page_images.stats(), 'formats': formats.stats() if formats else None, 'packages': packages.stats(), 'commits': commit_index.stats(), 'github': github.stats(), 'objects': objects.stats(), 'shared': shared_cache.stats(), 'save_buffer': save_buffer.stats() if save_buffer else None})
+
+class CommitError(Exception):
+    def __init__(self, message, status_code=500, head=None, conflicts=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.head = head
+        self.conflicts = conflicts  # {path: blob sha on the branch} for expected_blobs that didn't match
+
+def _create_blob(repo, content, headers, attempts=4):
+    # Handle both text and binary files via base64
+    encoded_content = base64.b64encode(content).decode('utf-8')
+    for attempt in range(attempts):
+        try:
+            blob_res = github.post(
+                f'https://api.github.com/repos/{repo}/git/blobs',
+                headers=headers,
+                json={'content': encoded_content, 'encoding': 'base64'}
+            )
+        except Exception as e:
+            blob_res = None
+            error = str(e)
+        else:
+            if blob_res.status_code == 201:
+                return blob_res.json()['sha']
+            error = blob_res.text
+            # Only server errors and (secondary) rate limiting are worth retrying
+            if blob_res.status_code < 500 and blob_res.status_code not in (403, 429):
+                break
+        if attempt < attempts - 1:
+            retry_after = blob_res.headers.get('Retry-After') if blob_res is not None else None
+            time.sleep(float(retry_after) if retry_after and retry_after.isdigit() else 0.5 * 2 ** attempt)
+    raise CommitError(f'Failed to upload blob: {error}', blob_res.status_code if blob_res is not None else 502)
+
+def upload_blobs(repo, headers, items, known_shas=()):
+    """Upload blobs for (path, read) pairs on the bounded upload pool.
+
+    read() is only called on a pool thread, so at most BLOB_UPLOAD_WORKERS
+    files are held in memory at once. Content whose blob SHA is in known_shas
+    already exists in the repo and is not uploaded again. Returns {path: sha}.
+    """
+    def upload(path, read):
+        content = read()
+        sha = git_blob_sha(content)
+        if sha not in known_shas:
+            sha = _create_blob(repo, content, headers)
+        return path, sha
+    
+    futures = [blob_uploads.submit(upload, path, read) for path, read in items]
+    return dict(future.result() for future in futures)
+
+def _base_entries(repo, commit_sha, paths, headers):
+    """(tree sha, {path: (mode, blob sha)}) of the blobs in commit_sha's tree.
+
+    Normally every blob of the recursive listing. When GitHub truncated that
+    listing (very large repos), only the given paths, looked up directory by
+    directory with non-recursive tree requests.
+    """
+    tree_sha = _commit_tree_sha(repo, commit_sha, headers)
+    tree, status = _recursive_tree(repo, tree_sha, headers) if tree_sha else ({}, 404)
+    if status != 200:
+        raise CommitError('Could not read base tree', 502)
+    if not tree.get('truncated'):
+        return tree_sha, {item['path']: (item['mode'], item['sha']) for item in tree.get('tree', []) if item['type'] == 'blob'}
+    
+    base = {}
+    listings = {'': _directory_entries(repo, tree_sha, headers)}
+    for path in paths:
+        directory, _, name = path.rpartition('/')
+        item = _directory_listing(repo, directory, headers, listings).get(name)
+        if item and item['type'] == 'blob':
+            base[path] = (item['mode'], item['sha'])
+    return tree_sha, base
+
+def _directory_listing(repo, directory, headers, listings):
+    # {name: entry} of one directory below the root listing, memoized in listings
+    if directory not in listings:
+        parent, _, name = directory.rpartition('/')
+        item = _directory_listing(repo, parent, headers, listings).get(name)
+        listings[directory] = _directory_entries(repo, item['sha'], headers) if item and item['type'] == 'tree' else {}
+    return listings[directory]
+
+def _directory_entries(repo, tree_sha, headers):
+    response = github.get(f'https://api.github.com/repos/{repo}/git/trees/{tree_sha}', headers=headers)
+    if response.status_code != 200:
+        raise CommitError('Could not read base tree', 502)
+    return {item['path']: item for item in response.json().get('tree', [])}
+
+def _branch_head(repo, branch, headers):
+    ref_res = github.get(f'https://api.github.com/repos/{repo}/git/ref/heads/{branch}', headers=headers)
+    if ref_res.status_code != 200:
+        raise CommitError('Branch not found', 404)
+    return ref_res.json()['object']['sha']
+
+def commit_changes(repo, branch, headers, changes, message, expected_head=None, expected_blobs=None, max_attempts=3):
+    """Apply a set of file changes to branch as one commit through the git data API.
+
+    changes is a list of dicts with 'op' in create/update/delete/rename:
+      {'op': 'update', 'path': p, 'content': bytes}  (or 'sha' of an uploaded blob)
+      {'op': 'delete', 'path': p}
+      {'op': 'rename', 'path': old, 'new_path': new}
+    Operations apply in order on top of the branch head. Blobs are uploaded
+    concurrently once; the tree, commit and ref update are retried on top of
+    the new head if the branch moves underneath us, unless expected_head
+    pins the commit the client based its edits on. expected_blobs maps paths
+    to the blob SHA (None: no file) the head must still have there.
+    Returns (commit sha, {path: blob sha}).
+    """
+    head = _branch_head(repo, branch, headers)
+    if expected_head and head != expected_head:
+        raise CommitError('Branch has moved since these changes were made', 409, head)
+    
+    paths = [change['path'] for change in changes] + [change['new_path'] for change in changes if 'new_path' in change]
+    tree_sha, base = _base_entries(repo, head, paths, headers)
+    
+    # Upload all new content once, up front - blobs don't depend on the base commit
+    writes = [i for i, change in enumerate(changes) if change['op'] in ('create', 'update')]
+    pending = [(i, lambda change=changes[i]: change['content']) for i in writes if 'sha' not in changes[i]]
+    blob_shas = {i: changes[i]['sha'] for i in writes if 'sha' in changes[i]}
+    if pending:
+        blob_shas.update(upload_blobs(repo, headers, pending, {sha for mode, sha in base.values()}))
+    
+    for attempt in range(max_attempts):
+        # Recomputed against each new head: the branch must still hold what the changes were based on
+        current = {path: base[path][1] if path in base else None for path in expected_blobs or {}}
+        conflicts = {path: sha for path, sha in current.items() if sha != expected_blobs[path]}
+        if conflicts:
+            raise CommitError(f"Changed on the branch: {', '.join(sorted(conflicts))}", 409, head, conflicts)
         
-        # 2. Get current branch SHA
-        ref_res = requests.get(f'https://api.github.com/repos/{repo}/git/ref/heads/{branch}', headers=headers)
-        base_sha = ref_res.json()['object']['sha']
+        # Apply the operations in order, then send only the difference from the base tree
+        state = dict(base)
+        for i, change in enumerate(changes):
+            path = change['path']
+            if change['op'] in ('create', 'update'):
+                mode = state[path][0] if path in state else '100644'
+                state[path] = (mode, blob_shas[i])
+            elif path not in state:
+                raise CommitError(f'File not found: {path}', 404)
+            elif change['op'] == 'delete':
+                del state[path]
+            elif change['op'] == 'rename':
+                # Renames reuse the existing blob - nothing is uploaded
+                state[change['new_path']] = state.pop(path)
+            else:
+                raise CommitError(f"Unknown operation: {change['op']}", 400)
         
-        # 3. Create Blobs for each file
         tree_items = []
-        files_processed = 0
+        files = {}
+        for path, (mode, sha) in state.items():
+            if base.get(path) != (mode, sha):
+                tree_items.append({'path': path, 'mode': mode, 'type': 'blob', 'sha': sha})
+                files[path] = sha
+        for path, (mode, sha) in base.items():
+            if path not in state:
+                tree_items.append({'path': path, 'mode': mode, 'type': 'blob', 'sha': None})
         
-        for file_info in z.infolist():
-            if file_info.is_dir():
-                continue
-                
-            with z.open(file_info) as f:
-                content = f.read()
-                # Handle both text and binary files via base64
-                encoded_content = base64.b64encode(content).decode('utf-8')
-                
-                blob_res = requests.post(
-                    f'https://api.github.com/repos/{repo}/git/blobs',
-                    headers=headers,
-                    json={'content': encoded_content, 'encoding': 'base64'}
-                )
-                
-                if blob_res.status_code == 201:
-                    tree_items.append({
-                        "path": file_info.filename,
-                        "mode": "100644",
-                        "type": "blob",
-                        "sha": blob_res.json()['sha']
-                    })
-                    files_processed += 1
-
-        if not tree_items:
-            return jsonify({'error': 'No files found in zip'}), 400
-
-        # 4. Create a new Tree
-        tree_res = requests.post(
+        # Create a new Tree
+        tree_res = github.post(
             f'https://api.github.com/repos/{repo}/git/trees',
             headers=headers,
-            json={'base_tree': base_sha, 'tree': tree_items}
+            json={'base_tree': tree_sha, 'tree': tree_items}
         )
-        new_tree_sha = tree_res.json()['sha']
-
-        # 5. Create a Commit
-        commit_res = requests.post(
+        if tree_res.status_code != 201:
+            raise CommitError(f'Failed to create tree: {tree_res.text}', tree_res.status_code)
+        
+        # Create a Commit
+        commit_res = github.post(
             f'https://api.github.com/repos/{repo}/git/commits',
             headers=headers,
-            json={
-                'message': f'Upload zip archive ({files_processed} files) - {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}',
-                'tree': new_tree_sha,
-                'parents': [base_sha]
-            }
+            json={'message': message, 'tree': tree_res.json()['sha'], 'parents': [head]}
         )
+        if commit_res.status_code != 201:
+            raise CommitError(f'Failed to create commit: {commit_res.text}', commit_res.status_code)
         new_commit_sha = commit_res.json()['sha']
-
-        # 6. Update Reference
-        patch_res = requests.patch(
+        
+        # Update Reference - fast-forward only, so a concurrent push is never lost
+        patch_res = github.patch(
             f'https://api.github.com/repos/{repo}/git/refs/heads/{branch}',
             headers=headers,
-            json={'sha': new_commit_sha}
+            json={'sha': new_commit_sha, 'force': False}
+        )
+        if patch_res.status_code == 200:
+            _ref_changed(repo, branch, new_commit_sha)
+            return new_commit_sha, files
+        if patch_res.status_code != 422 or expected_head:
+            raise CommitError(f'Failed to update branch: {patch_res.text}', 409 if patch_res.status_code == 422 else patch_res.status_code)
+        
+        head = _branch_head(repo, branch, headers)
+        tree_sha, base = _base_entries(repo, head, paths, headers)
+    
+    raise CommitError('Branch kept moving, giving up', 409, head)
+
+def _flush_saves(repo, branch, token, files, bases):
+    headers = {'Authorization': f"token {token}"}
+    changes = [{'op': 'update', 'path': path, 'content': content} for path, content in sorted(files.items())]
+    names = ', '.join(sorted(files)) if len(files) <= 3 else f'{len(files)} files'
+    try:
+        commit_sha, _ = commit_changes(repo, branch, headers, changes,
+                                       f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} ({names})", expected_blobs=bases)
+    except CommitError as e:
+        if e.conflicts:
+            raise SaveConflict(e.conflicts)
+        raise
+    return commit_sha
+
+save_buffer = SaveBuffer(SAVE_BUFFER_DIR, SAVE_FLUSH_INTERVAL, _flush_saves) if SAVE_BUFFER_ENABLED else None
+
+def _flush_pending(repo, branch):
+    # Without push access the write that follows fails anyway; the token must
+    # not become the one background flushes use
+    headers = {'Authorization': f"token {session['oauth_token']}"}
+    if SAVE_BUFFER_ENABLED and _can_push(repo, headers):
+        try:
+            save_buffer.flush(repo, branch, session['oauth_token'])
+        except SaveConflict:
+            pass  # held back and checked again when flushed, so nothing here can overwrite them
+
+@app.route('/api/save/flush', methods=['POST'])
+def flush_saves():
+    if 'oauth_token' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    # Beacons from the unload handler arrive as text/plain
+    data = request.get_json(force=True)
+    headers = {'Authorization': f"token {session['oauth_token']}"}
+    if not _can_push(data['repo'], headers):
+        return jsonify({'error': 'No push access to this repository'}), 403
+    if not SAVE_BUFFER_ENABLED:
+        return jsonify({'success': True, 'commit': None})
+    try:
+        commit_sha = save_buffer.flush(data['repo'], data['branch'], session['oauth_token'])
+    except SaveConflict as e:
+        return jsonify({'error': str(e), 'conflicts': sorted(e.conflicts)}), 409
+    except CommitError as e:
+        return jsonify({'error': str(e)}), e.status_code
+    return jsonify({'success': True, 'commit': commit_sha})
+
+@app.route('/api/save/pending/<path:repo>/<branch>')
+def get_pending_saves(repo, branch):
+    if 'oauth_token' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    headers = {'Authorization': f"token {session['oauth_token']}"}
+    access = _repo_access(repo, headers)
+    if access is None:
+        return jsonify({'error': 'Repository not found'}), 404
+    if not SAVE_BUFFER_ENABLED:
+        return jsonify({'files': {}, 'conflicts': [], 'oldest_pending_seconds': 0, 'next_flush_in_seconds': None})
+    # Lets this worker flush entries recovered from disk after a restart
+    if access == b'push':
+        save_buffer.remember_token(repo, branch, session['oauth_token'])
+    return jsonify(save_buffer.pending(repo, branch))
+
+@app.route('/api/batch', methods=['POST'])
+def batch_write():
+    if 'oauth_token' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    data = request.json
+    repo = data['repo']
+    branch = data['branch']
+    
+    headers = {'Authorization': f"token {session['oauth_token']}"}
+    
+    changes = []
+    for operation in data.get('operations', []):
+        change = {'op': operation['op'], 'path': operation['path']}
+        if operation['op'] in ('create', 'update'):
+            if operation.get('encoding') == 'base64':
+                change['content'] = base64.b64decode(operation['content'])
+            else:
+                change['content'] = operation.get('content', '').encode('utf-8')
+        elif operation['op'] == 'rename':
+            change['new_path'] = operation['new_path']
+        changes.append(change)
+    
+    if not changes:
+        return jsonify({'error': 'No operations'}), 400
+    
+    commit_message = data.get('message') or datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    
+    try:
+        # Commit buffered saves first so they can't land on top of this change
+        _flush_pending(repo, branch)
+        commit_sha, files = commit_changes(repo, branch, headers, changes, commit_message,
+                                           expected_head=data.get('base_commit'))
+    except CommitError as e:
+        return jsonify({'error': str(e), 'head': e.head}), e.status_code
+    
+    return jsonify({'success': True, 'commit': commit_sha, 'files': files})
+
+@app.route('/api/upload-zip', methods=['POST'])
+def upload_zip():
+    if 'oauth_token' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    if 'file' in request.files:
+        # Multipart upload - werkzeug spools the body to a temporary file as it
+        # arrives, and members are read from it one at a time below
+        repo = request.form['repo']
+        branch = request.form['branch']
+        archive = request.files['file'].stream
+    else:
+        data = request.json
+        repo = data['repo']
+        branch = data['branch']
+        archive = io.BytesIO(base64.b64decode(data['zip_data']))
+    
+    headers = {'Authorization': f"token {session['oauth_token']}"}
+    
+    try:
+        z = zipfile.ZipFile(archive)
+        members = [file_info for file_info in z.infolist() if not file_info.is_dir()]
+
+        if not members:
+            return jsonify({'error': 'No files found in zip'}), 400
+
+        # Commit buffered saves first so they can't land on top of the upload
+        _flush_pending(repo, branch)
+
+        # Fan the blobs out over the upload pool, skipping content the branch already has
+        head = _branch_head(repo, branch, headers)
+        _, base = _base_entries(repo, head, [file_info.filename for file_info in members], headers)
+        blob_shas = upload_blobs(
+            repo, headers,
+            [(file_info.filename, lambda file_info=file_info: z.read(file_info)) for file_info in members],
+            {sha for mode, sha in base.values()}
         )
 
-        return jsonify({'success': True, 'files_count': files_processed})
+        # The tree is only built once every blob has landed
+        changes = [{'op': 'create', 'path': path, 'sha': sha} for path, sha in blob_shas.items()]
+        commit_changes(
+            repo, branch, headers, changes,
+            f'Upload zip archive ({len(changes)} files) - {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}'
+        )
+
+        return jsonify({'success': True, 'files_count': len(changes)})
 
+    except CommitError as e:
+        return jsonify({'error': str(e)}), e.status_code
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -489,15 +1631,72 @@ def download_repo(repo, branch):
     url = f'https://github.com/{repo}/archive/refs/heads/{branch}.zip'
     return jsonify({'url': url})
 
+def _timeline_entry(commit):
+    # (timestamp, sha, author name, author email, subject) for the commit index
+    author = commit['commit']['author']
+    timestamp = datetime.fromisoformat(author['date'].replace('Z', '+00:00')).timestamp()
+    return (int(timestamp), commit['sha'], author['name'], author['email'], commit['commit']['message'].split('\n', 1)[0])
+
+def _commit_timeline(repo, branch, headers):
+    """The branch's commit timeline, brought up to date with its current head.
+    
+    Returns None if the branch can't be read with these credentials.
+    """
+    return run(_commit_timeline_steps(repo, branch, headers), github)
+
+def _commit_timeline_steps(repo, branch, headers):
+    head = yield from _branch_sha_steps(repo, branch, headers)
+    if not head:
+        return None
+    
+    # The index update waits on a per-branch flock; fetch only runs GitHub reads
+    def update(run_read):
+        return commit_index.update(repo, branch, head, lambda timeline: run_read(_new_commits_steps(repo, head, timeline, headers)))
+    
+    return (yield Call(update, reads=True))
+
+def _new_commits_steps(repo, head, timeline, headers):
+    # Usually just the commits pushed since the last lookup
+    if timeline is not None and timeline.head:
+        compare = yield Get(f'https://api.github.com/repos/{repo}/compare/{timeline.head}...{head}', headers)
+        if compare.status_code == 200:
+            data = compare.json()
+            if data['status'] == 'ahead' and data['ahead_by'] == len(data['commits']):
+                return [_timeline_entry(commit) for commit in data['commits']], False, timeline.complete
+    
+    # First lookup, force-push or a big jump - list the whole history
+    commits = []
+    for page in range(1, COMMIT_INDEX_MAX_PAGES + 1):
+        response = yield Get(f'https://api.github.com/repos/{repo}/commits?sha={head}&per_page=100&page={page}', headers)
+        if response.status_code != 200:
+            raise Exception(f'Could not list commits: {response.status_code}')
+        batch = response.json()
+        commits += [_timeline_entry(commit) for commit in batch]
+        if len(batch) < 100:
+            return commits, True, True
+    return commits, True, False
+
 @app.route('/api/commits/<path:repo>/<branch>')
 def get_commits(repo, branch):
     if 'oauth_token' not in session:
         return jsonify({'error': 'Not authenticated'}), 401
     
-    per_page = request.args.get('per_page', 50)
+    paging = _page_args(request.args)
+    if paging is None:
+        return jsonify({'error': 'page and per_page must be integers'}), 400
+    page, per_page = paging
+    # order=asc pages from the oldest commit, e.g. to find when the repo started
+    ascending = request.args.get('order') == 'asc'
     headers = {'Authorization': f"token {session['oauth_token']}"}
-    response = requests.get(f'https://api.github.com/repos/{repo}/commits?sha={branch}&per_page={per_page}', headers=headers)
-    return jsonify(response.json())
+    
+    try:
+        timeline = _commit_timeline(repo, branch, headers)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 502
+    if timeline is None:
+        return jsonify({'error': 'Branch not found'}), 404
+    
+    return jsonify([timeline.commit(i) for i in timeline.page(page, per_page, ascending)])
 
 @app.route('/api/delete', methods=['POST'])
 def delete_file():
@@ -506,6 +1705,14 @@ def delete_file():
     
     data = request.json
     headers = {'Authorization': f"token {session['oauth_token']}"}
+    repo = data['repo']
+    branch = data['branch']
+    
+    # Commit buffered saves first so they can't land on top of this change
+    try:
+        _flush_pending(repo, branch)
+    except Exception as e:
+        return jsonify({'error': f'Could not flush pending saves: {e}'}), 502
     
     # GitHub requires the file SHA to delete it
     payload = {
@@ -515,9 +1722,10 @@ def delete_file():
     }
     
     url = f"https://api.github.com/repos/{data['repo']}/contents/{data['filepath']}"
-    response = requests.delete(url, headers=headers, json=payload)
+    response = github.delete(url, headers=headers, json=payload)
     
     if response.status_code == 200:
+        _ref_changed(repo, branch, response.json()['commit']['sha'])
         return jsonify({'success': True})
     return jsonify({'error': response.json()}), response.status_code
 
@@ -531,30 +1739,21 @@ def rename_file():
     repo = data['repo']
     branch = data['branch']
     
-    # 1. Get the original file content
-    get_url = f"https://api.github.com/repos/{repo}/contents/{data['old_path']}?ref={branch}"
-    file_data = requests.get(get_url, headers=headers).json()
-    
-    # 2. Create the file at the new path
-    create_payload = {
-        'message': f"Rename {data['old_path']} to {data['new_path']}",
-        'content': file_data['content'],
-        'branch': branch
-    }
-    create_url = f"https://api.github.com/repos/{repo}/contents/{data['new_path']}"
-    create_res = requests.put(create_url, headers=headers, json=create_payload)
+    # Commit buffered saves first so they can't land on top of this change
+    try:
+        _flush_pending(repo, branch)
+    except Exception as e:
+        return jsonify({'error': f'Could not flush pending saves: {e}'}), 502
     
-    if create_res.status_code not in [200, 201]:
-        return jsonify({'error': 'Failed to create new file'}), 500
-
-    # 3. Delete the old file
-    delete_payload = {
-        'message': f"Cleanup after rename: {data['old_path']}",
-        'sha': data['sha'],
-        'branch': branch
-    }
-    delete_url = f"https://api.github.com/repos/{repo}/contents/{data['old_path']}"
-    requests.delete(delete_url, headers=headers, json=delete_payload)
+    # Move the existing blob to the new path in a single commit
+    try:
+        commit_changes(
+            repo, branch, headers,
+            [{'op': 'rename', 'path': data['old_path'], 'new_path': data['new_path']}],
+            f"Rename {data['old_path']} to {data['new_path']}"
+        )
+    except CommitError as e:
+        return jsonify({'error': str(e)}), e.status_code
     
     return jsonify({'success': True})
 
@@ -563,27 +1762,23 @@ def get_commit_at_time(repo, branch, timestamp):
     if 'oauth_token' not in session:
         return jsonify({'error': 'Not authenticated'}), 401
     
-    from datetime import datetime as dt
-    
     headers = {'Authorization': f"token {session['oauth_token']}"}
     
     # Get commits until the specified timestamp
-    target_time = dt.fromisoformat(timestamp.replace('Z', '+00:00'))
-    
-    # Fetch commits (GitHub API returns newest first)
-    response = requests.get(f'https://api.github.com/repos/{repo}/commits?sha={branch}&per_page=100', headers=headers)
-    commits = response.json()
-    
-    # Find the first commit that's before or at the target time
-    selected_commit = None
-    for commit in commits:
-        commit_time = dt.fromisoformat(commit['commit']['author']['date'].replace('Z', '+00:00'))
-        if commit_time <= target_time:
-            selected_commit = commit
-            break
-    
-    if selected_commit:
-        return jsonify({'commit': selected_commit})
+    target_time = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+    
+    try:
+        timeline = _commit_timeline(repo, branch, headers)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 502
+    if timeline is None:
+        return jsonify({'error': 'Branch not found'}), 404
+    
+    # Newest commit at or before the target time - a binary search on the index
+    selected = timeline.at(int(target_time.timestamp()))
+    
+    if selected is not None:
+        return jsonify({'commit': timeline.commit(selected)})
     else:
         return jsonify({'error': 'No commits found before this time'}), 404
 
@@ -593,18 +1788,20 @@ def get_tree_at_commit(repo, commit_sha):
         return jsonify({'error': 'Not authenticated'}), 401
     
     headers = {'Authorization': f"token {session['oauth_token']}"}
+    payload, status = run(_tree_at_commit_steps(repo, commit_sha, headers), github)
+    return jsonify(payload), status
+
+def _tree_at_commit_steps(repo, commit_sha, headers):
+    if (yield from _repo_access_steps(repo, headers)) is None:
+        return {'error': 'Repository not found'}, 404
     
     # Get commit
-    commit_response = requests.get(f'https://api.github.com/repos/{repo}/git/commits/{commit_sha}', headers=headers)
-    if commit_response.status_code != 200:
-        return jsonify({'error': 'Commit not found'}), 404
-    
-    tree_sha = commit_response.json()['tree']['sha']
+    tree_sha = yield from _commit_tree_sha_steps(repo, commit_sha, headers)
+    if not tree_sha:
+        return {'error': 'Commit not found'}, 404
     
     # Get recursive tree
-    tree_response = requests.get(f'https://api.github.com/repos/{repo}/git/trees/{tree_sha}?recursive=1', headers=headers)
-    return jsonify(tree_response.json())
-        
+    return (yield from _recursive_tree_steps(repo, tree_sha, headers))
 
 @app.route('/api/file-at-commit', methods=['POST'])
 def get_file_at_commit():
@@ -617,26 +1814,16 @@ def get_file_at_commit():
     filepath = data['filepath']
     
     headers = {'Authorization': f"token {session['oauth_token']}"}
-    response = requests.get(f'https://api.github.com/repos/{repo}/contents/{filepath}?ref={commit}', headers=headers)
-    
-    if response.status_code != 200:
-        return jsonify({'error': 'File not found'}), 404
-    
-    file_data = response.json()
-    
-    # Decode content if it's a file
-    if file_data.get('type') == 'file' and 'content' in file_data:
-        try:
-            content = base64.b64decode(file_data['content']).decode('utf-8')
-            return jsonify({'content': content, 'sha': file_data['sha'], 'type': 'text'})
-        except UnicodeDecodeError:
-            # Binary file - return base64 as-is
-            return jsonify({'content': file_data['content'], 'sha': file_data['sha'], 'type': 'binary'})
+    if not _can_read(repo, headers):
+        return jsonify({'error': 'Repository not found'}), 404
     
-    return jsonify(file_data)
+    payload, status = run(_file_steps(repo, commit, filepath, headers), github)
+    return jsonify(payload), status
 
 @app.route('/logout')
 def logout():
+    if 'oauth_token' in session and SAVE_BUFFER_ENABLED:
+        save_buffer.flush_token(session['oauth_token'])
     session.clear()
     return redirect(url_for('login'))
 
@@ -0,0 +1,234 @@
+import os
+import re
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+import subprocess
+
+import metrics
+from governor import Governor
+from node_files import FileLock, write_atomically, remove, lru_files, evict_lru
+
+BEGIN_DOCUMENT_PATTERN = re.compile(r'^[^%\n]*?\\begin\s*\{document\}', re.MULTILINE)
+MAX_VARIANTS = 4
+FAILED_RETRY_SECONDS = 3600
+
+
+class FormatCache:
+    """Precompiled preamble formats (.fmt) shared by all compiles on the node.
+
+    A project's preamble - everything before \\begin{document} - is dumped once
+    with mylatexformat and later passes load the format instead of re-reading
+    every package. Formats are keyed by the preamble text and the engine
+    version, so editing the preamble picks a new format. Local files read while
+    dumping (macros.sty, \\input'ed definitions) are recorded with their hashes;
+    a format is only used while those files are unchanged. Dumps run under
+    governor's limits, as part of the compile that asked for the format.
+    """
+
+    def __init__(self, root, max_bytes, governor=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.governor = governor or Governor()
+        self.hits = 0
+        self.builds = 0
+        self.failures = 0
+        self._versions = {}  # engine -> version banner
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def format_for(self, working_dir, file_name, engine, env, progress=None):
+        """Absolute path of a format for file_name's preamble, building it if needed.
+
+        Returns None when the file has no preamble worth dumping or the dump
+        fails - callers then compile the normal way.
+        """
+        try:
+            with open(os.path.join(working_dir, file_name), encoding='utf-8', errors='replace') as f:
+                source = f.read()
+        except OSError:
+            return None
+        match = BEGIN_DOCUMENT_PATTERN.search(source)
+        version = self._engine_version(engine, env)
+        if not match or not version:
+            return None
+        key = hashlib.sha256(f'{engine}\0{version}\0{source[:match.start()]}'.encode('utf-8')).hexdigest()[:32]
+
+        with self._locked(key):
+            manifest = self._read_manifest(key)
+            for variant in manifest['variants']:
+                path = self._fmt_path(key, variant['digest'])
+                if os.path.exists(path) and _files_match(working_dir, variant['files']):
+                    os.utime(path)  # mtime doubles as last-used time for LRU
+                    with self._lock:
+                        self.hits += 1
+                    return path
+
+            if time.time() - manifest.get('failed_at', 0) < FAILED_RETRY_SECONDS:
+                return None
+            if progress:
+                progress('format')
+            with metrics.span('compile_phase', phase='format'):
+                path = self._dump(key, manifest, working_dir, file_name, engine, env)
+
+        if path:
+            self._evict()
+        return path
+
+    def reject(self, path):
+        """Stop using a format that broke a compile; its preamble is compiled normally for a while."""
+        key, digest = os.path.basename(path)[:-len('.fmt')].split('-', 1)
+        with self._locked(key):
+            manifest = self._read_manifest(key)
+            manifest['variants'] = [v for v in manifest['variants'] if v['digest'] != digest]
+            manifest['failed_at'] = time.time()
+            self._write_manifest(key, manifest)
+            remove(path)
+        with self._lock:
+            self.failures += 1
+
+    def _dump(self, key, manifest, working_dir, file_name, engine, env):
+        build_dir = tempfile.mkdtemp(dir=self.root, prefix='dump-')
+        try:
+            result = self.governor.run(
+                [engine, '-ini', '-interaction=nonstopmode', '-recorder', f'-output-directory={build_dir}',
+                 f'-jobname={key}', f'&{engine}', 'mylatexformat.ltx', file_name],
+                cwd=working_dir,
+                env=env
+            )
+            dumped = os.path.join(build_dir, key + '.fmt')
+            if not os.path.exists(dumped):
+                print(f'Format dump failed for {file_name}: {result.stdout[-500:]}')
+                manifest['failed_at'] = time.time()
+                self._write_manifest(key, manifest)
+                with self._lock:
+                    self.failures += 1
+                return None
+
+            files = _local_inputs(os.path.join(build_dir, key + '.fls'), working_dir, file_name)
+            digest = hashlib.sha256(json.dumps(files, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+            path = self._fmt_path(key, digest)
+            os.replace(dumped, path)
+
+            # Same preamble with different local files (e.g. two projects sharing
+            # a template) keeps a few variants side by side
+            variants = [v for v in manifest['variants'] if v['digest'] != digest]
+            variants.insert(0, {'digest': digest, 'files': files})
+            for stale in variants[MAX_VARIANTS:]:
+                remove(self._fmt_path(key, stale['digest']))
+            self._write_manifest(key, {'variants': variants[:MAX_VARIANTS]})
+            with self._lock:
+                self.builds += 1
+            return path
+        finally:
+            shutil.rmtree(build_dir, ignore_errors=True)
+
+    def _engine_version(self, engine, env):
+        with self._lock:
+            version = self._versions.get(engine)
+        if version is None:
+            try:
+                result = subprocess.run([engine, '--version'], capture_output=True, text=True, env=env)
+                version = result.stdout.splitlines()[0] if result.returncode == 0 and result.stdout else ''
+            except OSError:
+                version = ''
+            with self._lock:
+                self._versions[engine] = version
+        return version
+
+    def _fmt_path(self, key, digest):
+        return os.path.join(self.root, f'{key}-{digest}.fmt')
+
+    def _manifest_path(self, key):
+        return os.path.join(self.root, key + '.json')
+
+    def _read_manifest(self, key):
+        try:
+            with open(self._manifest_path(key)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {'variants': []}
+
+    def _write_manifest(self, key, manifest):
+        write_atomically(self._manifest_path(key), json.dumps(manifest).encode('utf-8'))
+
+    def _locked(self, key):
+        # So one format is dumped once across all workers; the file goes on release
+        return FileLock(os.path.join(self.root, key + '.lock'), remove=True)
+
+    def _evict(self):
+        # A format still being loaded stays readable after unlink; its
+        # manifest entry is simply skipped once the file is gone
+        entries = lru_files(self.root, ('.fmt',))
+        removed = set(evict_lru(self.root, entries, self.max_bytes))
+        self._drop_manifests({name.split('-', 1)[0] for mtime, name, size in entries if name not in removed})
+
+    def _drop_manifests(self, live_keys):
+        # Manifests whose formats are all gone, once a failed dump may be retried
+        for name in os.listdir(self.root):
+            if not name.endswith('.json') or name[:-len('.json')] in live_keys:
+                continue
+            key = name[:-len('.json')]
+            lock = self._locked(key)
+            if not lock.acquire(blocking=False):
+                continue  # being looked up or dumped right now
+            try:
+                manifest = self._read_manifest(key)
+                if any(os.path.exists(self._fmt_path(key, v['digest'])) for v in manifest['variants']):
+                    continue
+                if time.time() - manifest.get('failed_at', 0) >= FAILED_RETRY_SECONDS:
+                    remove(self._manifest_path(key))
+            finally:
+                lock.release()
+
+    def stats(self):
+        entries = lru_files(self.root, ('.fmt',))
+        return {
+            'hits': self.hits,
+            'builds': self.builds,
+            'failures': self.failures,
+            'entries': len(entries),
+            'bytes': sum(entry[2] for entry in entries),
+            'max_bytes': self.max_bytes,
+        }
+
+
+def _local_inputs(fls_path, working_dir, file_name):
+    """{relative path: sha256} of project files the dump read, from the -recorder log."""
+    files = {}
+    try:
+        with open(fls_path, encoding='utf-8', errors='replace') as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return files
+    for line in lines:
+        if not line.startswith('INPUT '):
+            continue
+        # TeX records project files relative to the working directory and
+        # files from the distribution's trees as absolute paths
+        path = os.path.normpath(os.path.join(working_dir, line[6:]))
+        if os.path.isabs(line[6:]) and not path.startswith(os.path.join(working_dir, '')):
+            continue
+        rel = os.path.relpath(path, working_dir)
+        # The main file's preamble is already part of the key
+        if rel == file_name or rel in files:
+            continue
+        digest = _file_hash(path)
+        if digest:
+            files[rel] = digest
+    return files
+
+
+def _files_match(working_dir, files):
+    return all(_file_hash(os.path.join(working_dir, rel)) == digest for rel, digest in files.items())
+
+
+def _file_hash(path):
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
@@ -0,0 +1,250 @@
+import time
+import hashlib
+import threading
+from collections import OrderedDict, namedtuple
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+try:
+    import httpx
+except ImportError:  # only needed by the async serving mode
+    httpx = None
+
+import metrics
+
+GITHUB_API = 'https://api.github.com'
+# Describe the body as sent, not the decoded bytes the cache keeps
+BODY_HEADERS = ('content-encoding', 'content-length', 'transfer-encoding')
+
+# What the ETag cache keeps of a response; size is what it counts against the budget
+CachedResponse = namedtuple('CachedResponse', 'etag last_modified status_code headers body size')
+
+
+class GitHubClient:
+    """Shared, pooled client for api.github.com with an ETag response cache.
+
+    Call sites keep the requests-style signature (full api.github.com URL plus
+    an Authorization header). GETs are revalidated with If-None-Match; GitHub
+    answers an unchanged resource with 304, which is served from the cache and
+    does not count against the rate limit. Only the status, headers and body
+    of cached responses are kept, least recently used first out once they
+    add up to more than cache_max_bytes. base_url points the client at a
+    local stub server instead of GitHub.
+    """
+
+    def __init__(self, base_url=GITHUB_API, pool_size=100, cache_max_bytes=32 * 1024 ** 2, cache_max_body=1024 * 1024):
+        self.base_url = base_url.rstrip('/')
+        self.cache_max_bytes = cache_max_bytes
+        self.cache_max_body = cache_max_body
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._cache = OrderedDict()  # (token hash, url, ...) -> CachedResponse
+        self._cache_bytes = 0
+        self._lock = threading.Lock()
+        self._endpoints = {}   # endpoint -> counters
+        self._rate_limits = {}  # token hash -> (remaining, limit, reset)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.request('PATCH', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    def request(self, method, url, headers=None, **kwargs):
+        url, headers, cache = self._prepare(method, url, headers, kwargs)
+        start = time.monotonic()
+        try:
+            response = self.session.request(method, url, headers=headers, **kwargs)
+        except requests.RequestException:
+            self._record(method, url, time.monotonic() - start, 'error')
+            raise
+        return self._complete(method, url, time.monotonic() - start, response, cache)
+
+    def _prepare(self, method, url, headers, kwargs):
+        # Rewrites the URL and adds revalidation headers for a cached response
+        if url.startswith(GITHUB_API):
+            url = self.base_url + url[len(GITHUB_API):]
+        headers = dict(headers or {})
+        token_key = _token_key(headers.get('Authorization', ''))
+
+        # Streamed responses can't be replayed from the cache
+        cacheable = method == 'GET' and not kwargs.get('stream')
+        cache_key = (token_key, url, kwargs.get('params') and repr(sorted(kwargs['params'].items())),
+                     headers.get('Accept'))
+        cached = None
+        if cacheable:
+            with self._lock:
+                cached = self._cache.get(cache_key)
+                if cached:
+                    self._cache.move_to_end(cache_key)
+            if cached:
+                if cached.etag:
+                    headers['If-None-Match'] = cached.etag
+                if cached.last_modified:
+                    headers['If-Modified-Since'] = cached.last_modified
+        return url, headers, (token_key, cache_key, cacheable, cached)
+
+    def _complete(self, method, url, elapsed, response, cache):
+        token_key, cache_key, cacheable, cached = cache
+        self._record_rate_limit(token_key, response)
+
+        if cached and response.status_code == 304:
+            self._record(method, url, elapsed, 'not_modified')
+            return self._replay(cached, url)
+
+        self._record(method, url, elapsed, response.status_code)
+
+        if cacheable and response.status_code == 200:
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
+            if (etag or last_modified) and len(response.content) <= self.cache_max_body:
+                self._store(cache_key, etag, last_modified, response)
+        return response
+
+    def _store(self, cache_key, etag, last_modified, response):
+        headers = [(name, value) for name, value in response.headers.items() if name.lower() not in BODY_HEADERS]
+        size = len(response.content) + sum(len(name) + len(value) for name, value in headers)
+        with self._lock:
+            replaced = self._cache.pop(cache_key, None)
+            if replaced:
+                self._cache_bytes -= replaced.size
+            self._cache[cache_key] = CachedResponse(etag, last_modified, response.status_code, headers,
+                                                    response.content, size)
+            self._cache_bytes += size
+            while self._cache_bytes > self.cache_max_bytes:
+                _, evicted = self._cache.popitem(last=False)
+                self._cache_bytes -= evicted.size
+
+    def _replay(self, cached, url):
+        # A fresh response per caller, so none of them share a consumed or mutated object
+        response = requests.Response()
+        response.status_code = cached.status_code
+        response.headers = CaseInsensitiveDict(cached.headers)
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.url = url
+        response._content = cached.body
+        return response
+
+    def _record(self, method, url, elapsed, status):
+        metrics.record('github_request', elapsed, method=method, endpoint=_endpoint(url), status=status)
+        endpoint = f'{method} {_endpoint(url)}'
+        with self._lock:
+            stats = self._endpoints.get(endpoint)
+            if stats is None:
+                stats = self._endpoints[endpoint] = {
+                    'count': 0, 'total_seconds': 0.0, 'max_seconds': 0.0, 'not_modified': 0, 'errors': 0,
+                }
+            stats['count'] += 1
+            stats['total_seconds'] += elapsed
+            stats['max_seconds'] = max(stats['max_seconds'], elapsed)
+            if status == 'not_modified':
+                stats['not_modified'] += 1
+            elif status == 'error' or status >= 400:
+                stats['errors'] += 1
+
+    def _record_rate_limit(self, token_key, response):
+        remaining = response.headers.get('X-RateLimit-Remaining')
+        if remaining is None:
+            return
+        with self._lock:
+            self._rate_limits[token_key] = (
+                int(remaining),
+                int(response.headers.get('X-RateLimit-Limit', 0)),
+                int(response.headers.get('X-RateLimit-Reset', 0)),
+            )
+
+    def stats(self):
+        with self._lock:
+            endpoints = {}
+            for endpoint, stats in self._endpoints.items():
+                endpoints[endpoint] = dict(stats, avg_seconds=stats['total_seconds'] / stats['count'])
+            remaining = [limits[0] for limits in self._rate_limits.values()]
+            return {
+                'endpoints': endpoints,
+                'cache_entries': len(self._cache),
+                'cache_bytes': self._cache_bytes,
+                'cache_max_bytes': self.cache_max_bytes,
+                'rate_limit': {
+                    'tokens': len(remaining),
+                    'min_remaining': min(remaining) if remaining else None,
+                },
+            }
+
+    def rate_limit(self, authorization):
+        """(remaining, limit, reset) last seen for the token in an Authorization header."""
+        with self._lock:
+            return self._rate_limits.get(_token_key(authorization))
+
+
+class AsyncGitHubClient(GitHubClient):
+    """GitHubClient for asyncio code, on one pooled httpx.AsyncClient.
+
+    Shares the endpoint stats and rate limits of sync_client, so both serving
+    paths report together. The ETag cache is its own, with the same byte
+    budget, and replays cached entries as httpx responses.
+    """
+
+    def __init__(self, sync_client, pool_size=1000, timeout=60):
+        if httpx is None:
+            raise RuntimeError('The async serving mode needs httpx (pip install httpx)')
+        self.base_url = sync_client.base_url
+        self.cache_max_bytes = sync_client.cache_max_bytes
+        self.cache_max_body = sync_client.cache_max_body
+        self._cache = OrderedDict()
+        self._cache_bytes = 0
+        self._lock = sync_client._lock
+        self._endpoints = sync_client._endpoints
+        self._rate_limits = sync_client._rate_limits
+        # Thousands of sessions share these connections instead of a thread each
+        self.session = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            timeout=timeout,
+        )
+
+    async def request(self, method, url, headers=None, **kwargs):
+        url, headers, cache = self._prepare(method, url, headers, kwargs)
+        start = time.monotonic()
+        try:
+            response = await self.session.request(method, url, headers=headers, **kwargs)
+        except httpx.HTTPError:
+            self._record(method, url, time.monotonic() - start, 'error')
+            raise
+        return self._complete(method, url, time.monotonic() - start, response, cache)
+
+    def _replay(self, cached, url):
+        return httpx.Response(cached.status_code, headers=cached.headers, content=cached.body,
+                              request=httpx.Request('GET', url))
+
+    async def aclose(self):
+        await self.session.aclose()
+
+
+def _token_key(authorization):
+    # Never keep raw tokens as dict keys
+    return hashlib.sha256(authorization.encode('utf-8')).hexdigest()[:16]
+
+
+def _endpoint(url):
+    # Collapse owner/repo and object ids so metrics stay low-cardinality:
+    # /repos/a/b/git/trees/<sha> -> /repos/:repo/git/trees
+    parts = [part for part in urlsplit(url).path.split('/') if part]
+    if parts[:1] == ['repos'] and len(parts) >= 3:
+        rest = parts[3:]
+        keep = 2 if rest[:1] == ['git'] else 1
+        return '/' + '/'.join(['repos', ':repo'] + rest[:keep])
+    return '/' + '/'.join(parts)
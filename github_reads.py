@@ -0,0 +1,65 @@
+import asyncio
+from collections import namedtuple
+from functools import partial
+
+# The steps a read yields. A read is a generator written once for both
+# serving modes; run() or run_async() carries out each step and sends its
+# result back in.
+
+# A GitHub GET; the result is the response
+Get = namedtuple('Get', 'url headers')
+# The value cached under key (a tuple of cache.get's arguments), filled by
+# the read fill() on a miss; the result is the value, or None if fill()
+# returned None (which is not cached)
+Fill = namedtuple('Fill', 'cache key fill options', defaults=({},))
+# fn(*args), for work that blocks on local disk or a streamed download.
+# With reads=True fn gets a first argument that runs a read to completion
+# from the thread fn is on; such reads should only Get, since in the async
+# mode any disk work of theirs would wait for the same pool
+Call = namedtuple('Call', 'fn args reads', defaults=((), False))
+
+
+def run(read, github):
+    """Carry out read on this thread with the requests-based client and return its result."""
+    result = None
+    while True:
+        try:
+            step = read.send(result)
+        except StopIteration as stop:
+            return stop.value
+        if isinstance(step, Get):
+            result = github.get(step.url, headers=step.headers)
+        elif isinstance(step, Fill):
+            # Only one worker on the node fills a key at a time
+            result = step.cache.get_or_fill(*step.key, lambda: run(step.fill(), github), **step.options)
+        elif step.reads:
+            result = step.fn(lambda inner: run(inner, github), *step.args)
+        else:
+            result = step.fn(*step.args)
+
+
+async def run_async(read, github, executor):
+    """Carry out read on the event loop with the httpx client; disk work goes to executor."""
+    loop = asyncio.get_running_loop()
+    result = None
+    while True:
+        try:
+            step = read.send(result)
+        except StopIteration as stop:
+            return stop.value
+        if isinstance(step, Get):
+            result = await github.get(step.url, headers=step.headers)
+        elif isinstance(step, Fill):
+            # No single-flight: waiting on another worker's fill would hold a thread
+            result = await loop.run_in_executor(executor, partial(step.cache.get, *step.key))
+            if result is None:
+                result = await run_async(step.fill(), github, executor)
+                if result is not None:
+                    await loop.run_in_executor(executor, partial(step.cache.put, *step.key, result, **step.options))
+        elif step.reads:
+            # Reads started from the pool thread still use the loop's client
+            def drive(inner):
+                return asyncio.run_coroutine_threadsafe(run_async(inner, github, executor), loop).result()
+            result = await loop.run_in_executor(executor, partial(step.fn, drive, *step.args))
+        else:
+            result = await loop.run_in_executor(executor, partial(step.fn, *step.args))
@@ -0,0 +1,341 @@
+import os
+import re
+import sys
+import json
+import math
+import time
+import signal
+import tempfile
+import threading
+import subprocess
+from collections import Counter
+from contextlib import contextmanager
+
+import metrics
+
+try:
+    import resource
+except ImportError:  # Windows - wall-clock limit only
+    resource = None
+
+POLL_SECONDS = 0.5
+HEAVIEST_JOBS = 20
+# How TeX, BibTeX and pandoc report a failed allocation, or a write past the
+# file size limit when they don't die of SIGXFSZ
+MEMORY_PATTERN = re.compile(r'memory exhausted|out of memory|cannot allocate memory|bad_alloc', re.IGNORECASE)
+OUTPUT_PATTERN = re.compile(r'file too large', re.IGNORECASE)
+
+
+class GovernedProcess(subprocess.CompletedProcess):
+    """CompletedProcess of a governed run.
+
+    limit names the limit the run was stopped for ('cpu', 'memory', 'output',
+    'processes' or 'wall'), or is None; usage holds its cpu_seconds,
+    max_rss_bytes and wall_seconds.
+    """
+
+    def __init__(self, args, returncode, stdout, stderr, limit=None, usage=None):
+        super().__init__(args, returncode, stdout, stderr)
+        self.limit = limit
+        self.usage = usage or {}
+
+
+class Governor:
+    """Runs compile processes (TeX, BibTeX, biber, pandoc) under resource limits.
+
+    Each process starts in a session of its own with rlimits on CPU time,
+    address space and the size of the files it writes. The governor watches
+    the wall clock and the number of processes in the session; past either
+    budget the whole group gets TERM and, kill_grace seconds later, KILL.
+    Inside job() the CPU and wall-clock budgets cover all runs of one
+    compile together, and the job's usage is recorded when it ends. A limit
+    of None is not enforced.
+    """
+
+    def __init__(self, cpu_seconds=None, memory_bytes=None, output_bytes=None, max_processes=None,
+                 wall_seconds=None, kill_grace=5, usage_log=None):
+        self.cpu_seconds = cpu_seconds
+        self.memory_bytes = memory_bytes
+        self.output_bytes = output_bytes
+        self.max_processes = max_processes
+        self.wall_seconds = wall_seconds
+        self.kill_grace = kill_grace
+        self.usage_log = usage_log
+        self.jobs = 0
+        self.runs = 0
+        self.limits = {}  # limit name -> times hit
+        self.cpu_total = 0.0
+        self.max_rss_bytes = 0
+        self._heaviest = []  # usage of the jobs with the most CPU time, heaviest first
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def job(self, **labels):
+        """Share one set of budgets between the runs in the block; labels go into the usage record."""
+        job = _Job(labels, time.monotonic())
+        self._local.job = job
+        try:
+            yield job
+        finally:
+            self._local.job = None
+            self._record(job)
+
+    def run(self, cmd, cwd=None, env=None):
+        """Run cmd to completion within the limits and return a GovernedProcess (text output)."""
+        job = getattr(self._local, 'job', None)
+        wall = self.wall_seconds
+        cpu = self.cpu_seconds
+        if job is not None:
+            if wall:
+                wall -= time.monotonic() - job.started
+            if cpu:
+                cpu -= job.cpu_seconds
+        if (wall is not None and wall <= 0) or (cpu is not None and cpu <= 0):
+            result = GovernedProcess(cmd, 1, '', '', limit='wall' if wall is not None and wall <= 0 else 'cpu')
+        elif resource is None:
+            result = self._run_unlimited(cmd, cwd, env, wall)
+        else:
+            result = self._run_limited(cmd, cwd, env, wall, cpu)
+
+        with self._lock:
+            self.runs += 1
+        if job is not None:
+            job.add(result)
+        return result
+
+    def describe(self, limit):
+        """Message telling the user which limit stopped their compile."""
+        if limit == 'cpu':
+            return f'it used more than {self.cpu_seconds} seconds of CPU time'
+        if limit == 'memory':
+            return f'it needed more than {self.memory_bytes // 1024 ** 2} MB of memory'
+        if limit == 'output':
+            return f'it wrote a file larger than {self.output_bytes // 1024 ** 2} MB'
+        if limit == 'processes':
+            return f'it started more than {self.max_processes} processes'
+        return f'it ran for more than {self.wall_seconds} seconds'
+
+    def _run_limited(self, cmd, cwd, env, wall, cpu):
+        started = time.monotonic()
+        with tempfile.TemporaryFile() as out, tempfile.TemporaryFile() as err:
+            # The child sets its limits before exec, so nothing it starts runs without them
+            limits = self._rlimits(cpu)
+            proc = subprocess.Popen(cmd, cwd=cwd, env=env, stdin=subprocess.DEVNULL, stdout=out, stderr=err,
+                                    start_new_session=True, preexec_fn=lambda: _apply_rlimits(limits))
+            status, rusage, limit = self._wait(proc, wall)
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            stdout, stderr = _read(out), _read(err)
+
+        usage = {
+            'cpu_seconds': rusage.ru_utime + rusage.ru_stime,
+            # ru_maxrss is in kilobytes, except on macOS
+            'max_rss_bytes': rusage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024),
+            'wall_seconds': time.monotonic() - started,
+        }
+        if limit is None and proc.returncode != 0:
+            messages = stderr[-2000:] + stdout[-2000:]
+            if proc.returncode == -signal.SIGXCPU or (cpu and usage['cpu_seconds'] >= cpu):
+                limit = 'cpu'
+            elif proc.returncode == -signal.SIGXFSZ or (self.output_bytes and OUTPUT_PATTERN.search(messages)):
+                limit = 'output'
+            elif self.memory_bytes and MEMORY_PATTERN.search(messages):
+                limit = 'memory'
+        return GovernedProcess(cmd, proc.returncode, stdout, stderr, limit, usage)
+
+    def _rlimits(self, cpu):
+        limits = []
+        if cpu:
+            # The soft limit sends SIGXCPU; the hard one, kill_grace later, SIGKILL
+            seconds = math.ceil(cpu)
+            limits.append((resource.RLIMIT_CPU, (seconds, seconds + self.kill_grace)))
+        if self.memory_bytes:
+            limits.append((resource.RLIMIT_AS, (self.memory_bytes, self.memory_bytes)))
+        if self.output_bytes:
+            limits.append((resource.RLIMIT_FSIZE, (self.output_bytes, self.output_bytes)))
+        return limits
+
+    def _wait(self, proc, wall):
+        # A thread of its own waits for the exit while this one watches the
+        # budgets. It leaves the child a zombie, so its pid - the group id -
+        # can't be reused before the group is killed and the child reaped
+        def wait_exit():
+            os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOWAIT)
+
+        waiter = threading.Thread(target=wait_exit, name='governor-wait', daemon=True)
+        waiter.start()
+        deadline = time.monotonic() + wall if wall else None
+        limit = None
+        while limit is None:
+            timeout = POLL_SECONDS if deadline is None else min(POLL_SECONDS, max(deadline - time.monotonic(), 0))
+            waiter.join(timeout)
+            if not waiter.is_alive():
+                break
+            if deadline is not None and time.monotonic() >= deadline:
+                limit = 'wall'
+            elif self.max_processes and _groups.size(proc.pid) > self.max_processes:
+                limit = 'processes'
+        if limit:
+            _signal_group(proc.pid, signal.SIGTERM)
+            waiter.join(self.kill_grace)
+            if waiter.is_alive():
+                _signal_group(proc.pid, signal.SIGKILL)
+        waiter.join()
+        # Whatever the build left running in the background goes with it
+        _signal_group(proc.pid, signal.SIGKILL)
+        # Reaped with wait4 for the child's rusage
+        _, status, rusage = os.wait4(proc.pid, 0)
+        return status, rusage, limit
+
+    def _run_unlimited(self, cmd, cwd, env, wall):
+        started = time.monotonic()
+        try:
+            result = subprocess.run(cmd, cwd=cwd, env=env, stdin=subprocess.DEVNULL, capture_output=True, timeout=wall)
+            returncode, stdout, stderr, limit = result.returncode, result.stdout, result.stderr, None
+        except subprocess.TimeoutExpired as e:
+            returncode, stdout, stderr, limit = 1, e.stdout, e.stderr, 'wall'
+        usage = {'wall_seconds': time.monotonic() - started}
+        return GovernedProcess(cmd, returncode, _decode(stdout), _decode(stderr), limit, usage)
+
+    def _record(self, job):
+        usage = {
+            **job.labels,
+            'runs': job.runs,
+            'cpu_seconds': round(job.cpu_seconds, 3),
+            'max_rss_bytes': job.max_rss_bytes,
+            'wall_seconds': round(time.monotonic() - job.started, 3),
+            'limit': job.limit,
+        }
+        metrics.record('compile_cpu', job.cpu_seconds, limit=job.limit or 'none')
+        with self._lock:
+            self.jobs += 1
+            self.cpu_total += job.cpu_seconds
+            self.max_rss_bytes = max(self.max_rss_bytes, job.max_rss_bytes)
+            if job.limit:
+                self.limits[job.limit] = self.limits.get(job.limit, 0) + 1
+            self._heaviest.append(usage)
+            self._heaviest.sort(key=lambda entry: entry['cpu_seconds'], reverse=True)
+            del self._heaviest[HEAVIEST_JOBS:]
+
+        line = json.dumps(usage)
+        if self.usage_log:
+            try:
+                with open(self.usage_log, 'a') as f:
+                    f.write(line + '\n')
+            except OSError as e:
+                print(f'Compile usage log failed: {e}')
+        elif job.limit:
+            print(f'Compile limit exceeded: {line}')
+
+    def stats(self):
+        with self._lock:
+            return {
+                'limits': {
+                    'cpu_seconds': self.cpu_seconds,
+                    'memory_bytes': self.memory_bytes,
+                    'output_bytes': self.output_bytes,
+                    'max_processes': self.max_processes,
+                    'wall_seconds': self.wall_seconds,
+                },
+                'jobs': self.jobs,
+                'runs': self.runs,
+                'exceeded': dict(self.limits),
+                'cpu_seconds': self.cpu_total,
+                'max_rss_bytes': self.max_rss_bytes,
+                'heaviest': list(self._heaviest),
+            }
+
+
+class _Job:
+    def __init__(self, labels, started):
+        self.labels = labels
+        self.started = started
+        self.runs = 0
+        self.cpu_seconds = 0.0
+        self.max_rss_bytes = 0
+        self.limit = None
+
+    def add(self, result):
+        self.runs += 1
+        self.cpu_seconds += result.usage.get('cpu_seconds', 0.0)
+        self.max_rss_bytes = max(self.max_rss_bytes, result.usage.get('max_rss_bytes', 0))
+        self.limit = self.limit or result.limit
+
+
+class _GroupIndex:
+    """pid -> process group of every process on the node, to count a group's members.
+
+    A refresh lists /proc but only reads the stat file of pids it hasn't
+    seen yet, so watching groups costs one directory listing per poll
+    rather than a read per process. Processes in our own group are read
+    again each time: a child just forked may not have started its session.
+    """
+
+    def __init__(self):
+        self._pgids = {}
+        self._sizes = Counter()
+        self._refreshed = None
+        self._lock = threading.Lock()
+
+    def size(self, pgid):
+        """Processes in the process group pgid (0 where there is none)."""
+        with self._lock:
+            # Concurrent runs share a refresh
+            if self._refreshed is None or time.monotonic() - self._refreshed >= POLL_SECONDS / 2:
+                self._refresh()
+                self._refreshed = time.monotonic()
+            return self._sizes[pgid]
+
+    def _refresh(self):
+        try:
+            pids = {int(name) for name in os.listdir('/proc') if name.isdigit()}
+        except OSError:
+            pids = set()
+        for pid in self._pgids.keys() - pids:
+            del self._pgids[pid]
+        own = os.getpgrp()
+        for pid in pids - self._pgids.keys():
+            pgid = _read_pgid(pid)
+            if pgid is not None and pgid != own:
+                self._pgids[pid] = pgid
+        self._sizes = Counter(self._pgids.values())
+
+
+_groups = _GroupIndex()
+
+
+def _read_pgid(pid):
+    try:
+        with open(f'/proc/{pid}/stat', 'rb') as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # The command name may contain spaces and parentheses; the fields after it don't
+    fields = stat.rsplit(b')', 1)[-1].split()
+    return int(fields[2]) if len(fields) > 2 else None
+
+
+def _apply_rlimits(limits):
+    # Runs in the child between fork and exec: setrlimit calls only
+    for which, value in limits:
+        try:
+            resource.setrlimit(which, value)
+        except (ValueError, OSError):  # not supported here (RLIMIT_AS on macOS)
+            pass
+
+
+def _signal_group(pgid, sig):
+    try:
+        os.killpg(pgid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def _read(f):
+    f.seek(0)
+    return _decode(f.read())
+
+
+def _decode(data):
+    # TeX logs aren't always valid UTF-8
+    return (data or b'').decode('utf-8', errors='replace')
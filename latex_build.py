@@ -0,0 +1,217 @@
+import os
+import re
+import json
+import hashlib
+
+import metrics
+from governor import Governor
+
+# Auxiliary files whose contents feed back into the next LaTeX pass
+AUX_EXTENSIONS = ('.aux', '.toc', '.lof', '.lot', '.out', '.nav', '.snm', '.idx', '.ind', '.glo', '.gls', '.bbl')
+MAX_PASSES = 5
+RERUN_PATTERN = re.compile(r'(Rerun to get|Please rerun|rerun LaTeX|Label\(s\) may have changed)', re.IGNORECASE)
+BIBDATA_PATTERN = re.compile(r'\\bibdata\{([^}]*)\}')
+CITATION_PATTERN = re.compile(r'\\(?:citation|bibstyle)\{[^}]*\}')
+BCF_DATASOURCE_PATTERN = re.compile(r'<bcf:datasource[^>]*>([^<]+)</bcf:datasource>')
+# TeX could not load the precompiled format itself
+FORMAT_ERROR_PATTERN = re.compile(r"Fatal format file error|can't find the format file|---! .*\.fmt (?:was written by|doesn't match)")
+
+STATE_FILE = '.underleaf-build.json'
+
+
+def build_dir_for(workspace, filepath):
+    """Persistent build directory for one main file of a cached workspace.
+
+    Lives under .git so `git clean` between compiles leaves it alone and it is
+    evicted together with the workspace.
+    """
+    key = hashlib.sha256(filepath.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(workspace, '.git', 'underleaf-build', key)
+
+
+def build_latex(working_dir, file_name, build_dir, env, engine='pdflatex', progress=None, formats=None,
+                governor=None):
+    """Incrementally compile file_name, reusing auxiliary files in build_dir.
+
+    progress(phase, log=None) is called before every pass / bibliography run
+    and with the log after each pass. With a FormatCache in formats, passes
+    load the precompiled preamble. TeX and the bibliography tool run under
+    governor's limits. Returns (result, output_pdf, passes) where result is
+    the GovernedProcess of the last run; the build stops at the first run
+    that hits a limit.
+    """
+    progress = progress or _no_progress
+    governor = governor or Governor()
+    jobname = os.path.splitext(file_name)[0]
+    output_pdf = os.path.join(build_dir, jobname + '.pdf')
+
+    _mirror_directories(working_dir, build_dir)
+    state = _load_state(build_dir)
+
+    # A stale PDF from the previous build must never count as success
+    if os.path.exists(output_pdf):
+        os.remove(output_pdf)
+
+    bib_env = env.copy()
+    for var in ('BIBINPUTS', 'BSTINPUTS'):
+        bib_env[var] = working_dir + os.pathsep + env.get(var, '')
+
+    fmt = formats.format_for(working_dir, file_name, engine, env, progress) if formats else None
+
+    passes = 0
+    bib_done = False
+    result = None
+    suspect_fmt = None
+    while passes < MAX_PASSES:
+        before = _aux_checksum(build_dir)
+        progress(f'pass {passes + 1}')
+        cmd = [engine, '-interaction=nonstopmode', '-recorder', f'-output-directory={build_dir}', file_name]
+        if fmt:
+            cmd.insert(1, f'-fmt={fmt}')
+        with metrics.span('compile_phase', phase=f'pass{passes + 1}'):
+            result = governor.run(cmd, cwd=working_dir, env=env)
+        passes += 1
+        progress(f'pass {passes}', result.stdout)
+        if result.limit:
+            break
+
+        if not os.path.exists(output_pdf):
+            if fmt and passes == 1:
+                # Retry without the format. It is only to blame if it didn't
+                # load, or if the document compiles without it
+                if FORMAT_ERROR_PATTERN.search(result.stdout or ''):
+                    formats.reject(fmt)
+                else:
+                    suspect_fmt = fmt
+                fmt = None
+                passes = 0
+                continue
+            break
+
+        if suspect_fmt:
+            # Some preambles don't survive being dumped - compile them the normal way
+            formats.reject(suspect_fmt)
+            suspect_fmt = None
+
+        if not bib_done:
+            bib_done = True
+            bib_result = _run_bibliography(working_dir, build_dir, jobname, state, bib_env, progress, governor)
+            if bib_result and bib_result.limit:
+                result = bib_result
+                break
+            if bib_result:
+                continue
+
+        if _aux_checksum(build_dir) == before and not RERUN_PATTERN.search(result.stdout or ''):
+            break
+
+    if os.path.exists(output_pdf) and not result.limit:
+        _save_state(build_dir, state)
+    else:
+        # Don't let a broken .aux from a failed or stopped run poison the next build
+        _clear_aux(build_dir)
+
+    return result, output_pdf, passes
+
+
+def _run_bibliography(working_dir, build_dir, jobname, state, env, progress, governor):
+    """Run biber/bibtex if the citations or .bib inputs changed. Returns its result, or None if it didn't run."""
+    bcf_path = os.path.join(build_dir, jobname + '.bcf')
+    aux_path = os.path.join(build_dir, jobname + '.aux')
+
+    if os.path.exists(bcf_path):
+        tool = 'biber'
+        control = _read(bcf_path)
+        sources = BCF_DATASOURCE_PATTERN.findall(control)
+    elif os.path.exists(aux_path):
+        aux = _read(aux_path)
+        bibdata = BIBDATA_PATTERN.findall(aux)
+        if not bibdata:
+            return False
+        tool = 'bibtex'
+        control = '\n'.join(CITATION_PATTERN.findall(aux))
+        sources = [name.strip() for entry in bibdata for name in entry.split(',') if name.strip()]
+    else:
+        return False
+
+    digest = hashlib.sha256(control.encode('utf-8'))
+    for source in sources:
+        source = source.strip()
+        if not source.endswith('.bib'):
+            source += '.bib'
+        digest.update(source.encode('utf-8'))
+        try:
+            with open(os.path.join(working_dir, source), 'rb') as f:
+                digest.update(f.read())
+        except OSError:
+            pass
+    bib_hash = digest.hexdigest()
+
+    if state.get('bib_hash') == bib_hash and os.path.exists(os.path.join(build_dir, jobname + '.bbl')):
+        return False
+
+    if tool == 'biber':
+        cmd = ['biber', f'--input-directory={build_dir}', f'--output-directory={build_dir}', jobname]
+        cwd = working_dir
+    else:
+        cmd = ['bibtex', jobname]
+        cwd = build_dir
+    progress(tool)
+    with metrics.span('compile_phase', phase=tool):
+        result = governor.run(cmd, cwd=cwd, env=env)
+    progress(tool, result.stdout)
+    state['bib_hash'] = bib_hash
+    return result
+
+
+def _no_progress(phase, log=None):
+    pass
+
+
+def _aux_checksum(build_dir):
+    digest = hashlib.sha256()
+    for dirpath, dirnames, filenames in os.walk(build_dir):
+        for filename in sorted(filenames):
+            if filename.endswith(AUX_EXTENSIONS):
+                path = os.path.join(dirpath, filename)
+                digest.update(os.path.relpath(path, build_dir).encode('utf-8'))
+                with open(path, 'rb') as f:
+                    digest.update(f.read())
+        dirnames.sort()
+    return digest.hexdigest()
+
+
+def _clear_aux(build_dir):
+    for dirpath, dirnames, filenames in os.walk(build_dir):
+        for filename in filenames:
+            if filename.endswith(AUX_EXTENSIONS) or filename == STATE_FILE:
+                os.remove(os.path.join(dirpath, filename))
+
+
+def _mirror_directories(working_dir, build_dir):
+    # \include{chapters/intro} writes chapters/intro.aux under the output
+    # directory, which TeX refuses to create itself
+    os.makedirs(build_dir, exist_ok=True)
+    for dirpath, dirnames, filenames in os.walk(working_dir):
+        dirnames[:] = [d for d in dirnames if d != '.git']
+        for dirname in dirnames:
+            rel = os.path.relpath(os.path.join(dirpath, dirname), working_dir)
+            os.makedirs(os.path.join(build_dir, rel), exist_ok=True)
+
+
+def _load_state(build_dir):
+    try:
+        with open(os.path.join(build_dir, STATE_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_state(build_dir, state):
+    with open(os.path.join(build_dir, STATE_FILE), 'w') as f:
+        json.dump(state, f)
+
+
+def _read(path):
+    with open(path, encoding='utf-8', errors='replace') as f:
+        return f.read()
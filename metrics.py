@@ -0,0 +1,223 @@
+import os
+import json
+import time
+import atexit
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from node_files import write_atomically
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+HELP = {
+    'http_request': 'Time to handle an HTTP request, by route, method and status.',
+    'github_request': 'Time of outbound GitHub API calls, by method, endpoint and status.',
+    'compile': 'End-to-end time of a compile on a worker thread, by compiler and outcome.',
+    'compile_phase': 'Time spent in each phase of a compile (queue, checkout, packages, format, passes, ...), by outcome.',
+    'compile_cpu': 'CPU time used by the TeX, BibTeX and pandoc processes of one compile, by the limit it hit.',
+}
+
+
+class Histogram:
+    """Prometheus-style cumulative histogram with labels."""
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self._series = {}  # sorted label items -> [count per bucket..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'help': self.help,
+                'buckets': list(self.buckets),
+                'series': [[list(key), list(series)] for key, series in self._series.items()],
+            }
+
+
+class Registry:
+    """Histograms of this process, written to a per-process file in root.
+
+    Every gunicorn worker keeps its own numbers; /metrics, answered by any
+    one of them, sums the files of all workers. A worker's file goes away
+    when it exits, or, if it died without cleaning up, the next time the
+    files are summed.
+    """
+
+    def __init__(self, root, flush_interval=10):
+        self.root = root
+        self.flush_interval = flush_interval
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._path = None
+        self._flusher = None
+        os.makedirs(root, exist_ok=True)
+
+    def histogram(self, name, help=''):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram(name, help)
+            # Started lazily so a process that never records anything (and a
+            # gunicorn master forking workers) doesn't write a file
+            if self._flusher is None:
+                self._path = os.path.join(self.root, f'{os.getpid()}-{int(time.time() * 1000)}.json')
+                self._flusher = threading.Thread(target=self._flush_loop, name='metrics-flush', daemon=True)
+                self._flusher.start()
+                atexit.register(self._remove, self._path)
+        return histogram
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def flush(self):
+        with self._lock:
+            histograms = list(self._histograms.values())
+            path = self._path
+        if not histograms:
+            return
+        data = json.dumps({histogram.name: histogram.snapshot() for histogram in histograms})
+        write_atomically(path, data.encode('utf-8'))
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except OSError as e:
+                print(f'Metrics flush failed: {e}')
+
+    def render(self):
+        """All workers' histograms in the Prometheus text exposition format."""
+        self.flush()
+        merged = {}
+        for name in sorted(os.listdir(self.root)):
+            if not name.endswith('.json'):
+                continue
+            if not _alive(int(name.split('-', 1)[0])):
+                self._remove(os.path.join(self.root, name))
+                continue
+            try:
+                with open(os.path.join(self.root, name)) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for metric, snapshot in data.items():
+                target = merged.setdefault(metric, {'help': snapshot['help'], 'buckets': snapshot['buckets'], 'series': {}})
+                for key, series in snapshot['series']:
+                    key = tuple(tuple(item) for item in key)
+                    existing = target['series'].get(key)
+                    if existing is None or len(existing) != len(series):
+                        target['series'][key] = list(series)
+                    else:
+                        target['series'][key] = [a + b for a, b in zip(existing, series)]
+
+        lines = []
+        for metric in sorted(merged):
+            snapshot = merged[metric]
+            lines.append(f'# HELP {metric} {snapshot["help"]}')
+            lines.append(f'# TYPE {metric} histogram')
+            for key, series in sorted(snapshot['series'].items()):
+                labels = [f'{k}="{_escape(v)}"' for k, v in key]
+                bounds = [str(bound) for bound in snapshot['buckets']] + ['+Inf']
+                for bound, count in zip(bounds, series):
+                    bucket_labels = ','.join(labels + [f'le="{bound}"'])
+                    lines.append(f'{metric}_bucket{{{bucket_labels}}} {count}')
+                label_str = '{' + ','.join(labels) + '}' if labels else ''
+                lines.append(f'{metric}_count{label_str} {series[-2]}')
+                lines.append(f'{metric}_sum{label_str} {series[-1]}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry(os.environ.get('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'underleaf-metrics')))
+_local = threading.local()
+
+
+def record(name, seconds, **labels):
+    """Observe seconds in the underleaf_<name>_seconds histogram and the current trace.
+
+    Histograms that span() also feeds get an outcome label there; record()
+    calls for them must pass one too, so all their series have the same labels.
+    """
+    registry.histogram(f'underleaf_{name}_seconds', HELP.get(name, '')).observe(seconds, **labels)
+    trace = getattr(_local, 'trace', None)
+    if trace is not None:
+        trace.append({
+            'span': name,
+            'start': round(time.monotonic() - seconds - _local.trace_start, 4),
+            'seconds': round(seconds, 4),
+            **labels,
+        })
+
+
+@contextmanager
+def span(name, **labels):
+    """Time the block into record(name), labelled outcome="ok" or "error"."""
+    start = time.monotonic()
+    try:
+        yield
+    except BaseException:
+        record(name, time.monotonic() - start, outcome='error', **labels)
+        raise
+    record(name, time.monotonic() - start, outcome='ok', **labels)
+
+
+def start_trace():
+    """Collect the spans recorded on this thread until finish_trace()."""
+    _local.trace = []
+    _local.trace_start = time.monotonic()
+
+
+def finish_trace():
+    trace = getattr(_local, 'trace', None)
+    _local.trace = None
+    return trace
+
+
+def current_trace():
+    """This thread's trace, for work handed to another thread; None if none is being collected."""
+    trace = getattr(_local, 'trace', None)
+    return (trace, _local.trace_start) if trace is not None else None
+
+
+@contextmanager
+def continue_trace(context):
+    """Collect the spans recorded in the block into context, a current_trace() of another thread."""
+    saved = getattr(_local, 'trace', None), getattr(_local, 'trace_start', None)
+    _local.trace, _local.trace_start = context or (None, None)
+    try:
+        yield
+    finally:
+        _local.trace, _local.trace_start = saved
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
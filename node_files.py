@@ -0,0 +1,151 @@
+import os
+import shutil
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows - in-process locking only
+    fcntl = None
+
+_thread_locks = {}  # path -> [lock, holders], without fcntl
+_thread_locks_guard = threading.Lock()
+
+
+class FileLock:
+    """Exclusive lock on a file, held across every worker process on the node.
+
+    flock excludes other processes and, since each FileLock opens the file
+    itself, other threads of this one too. With remove=True the file is
+    deleted on release so per-key lock files don't pile up; a waiter that
+    wakes up holding a deleted file just tries again with the new one.
+    Without fcntl only the threads of this process are excluded.
+    """
+
+    def __init__(self, path, remove=False):
+        self.path = path
+        self.remove = remove
+        self.file = None
+        self._thread_lock = None
+
+    def acquire(self, blocking=True):
+        """Take the lock; False if blocking is off and someone else holds it."""
+        if not fcntl:
+            return self._acquire_thread_lock(blocking)
+        while True:
+            f = open(self.path, 'a')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                f.close()
+                return False
+            if not self.remove:
+                break
+            try:
+                if os.fstat(f.fileno()).st_ino == os.stat(self.path).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+            f.close()
+        self.file = f
+        return True
+
+    def release(self):
+        if self.file is not None:
+            if self.remove:
+                remove(self.path)
+            self.file.close()
+            self.file = None
+        if self._thread_lock is not None:
+            self._release_thread_lock()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def _acquire_thread_lock(self, blocking):
+        with _thread_locks_guard:
+            entry = _thread_locks.setdefault(self.path, [threading.Lock(), 0])
+            entry[1] += 1
+        if entry[0].acquire(blocking):
+            self._thread_lock = entry
+            return True
+        self._forget(entry)
+        return False
+
+    def _release_thread_lock(self):
+        entry, self._thread_lock = self._thread_lock, None
+        entry[0].release()
+        self._forget(entry)
+
+    def _forget(self, entry):
+        with _thread_locks_guard:
+            entry[1] -= 1
+            if not entry[1]:
+                del _thread_locks[self.path]
+
+
+def write_atomically(path, data, durable=False):
+    """Replace path with data (bytes, or a binary file to copy) in one rename.
+
+    Readers see the old file or the new one, never a partial write. durable
+    also fsyncs before the rename, so a crash leaves one of them on disk.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            if isinstance(data, (bytes, bytearray)):
+                f.write(data)
+            else:
+                shutil.copyfileobj(data, f)
+            if durable:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        remove(tmp_path)
+        raise
+
+
+def lru_files(root, suffixes):
+    """(mtime, name, size) of the files in root ending in one of suffixes, oldest first.
+
+    Caches touch a file (os.utime) whenever they use it, so mtime is its last use.
+    """
+    entries = []
+    for name in os.listdir(root):
+        if not name.endswith(suffixes):
+            continue
+        try:
+            st = os.stat(os.path.join(root, name))
+        except OSError:
+            continue
+        entries.append((st.st_mtime, name, st.st_size))
+    return sorted(entries)
+
+
+def evict_lru(root, entries, max_bytes):
+    """Delete the oldest of lru_files() entries until the rest fit in max_bytes; returns the names deleted."""
+    total = sum(entry[2] for entry in entries)
+    removed = []
+    for mtime, name, size in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(root, name))
+        except OSError:
+            continue
+        total -= size
+        removed.append(name)
+    return removed
+
+
+def remove(path):
+    """Delete path if it is there."""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
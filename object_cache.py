@@ -0,0 +1,94 @@
+import threading
+from collections import OrderedDict
+
+
+class ObjectCache:
+    """Cache for immutable git objects (trees, blobs, commit->tree links) keyed by repo and SHA.
+
+    Objects never change once addressed by SHA, so entries need no
+    invalidation - only LRU eviction to stay within max_bytes of memory.
+    An entry is only stored after GitHub returned it from that repo, so a
+    SHA from another (private) repo is never served under this one.
+    With a SharedCache behind it, objects are also kept for every worker on
+    the node, and a missing object is fetched by one of them at a time.
+    """
+
+    def __init__(self, max_bytes, shared=None):
+        self.max_bytes = max_bytes
+        self.shared = shared
+        self.bytes = 0
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # (repo, kind, sha) -> bytes
+        self._lock = threading.Lock()
+
+    def get(self, repo, kind, sha):
+        key = (repo, kind, sha)
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+
+        if self.shared:
+            value = self.shared.get(_shared_key(repo, kind, sha))
+            if value is not None:
+                with self._lock:
+                    self.shared_hits += 1
+                self._remember(key, value)
+                return value
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, repo, kind, sha, value):
+        self._remember((repo, kind, sha), value)
+        if self.shared:
+            self.shared.put(_shared_key(repo, kind, sha), value)
+
+    def get_or_fill(self, repo, kind, sha, fill):
+        """The object, or fill()'s result for it (bytes, or None if it couldn't be fetched)."""
+        value = self.get(repo, kind, sha)
+        if value is not None:
+            return value
+        if self.shared:
+            value = self.shared.get_or_fill(_shared_key(repo, kind, sha), fill)
+        else:
+            value = fill()
+        if value is not None:
+            self._remember((repo, kind, sha), value)
+        return value
+
+    def _remember(self, key, value):
+        # Objects bigger than a quarter of the budget would just flush everything else
+        if len(value) > self.max_bytes // 4:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= len(old)
+            self._entries[key] = value
+            self.bytes += len(value)
+            while self.bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.bytes -= len(evicted)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.shared_hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'shared_hits': self.shared_hits,
+                'misses': self.misses,
+                'hit_ratio': (self.hits + self.shared_hits) / lookups if lookups else 0.0,
+            }
+
+
+def _shared_key(repo, kind, sha):
+    return f'{kind}:{repo}:{sha}'
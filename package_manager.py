@@ -0,0 +1,269 @@
+import os
+import re
+import json
+import time
+import shutil
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from node_files import FileLock, write_atomically
+
+PACKAGE_PATTERN = re.compile(r'\\(usepackage|RequirePackage|documentclass)\s*(?:\[[^\]]*\])?\s*\{([^}]*)\}')
+COMMENT_PATTERN = re.compile(r'(?<!\\)%.*')
+NAME_PATTERN = re.compile(r'^[A-Za-z0-9_.\-]+$')
+
+# Files whose MiKTeX package is not named after the file
+PACKAGE_ALIASES = {
+    'tikz': 'pgf',
+    'pgfcore': 'pgf',
+    'amssymb': 'amsfonts',
+    'amsthm': 'amscls',
+    'graphicx': 'graphics',
+    'color': 'graphics',
+    'subcaption': 'caption',
+    'algorithm': 'algorithms',
+    'algorithmic': 'algorithms',
+    'algpseudocode': 'algorithmicx',
+    'tabularx': 'tools',
+    'longtable': 'tools',
+    'array': 'tools',
+    'multicol': 'tools',
+    'verbatim': 'tools',
+    'bm': 'tools',
+}
+# Packages that failed to install are retried after this long; ones whose
+# install timed out (mirror down or hanging) much sooner
+UNAVAILABLE_RETRY_SECONDS = 24 * 3600
+TIMEOUT_RETRY_SECONDS = 600
+# kpsewhich only reads the local file database
+LOCATE_TIMEOUT_SECONDS = 30
+
+
+def scan_packages(source):
+    """TeX file names (foo.sty, bar.cls) a LaTeX source loads via \\usepackage,
+    \\RequirePackage and \\documentclass."""
+    files = set()
+    for kind, names in PACKAGE_PATTERN.findall(COMMENT_PATTERN.sub('', source)):
+        extension = '.cls' if kind == 'documentclass' else '.sty'
+        for name in names.split(','):
+            name = name.strip()
+            if NAME_PATTERN.match(name):
+                files.add(name + extension)
+    return files
+
+
+def scan_directory(path):
+    """Packages the .tex/.sty/.cls files under path load, minus the ones the project ships itself."""
+    files = set()
+    local = set()
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames[:] = [d for d in dirnames if d != '.git']
+        for filename in filenames:
+            if not filename.endswith(('.tex', '.sty', '.cls')):
+                continue
+            local.add(filename)
+            try:
+                with open(os.path.join(dirpath, filename), encoding='utf-8', errors='replace') as f:
+                    files |= scan_packages(f.read())
+            except OSError:
+                pass
+    return files - local
+
+
+class PackageManager:
+    """Installs the TeX packages projects need before they are compiled.
+
+    MiKTeX's on-the-fly installer blocks the first compile that uses a new
+    package and concurrent compiles race on the same install. Here installs
+    go through `mpm`, one at a time per node (flock), and the outcome of every
+    lookup is kept in a JSON record so known packages cost nothing. With
+    repository set, packages come from that local mirror instead of the network.
+    An install that takes longer than install_timeout is killed, and the rest
+    of its batch is skipped rather than left to hang on the same mirror while
+    compiles wait for the lock; both are retried after TIMEOUT_RETRY_SECONDS.
+    """
+
+    def __init__(self, root, repository=None, install_timeout=120):
+        self.root = root
+        self.repository = repository
+        self.install_timeout = install_timeout
+        self.mpm = shutil.which('mpm')
+        self.installs = 0
+        self.install_errors = 0
+        self.install_timeouts = 0
+        self._lock = threading.Lock()
+        self._pending = set()
+        # A single background installer - installs are serialized anyway
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix='package-prefetch')
+        os.makedirs(root, exist_ok=True)
+
+    def configure(self):
+        """Point MiKTeX's own on-demand installer at the offline mirror, if any.
+
+        Done once per node rather than by every worker: the repository that
+        was set is kept in a marker file next to the package record.
+        """
+        if not (self.mpm and self.repository):
+            return
+        marker = os.path.join(self.root, 'repository')
+        if _read_text(marker) == self.repository:
+            return
+        lock = self._locked('configure')
+        try:
+            # Another worker may have set it while we waited for the lock
+            if _read_text(marker) == self.repository:
+                return
+            try:
+                result = subprocess.run([self.mpm, f'--set-repository={self.repository}'], capture_output=True,
+                                        check=False, timeout=self.install_timeout)
+            except subprocess.TimeoutExpired:
+                return
+            if result.returncode == 0:
+                with open(marker, 'w') as f:
+                    f.write(self.repository)
+        finally:
+            lock.release()
+
+    def prefetch(self, files):
+        """Install missing packages for files in the background."""
+        if not self.mpm:
+            return
+        with self._lock:
+            files = set(files) - self._pending
+            self._pending |= files
+        if files:
+            self._executor.submit(self._prefetch, files)
+
+    def _prefetch(self, files):
+        try:
+            self.ensure(files)
+        except Exception as e:
+            print(f'Package prefetch failed: {e}')
+        finally:
+            with self._lock:
+                self._pending -= files
+
+    def ensure(self, files, env=None):
+        """Install whatever of files is missing; returns once they are in place or given up on."""
+        if not self.mpm:
+            return
+        files = self._unknown(files)
+        if not files:
+            return
+
+        lock = self._locked()
+        try:
+            # Another worker may have installed them while we waited for the lock
+            record = self._read_record()
+            files = self._unknown(files, record)
+            if not files:
+                return
+            now = time.time()
+            found = self._locate(files, env)
+            if found is None:
+                return
+            installing = True
+            for name in sorted(files):
+                if name in found:
+                    record[name] = {'status': 'present', 'checked_at': now}
+                    continue
+                package = _package_name(name)
+                # After a timeout the mirror is presumably hanging, so the
+                # rest of the batch waits for the retry as well
+                installed = self._install(package, env) if installing else None
+                if installed is None:
+                    installing = False
+                    record[name] = {'status': 'unavailable', 'package': package, 'checked_at': now,
+                                    'retry_after': TIMEOUT_RETRY_SECONDS}
+                else:
+                    record[name] = {'status': 'installed' if installed else 'unavailable', 'package': package,
+                                    'checked_at': now}
+            self._write_record(record)
+        finally:
+            lock.release()
+
+    def _install(self, package, env):
+        """True once package is installed, False if mpm failed, None if it timed out."""
+        cmd = [self.mpm, f'--install={package}']
+        if self.repository:
+            cmd.insert(1, f'--repository={self.repository}')
+        try:
+            result = subprocess.run(cmd, capture_output=True, text=True, env=env, timeout=self.install_timeout)
+        except subprocess.TimeoutExpired:
+            with self._lock:
+                self.install_timeouts += 1
+            print(f'Package install timed out after {self.install_timeout}s: {package}')
+            return None
+        with self._lock:
+            if result.returncode == 0:
+                self.installs += 1
+            else:
+                self.install_errors += 1
+        return result.returncode == 0
+
+    def _unknown(self, files, record=None):
+        record = self._read_record() if record is None else record
+        now = time.time()
+        unknown = set()
+        for name in files:
+            entry = record.get(name)
+            if entry is None or (entry['status'] == 'unavailable'
+                                 and now - entry['checked_at'] > entry.get('retry_after', UNAVAILABLE_RETRY_SECONDS)):
+                unknown.add(name)
+        return unknown
+
+    def _locate(self, files, env):
+        # One kpsewhich call for the whole batch; it prints the paths it finds.
+        # None if it hangs - nothing is installed or recorded this time
+        try:
+            result = subprocess.run(['kpsewhich'] + sorted(files), capture_output=True, text=True, env=env,
+                                    timeout=LOCATE_TIMEOUT_SECONDS)
+        except OSError:
+            return set()
+        except subprocess.TimeoutExpired:
+            return None
+        return {os.path.basename(line.strip()) for line in result.stdout.splitlines() if line.strip()}
+
+    def _locked(self, name='install'):
+        lock = FileLock(os.path.join(self.root, name + '.lock'))
+        lock.acquire()
+        return lock
+
+    def _read_record(self):
+        try:
+            with open(os.path.join(self.root, 'packages.json')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_record(self, record):
+        write_atomically(os.path.join(self.root, 'packages.json'), json.dumps(record).encode('utf-8'))
+
+    def stats(self):
+        record = self._read_record()
+        statuses = {}
+        for entry in record.values():
+            statuses[entry['status']] = statuses.get(entry['status'], 0) + 1
+        return {
+            'enabled': bool(self.mpm),
+            'offline_repository': self.repository,
+            'known': statuses,
+            'pending': len(self._pending),
+            'installs': self.installs,
+            'install_errors': self.install_errors,
+            'install_timeouts': self.install_timeouts,
+        }
+
+
+def _package_name(file_name):
+    stem = os.path.splitext(file_name)[0]
+    return PACKAGE_ALIASES.get(stem, stem)
+
+
+def _read_text(path):
+    try:
+        with open(path) as f:
+            return f.read()
+    except OSError:
+        return None
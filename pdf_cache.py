@@ -0,0 +1,78 @@
+import os
+import hashlib
+import threading
+
+from node_files import write_atomically, lru_files, evict_lru
+
+
+def pdf_cache_key(filepath, compiler, source_sha, repo=None):
+    """Content address of a build: main file, compiler and the git tree/commit SHA of its inputs.
+
+    repo scopes the key to one repository, for SHAs the client named rather
+    than ones looked up in that repository.
+    """
+    scope = f'{repo}\0' if repo else ''
+    return hashlib.sha256(f'{scope}{filepath}\0{compiler}\0{source_sha}'.encode('utf-8')).hexdigest()
+
+
+class PdfCache:
+    """Compiled PDFs stored on disk by content address, evicted LRU past max_bytes."""
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.root, key + '.pdf')
+
+    def get(self, key, record=True):
+        """Return the path of the cached PDF for key, or None.
+
+        record=False re-checks without counting towards the hit/miss stats.
+        """
+        path = self._path(key)
+        try:
+            size = os.path.getsize(path)
+            os.utime(path)  # mtime doubles as last-used time for LRU
+        except OSError:
+            if record:
+                with self._lock:
+                    self.misses += 1
+            return None
+        if record:
+            with self._lock:
+                self.hits += 1
+                self.bytes_saved += size
+        return path
+
+    def put(self, key, pdf_path):
+        # Copy then rename so other workers never see a half-written PDF
+        with open(pdf_path, 'rb') as src:
+            write_atomically(self._path(key), src)
+        self._evict()
+        return self._path(key)
+
+    def _evict(self):
+        removed = evict_lru(self.root, lru_files(self.root, ('.pdf',)), self.max_bytes)
+        with self._lock:
+            self.evictions += len(removed)
+
+    def stats(self):
+        entries = lru_files(self.root, ('.pdf',))
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'bytes_saved': self.bytes_saved,
+            'evictions': self.evictions,
+            'entries': len(entries),
+            'bytes': sum(entry[2] for entry in entries),
+            'max_bytes': self.max_bytes,
+        }
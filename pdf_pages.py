@@ -0,0 +1,130 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+from contextlib import nullcontext
+
+import metrics
+from governor import Governor
+from node_files import FileLock, write_atomically, lru_files, evict_lru
+
+GHOSTSCRIPT = os.environ.get('GHOSTSCRIPT', 'gswin64c' if os.name == 'nt' else 'gs')
+RENDER_TIMEOUT = 300
+
+
+class PageRenderer:
+    """PNG renderings of compiled PDFs, one image per page, stored by content hash.
+
+    A PDF (named by its build key) is rasterized with Ghostscript once; its
+    manifest lists the hash of every page image. Pages that come out the same
+    in the next build hash the same, so the client only has to fetch the
+    pages whose hash changed and the images themselves are shared between
+    builds. Images are evicted LRU past max_bytes. Ghostscript runs under
+    governor's limits, inside slot() - a node-wide compile slot - if given.
+    """
+
+    def __init__(self, root, max_bytes, dpi=110, governor=None, slot=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.dpi = dpi
+        self.governor = governor or Governor(wall_seconds=RENDER_TIMEOUT)
+        self.slot = slot or nullcontext
+        self.renders = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def pages(self, key, pdf_path, user=None):
+        """List of page hashes for the PDF stored under key, rasterizing it if needed (in user's turn for a slot)."""
+        pages = self.manifest(key)
+        if pages is not None:
+            return pages
+        with self._locked(key):
+            # Another worker may have rendered it while we waited
+            pages = self.manifest(key)
+            if pages is None:
+                with self.slot(user), metrics.span('compile_phase', phase='rasterize'):
+                    pages = self._render(key, pdf_path)
+        self._evict()
+        return pages
+
+    def manifest(self, key):
+        """Page hashes of an already rendered PDF, or None if it was never rendered or got evicted."""
+        try:
+            with open(self._manifest_path(key)) as f:
+                pages = json.load(f)['pages']
+            for page in set(pages):
+                os.utime(self.image_path(page))  # mtime doubles as last-used time for LRU
+            os.utime(self._manifest_path(key))
+        except (OSError, ValueError, KeyError):
+            return None
+        return pages
+
+    def image_path(self, page):
+        # Hashes come from URLs - keep them to a single path component
+        return os.path.join(self.root, os.path.basename(page) + '.png')
+
+    def _render(self, key, pdf_path):
+        render_dir = tempfile.mkdtemp(dir=self.root, prefix='render-')
+        try:
+            result = self.governor.run(
+                [GHOSTSCRIPT, '-q', '-dSAFER', '-dBATCH', '-dNOPAUSE', '-sDEVICE=png16m', f'-r{self.dpi}',
+                 '-dTextAlphaBits=4', '-dGraphicsAlphaBits=4', f'-sOutputFile={os.path.join(render_dir, "%d.png")}',
+                 pdf_path]
+            )
+            count = len([name for name in os.listdir(render_dir) if name.endswith('.png')])
+            if result.returncode != 0 or not count:
+                with self._lock:
+                    self.failures += 1
+                if result.limit:
+                    raise RuntimeError(f'Ghostscript was stopped because {self.governor.describe(result.limit)}')
+                raise RuntimeError(f'Ghostscript failed: {(result.stderr or result.stdout)[-500:]}')
+
+            pages = []
+            for number in range(1, count + 1):
+                rendered = os.path.join(render_dir, f'{number}.png')
+                with open(rendered, 'rb') as f:
+                    page = hashlib.sha256(f.read()).hexdigest()
+                # Unchanged pages already have their image from an earlier build
+                if os.path.exists(self.image_path(page)):
+                    os.utime(self.image_path(page))
+                else:
+                    os.replace(rendered, self.image_path(page))
+                pages.append(page)
+
+            write_atomically(self._manifest_path(key), json.dumps({'pages': pages}).encode('utf-8'))
+            with self._lock:
+                self.renders += 1
+            return pages
+        finally:
+            shutil.rmtree(render_dir, ignore_errors=True)
+
+    def _manifest_path(self, key):
+        return os.path.join(self.root, os.path.basename(key) + '.json')
+
+    def _locked(self, key):
+        # So one PDF is rasterized once across all workers; the file goes on release
+        return FileLock(os.path.join(self.root, os.path.basename(key) + '.lock'), remove=True)
+
+    def _evict(self):
+        # A manifest whose images are gone reads as not rendered and is redone
+        evict_lru(self.root, lru_files(self.root, ('.png', '.json')), self.max_bytes)
+
+    def stats(self):
+        entries = lru_files(self.root, ('.png', '.json'))
+        return {
+            'renders': self.renders,
+            'failures': self.failures,
+            'pages': sum(1 for entry in entries if entry[1].endswith('.png')),
+            'bytes': sum(entry[2] for entry in entries),
+            'max_bytes': self.max_bytes,
+        }
+
+
+def changed_pages(pages, previous):
+    """Indexes of pages that differ from the previous build's page list (None: all of them)."""
+    if previous is None:
+        return list(range(len(pages)))
+    return [i for i, page in enumerate(pages) if i >= len(previous) or previous[i] != page]
@@ -0,0 +1,88 @@
+import json
+import base64
+import codecs
+import mimetypes
+from urllib.parse import quote
+
+# GitHub answers blob and contents requests with the bytes themselves under this media type
+RAW_MEDIA_TYPE = 'application/vnd.github.raw'
+SNIFF_BYTES = 8192
+CHUNK_BYTES = 3 * 64 * 1024  # a multiple of 3, so chunks base64-encode independently
+
+
+def looks_like_text(prefix):
+    """Guess from a file's first bytes whether it is UTF-8 text."""
+    if b'\0' in prefix:
+        return False
+    try:
+        # A multi-byte character cut off at the end of the prefix is fine
+        codecs.getincrementaldecoder('utf-8')().decode(prefix, final=False)
+    except UnicodeDecodeError:
+        return False
+    return True
+
+
+def content_type(filepath, prefix):
+    guessed = mimetypes.guess_type(filepath)[0]
+    if looks_like_text(prefix):
+        if guessed and not guessed.startswith('text/'):
+            return guessed
+        return f"{guessed or 'text/plain'}; charset=utf-8"
+    return guessed or 'application/octet-stream'
+
+
+def raw_url(repo, ref, filepath):
+    """URL of the raw file endpoint; ref is a branch or commit SHA."""
+    return f"/api/raw/{repo}?ref={quote(ref, safe='')}&path={quote(filepath, safe='/')}"
+
+
+def file_payload(content, sha, url):
+    """/api/file response: text inline, anything else by URL of the raw endpoint."""
+    if looks_like_text(content[:SNIFF_BYTES]):
+        try:
+            return {'content': content.decode('utf-8'), 'sha': sha, 'type': 'text'}
+        except UnicodeDecodeError:
+            pass
+    return {'sha': sha, 'type': 'binary', 'url': url}
+
+
+def base64_json_body(fields, name, stream, length=None):
+    """A JSON object of fields plus name holding stream's bytes base64-encoded.
+
+    Returns an iterable request body. The stream is read and encoded
+    CHUNK_BYTES at a time, so the file is never held in memory whole. Given
+    the stream's length the body has a len(), which requests sends as
+    Content-Length instead of chunked transfer encoding.
+    """
+    head = (json.dumps(fields)[:-1] + (', ' if fields else '') + json.dumps(name) + ': "').encode('utf-8')
+    tail = b'"}'
+
+    def chunks():
+        yield head
+        pending = b''
+        while True:
+            data = stream.read(CHUNK_BYTES)
+            if not data:
+                break
+            pending += data
+            cut = len(pending) - len(pending) % 3
+            if cut:
+                yield base64.b64encode(pending[:cut])
+                pending = pending[cut:]
+        yield base64.b64encode(pending) + tail
+
+    if length is None:
+        return chunks()
+    return _SizedBody(chunks(), len(head) + 4 * ((length + 2) // 3) + len(tail))
+
+
+class _SizedBody:
+    def __init__(self, chunks, length):
+        self.chunks = chunks
+        self.length = length
+
+    def __iter__(self):
+        return self.chunks
+
+    def __len__(self):
+        return self.length
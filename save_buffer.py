@@ -0,0 +1,308 @@
+import os
+import json
+import time
+import hashlib
+import threading
+
+from node_files import FileLock, write_atomically, remove
+
+
+def git_blob_sha(content):
+    """The SHA GitHub will assign to content once it is committed as a blob."""
+    return hashlib.sha1(b'blob %d\0' % len(content) + content).hexdigest()
+
+
+class SaveConflict(Exception):
+    """Buffered files whose version on the branch isn't the one they were edited from.
+
+    conflicts maps each path to the blob SHA it must be saved against now.
+    """
+
+    def __init__(self, conflicts):
+        super().__init__(f"Changed elsewhere since it was edited: {', '.join(sorted(conflicts))}")
+        self.conflicts = conflicts
+
+
+class SaveBuffer:
+    """Write-behind buffer for autosaves.
+
+    Saves are written durably to local disk and acknowledged right away.
+    Dirty files of a repo/branch are flushed to GitHub as one squashed commit
+    once the oldest of them is flush_interval seconds old, on request, or on
+    logout. Anything still on disk after a crash is flushed the next time a
+    worker holds a token for that repo/branch.
+
+    Each file keeps the blob SHA it was first edited from. flush_fn(repo,
+    branch, token, {path: bytes}, {path: base blob SHA or None}) must commit
+    the files and return the commit SHA, or raise SaveConflict if the branch
+    has something else at a path (None: a file there at all). Conflicted
+    files are held back until they are saved against the branch's version;
+    the rest of the entry still flushes. Tokens given to save, flush and
+    remember_token commit everyone's pending saves of that repo/branch later
+    on, so callers must only pass tokens that may push there.
+    """
+
+    def __init__(self, root, flush_interval, flush_fn):
+        self.root = root
+        self.flush_interval = flush_interval
+        self.flush_fn = flush_fn
+        self.flushes = 0
+        self.flush_errors = 0
+        self.conflicts = 0
+        self._tokens = {}  # entry key -> token of the last user who saved there (memory only)
+        self._failed_at = {}  # entry key -> time of the last failed background flush
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        threading.Thread(target=self._flusher, name='save-buffer-flush', daemon=True).start()
+
+    def _key(self, repo, branch):
+        return hashlib.sha256(f'{repo}\0{branch}'.encode('utf-8')).hexdigest()[:32]
+
+    def _entry_dir(self, key):
+        return os.path.join(self.root, key)
+
+    def _content_path(self, key, path):
+        return os.path.join(self._entry_dir(key), hashlib.sha256(path.encode('utf-8')).hexdigest())
+
+    def _locked(self, key, name='entry'):
+        os.makedirs(self._entry_dir(key), exist_ok=True)
+        lock = FileLock(os.path.join(self._entry_dir(key), name + '.lock'))
+        lock.acquire()
+        return lock
+
+    def _read_meta(self, key):
+        try:
+            with open(os.path.join(self._entry_dir(key), 'meta.json')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_meta(self, key, meta):
+        write_atomically(os.path.join(self._entry_dir(key), 'meta.json'), json.dumps(meta).encode('utf-8'), durable=True)
+
+    def remember_token(self, repo, branch, token):
+        with self._lock:
+            self._tokens[self._key(repo, branch)] = token
+
+    def save(self, repo, branch, path, content, token, base_sha=None):
+        """Buffer content for path and return its git blob SHA.
+
+        base_sha is the blob SHA of the version the content was edited from
+        (None for a new file). A path with a pending save may only be saved
+        against that save, or against the branch's version after a conflict;
+        anything else raises SaveConflict.
+        """
+        key = self._key(repo, branch)
+        sha = git_blob_sha(content)
+        lock = self._locked(key)
+        try:
+            meta = self._read_meta(key) or {'repo': repo, 'branch': branch, 'files': {}}
+            entry = meta['files'].get(path)
+            expected = (entry.get('conflict') or entry['sha']) if entry else base_sha
+            if base_sha != expected:
+                raise SaveConflict({path: expected})
+            self.remember_token(repo, branch, token)
+            write_atomically(self._content_path(key, path), content, durable=True)
+            now = time.time()
+            # Lets a logout on any worker find this user's pending entries
+            meta['user'] = _token_key(token)
+            meta['files'][path] = {
+                'sha': sha,
+                'saved_at': now,
+                'dirty_since': entry['dirty_since'] if entry else now,
+            }
+            # Saving over a conflict takes the branch's version as the new base
+            if not entry or entry.get('conflict'):
+                meta['files'][path]['base'] = base_sha
+            elif 'base' in entry:
+                meta['files'][path]['base'] = entry['base']
+            self._write_meta(key, meta)
+        finally:
+            lock.release()
+        return sha
+
+    def read(self, repo, branch, path):
+        """Buffered content for path, or None if it has no pending save."""
+        key = self._key(repo, branch)
+        meta = self._read_meta(key)
+        if not meta or path not in meta['files']:
+            return None
+        try:
+            with open(self._content_path(key, path), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def conflict(self, repo, branch, path):
+        """Blob SHA on the branch that path's pending save conflicts with, or None."""
+        meta = self._read_meta(self._key(repo, branch))
+        return ((meta or {}).get('files', {}).get(path) or {}).get('conflict')
+
+    def overlay(self, repo, branch):
+        """{path: bytes} of every pending file of repo/branch."""
+        key = self._key(repo, branch)
+        meta = self._read_meta(key)
+        files = {}
+        for path in (meta or {}).get('files', {}):
+            content = self.read(repo, branch, path)
+            if content is not None:
+                files[path] = content
+        return files
+
+    def pending(self, repo, branch):
+        meta = self._read_meta(self._key(repo, branch)) or {'files': {}}
+        now = time.time()
+        files = meta['files']
+        oldest = min((entry['dirty_since'] for entry in files.values() if not entry.get('conflict')), default=None)
+        return {
+            'files': {path: {'sha': entry['sha'], 'saved_at': entry['saved_at']} for path, entry in files.items()},
+            'conflicts': sorted(path for path, entry in files.items() if entry.get('conflict')),
+            'oldest_pending_seconds': now - oldest if oldest else 0,
+            'next_flush_in_seconds': max(0, oldest + self.flush_interval - now) if oldest else None,
+        }
+
+    def flush(self, repo, branch, token=None):
+        """Commit the pending files of repo/branch. Returns the commit SHA or None.
+
+        Files in conflict are marked and left out; the others are committed
+        and SaveConflict is raised afterwards.
+        """
+        key = self._key(repo, branch)
+        if token:
+            self.remember_token(repo, branch, token)
+        else:
+            with self._lock:
+                token = self._tokens.get(key)
+        if not token:
+            return None
+
+        # Only one flush per entry at a time across all workers
+        flush_lock = self._locked(key, 'flush')
+        try:
+            conflicts = {}
+            while True:
+                try:
+                    commit_sha = self._flush_locked(key, repo, branch, token)
+                    break
+                except SaveConflict as e:
+                    # Marked, so the next round commits only the rest
+                    self._mark_conflicts(key, e.conflicts)
+                    conflicts.update(e.conflicts)
+            if conflicts:
+                raise SaveConflict(conflicts)
+            return commit_sha
+        finally:
+            flush_lock.release()
+
+    def _flush_locked(self, key, repo, branch, token):
+        meta = self._read_meta(key)
+        if not meta or not meta['files']:
+            return None
+        pending = {path: entry for path, entry in meta['files'].items() if not entry.get('conflict')}
+        files = {}
+        for path, entry in pending.items():
+            content = self.read(repo, branch, path)
+            if content is not None and git_blob_sha(content) == entry['sha']:
+                files[path] = content
+        if not files:
+            return None
+        # Entries buffered before bases were recorded aren't checked
+        bases = {path: pending[path]['base'] for path in files if 'base' in pending[path]}
+        try:
+            commit_sha = self.flush_fn(repo, branch, token, files, bases)
+        except Exception as e:
+            if not isinstance(e, SaveConflict):
+                with self._lock:
+                    self.flush_errors += 1
+            raise
+
+        # Files saved again while the commit was in flight stay dirty, now
+        # based on the version just committed
+        lock = self._locked(key)
+        try:
+            meta = self._read_meta(key) or {'files': {}}
+            for path in files:
+                entry = meta['files'].get(path)
+                if entry is None:
+                    continue
+                if entry['sha'] != pending[path]['sha']:
+                    entry['base'] = pending[path]['sha']
+                    continue
+                del meta['files'][path]
+                remove(self._content_path(key, path))
+            self._write_meta(key, meta)
+        finally:
+            lock.release()
+        with self._lock:
+            self.flushes += 1
+        return commit_sha
+
+    def _mark_conflicts(self, key, conflicts):
+        lock = self._locked(key)
+        try:
+            meta = self._read_meta(key) or {'files': {}}
+            for path, sha in conflicts.items():
+                if path in meta['files']:
+                    meta['files'][path]['conflict'] = sha
+            self._write_meta(key, meta)
+        finally:
+            lock.release()
+        with self._lock:
+            self.conflicts += len(conflicts)
+
+    def flush_token(self, token):
+        """Flush everything this token has pending (logout)."""
+        user = _token_key(token)
+        for key in os.listdir(self.root):
+            meta = self._read_meta(key)
+            if meta and meta['files'] and meta.get('user') == user:
+                try:
+                    self.flush(meta['repo'], meta['branch'], token)
+                except Exception as e:
+                    print(f"Save buffer flush failed for {meta['repo']}@{meta['branch']}: {e}")
+
+    def _flusher(self):
+        while True:
+            time.sleep(min(self.flush_interval, 5))
+            now = time.time()
+            for key in os.listdir(self.root):
+                with self._lock:
+                    token = self._tokens.get(key)
+                if not token:
+                    continue
+                meta = self._read_meta(key)
+                dirty = [entry['dirty_since'] for entry in (meta or {}).get('files', {}).values() if not entry.get('conflict')]
+                if not dirty:
+                    continue
+                oldest = min(dirty)
+                if now - oldest < self.flush_interval:
+                    continue
+                # Back off after a failure instead of retrying every few seconds
+                if now - self._failed_at.get(key, 0) < self.flush_interval:
+                    continue
+                try:
+                    self.flush(meta['repo'], meta['branch'])
+                except Exception as e:
+                    self._failed_at[key] = now
+                    print(f"Save buffer flush failed for {meta['repo']}@{meta['branch']}: {e}")
+
+    def stats(self):
+        dirty_entries = 0
+        dirty_files = 0
+        for key in os.listdir(self.root):
+            meta = self._read_meta(key)
+            if meta and meta['files']:
+                dirty_entries += 1
+                dirty_files += len(meta['files'])
+        return {
+            'dirty_branches': dirty_entries,
+            'dirty_files': dirty_files,
+            'flushes': self.flushes,
+            'flush_errors': self.flush_errors,
+            'conflicts': self.conflicts,
+            'flush_interval': self.flush_interval,
+        }
+
+
+def _token_key(token):
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()[:16]
@@ -0,0 +1,161 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+
+from node_files import FileLock
+
+USED_RESOLUTION = 60  # seconds between last-used updates of an entry
+
+
+class SharedCache:
+    """Key -> bytes store in one SQLite file, shared by every worker on the node.
+
+    Entries are immutable unless given a ttl, after which they read as
+    missing. The least recently used entries are evicted once the store
+    grows past max_bytes. get_or_fill() is single-flight across processes:
+    one caller fills a missing key while the others wait for its result
+    instead of asking GitHub (or TeX) for the same thing. The store is a
+    cache - SQLite errors read as misses and never fail a request.
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.path = os.path.join(root, 'cache.sqlite')
+        self.hits = 0
+        self.misses = 0
+        self.fills = 0
+        self.waits = 0
+        self.evictions = 0
+        self.errors = 0
+        self._written = 0  # bytes put since the last size check
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(root, 'locks'), exist_ok=True)
+        self._execute('CREATE TABLE IF NOT EXISTS entries '
+                      '(key TEXT PRIMARY KEY, value BLOB, size INTEGER, expires REAL, used REAL)')
+        self._execute('CREATE INDEX IF NOT EXISTS entries_used ON entries (used)')
+
+    def _db(self):
+        # One connection per thread, and never one inherited across a fork
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    def _execute(self, sql, params=()):
+        try:
+            return self._db().execute(sql, params).fetchall()
+        except sqlite3.Error as e:
+            with self._lock:
+                self.errors += 1
+            print(f'Shared cache error: {e}')
+            return None
+
+    def get(self, key):
+        now = time.time()
+        rows = self._execute('SELECT value, expires, used FROM entries WHERE key = ?', (key,))
+        if not rows or (rows[0][1] is not None and rows[0][1] <= now):
+            with self._lock:
+                self.misses += 1
+            return None
+        value, expires, used = rows[0]
+        if now - used > USED_RESOLUTION:
+            self._execute('UPDATE entries SET used = ? WHERE key = ?', (now, key))
+        with self._lock:
+            self.hits += 1
+        return bytes(value)
+
+    def put(self, key, value, ttl=None):
+        # Values bigger than a sixteenth of the budget would just flush everything else
+        if len(value) > self.max_bytes // 16:
+            return
+        now = time.time()
+        self._execute('INSERT OR REPLACE INTO entries (key, value, size, expires, used) VALUES (?, ?, ?, ?, ?)',
+                      (key, sqlite3.Binary(value), len(value), now + ttl if ttl else None, now))
+        with self._lock:
+            self._written += len(value)
+            check = self._written > self.max_bytes // 64
+            if check:
+                self._written = 0
+        if check:
+            self._evict()
+
+    def delete(self, key):
+        self._execute('DELETE FROM entries WHERE key = ?', (key,))
+
+    def get_or_fill(self, key, fill, ttl=None):
+        """Value for key, calling fill() for it if missing.
+
+        Only one caller on the node runs fill() for a key at a time; the
+        others wait and read what it stored. fill() returns bytes, or None
+        for a result that must not be cached (the caller then fills itself).
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+        with self.locked(key):
+            value = self.get(key)
+            if value is not None:
+                with self._lock:
+                    self.waits += 1
+                return value
+            value = fill()
+            with self._lock:
+                self.fills += 1
+            if value is not None:
+                self.put(key, value, ttl)
+            return value
+
+    def locked(self, key):
+        """Context manager holding key's lock across all workers (for fills that store elsewhere)."""
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        os.makedirs(os.path.join(self.root, 'locks', digest[:2]), exist_ok=True)
+        # Removed on release, so there is no lock file per key ever filled
+        return FileLock(os.path.join(self.root, 'locks', digest[:2], digest + '.lock'), remove=True)
+
+    def _evict(self):
+        now = time.time()
+        self._execute('DELETE FROM entries WHERE expires IS NOT NULL AND expires <= ?', (now,))
+        rows = self._execute('SELECT COALESCE(SUM(size), 0) FROM entries')
+        if not rows or rows[0][0] <= self.max_bytes:
+            return
+        excess = rows[0][0] - self.max_bytes * 9 // 10
+        # Oldest first, until a tenth of the budget is free again
+        rows = self._execute('SELECT key, size FROM entries ORDER BY used LIMIT 10000') or []
+        stale = []
+        for key, size in rows:
+            if excess <= 0:
+                break
+            stale.append((key,))
+            excess -= size
+        try:
+            self._db().executemany('DELETE FROM entries WHERE key = ?', stale)
+        except sqlite3.Error as e:
+            print(f'Shared cache eviction failed: {e}')
+            return
+        with self._lock:
+            self.evictions += len(stale)
+
+    def stats(self):
+        rows = self._execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries') or [(0, 0)]
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': rows[0][0],
+                'bytes': rows[0][1],
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'fills': self.fills,
+                'waits': self.waits,
+                'evictions': self.evictions,
+                'errors': self.errors,
+            }
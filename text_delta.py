@@ -0,0 +1,25 @@
+class DeltaError(Exception):
+    pass
+
+
+def apply_edits(text, edits):
+    """Apply Monaco-style edits to text and return the result.
+
+    Each edit is {'offset': int, 'length': int, 'text': str} with offset and
+    length in UTF-16 code units, as reported by the editor's change events
+    (rangeOffset / rangeLength). Edits are applied in the given order, each
+    against the result of the previous one.
+    """
+    # Work on UTF-16 so offsets line up with JavaScript strings even for
+    # characters outside the BMP
+    data = text.encode('utf-16-le')
+    for edit in edits:
+        start = int(edit['offset']) * 2
+        end = start + int(edit.get('length', 0)) * 2
+        if start < 0 or end < start or end > len(data):
+            raise DeltaError(f"Edit out of range: offset {edit['offset']}, length {edit.get('length', 0)}")
+        data = data[:start] + edit.get('text', '').encode('utf-16-le') + data[end:]
+    try:
+        return data.decode('utf-16-le')
+    except UnicodeDecodeError:
+        raise DeltaError('Edit splits a surrogate pair')
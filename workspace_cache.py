@@ -0,0 +1,264 @@
+import os
+import shutil
+import subprocess
+import threading
+import time
+import re
+import hashlib
+from contextlib import contextmanager
+
+from node_files import FileLock, remove, write_atomically
+
+
+class WorkspaceCache:
+    """Long-lived git working copies keyed by (repo, branch) or (repo, commit).
+
+    A miss initialises a new shallow checkout, a hit only fetches the ref and
+    fast-forwards the existing one. Workspaces are partial clones: fetches
+    bring commits and trees only, and blobs are downloaded when they are
+    checked out - with a sparse checkout, only the files a build needs.
+    Workspaces are evicted least-recently-used first once the cache grows
+    past max_bytes; each one's size is recorded after it is used, so
+    eviction reads those records instead of walking every workspace.
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._stats_lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def _key(self, repo, ref):
+        # Partial clones don't share a layout with the full checkouts of old
+        return hashlib.sha256(f'{repo}\0{ref}\0partial'.encode('utf-8')).hexdigest()[:32]
+
+    @contextmanager
+    def _lock(self, key, blocking=True):
+        # Excludes other threads and the other gunicorn workers sharing the
+        # cache directory; the file stays, its mtime is the last-used time
+        lock = FileLock(os.path.join(self.root, key + '.lock'))
+        if not lock.acquire(blocking):
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            lock.release()
+
+    @contextmanager
+    def checkout(self, repo, clone_url, branch=None, commit=None, sparse=None):
+        """Yield the path of an up to date, clean checkout of branch or commit.
+
+        sparse(workspace, tree_paths) -> paths limits the checkout to the files
+        it returns; it is called again after each round of checkout until the
+        set stops growing (see dependency_scan.Dependencies).
+        """
+        ref = commit if commit else branch
+        key = self._key(repo, f'commit:{commit}' if commit else f'branch:{branch}')
+        path = os.path.join(self.root, key)
+
+        with self._lock(key):
+            if os.path.isdir(os.path.join(path, '.git')):
+                try:
+                    self._update(path, clone_url, ref, fetch=not commit or self._head(path) != commit, sparse=sparse)
+                    self._count('hits')
+                except subprocess.CalledProcessError:
+                    # Broken workspace (interrupted fetch, force-push on a
+                    # shallow history, ...) - start over from scratch
+                    shutil.rmtree(path, ignore_errors=True)
+                    self._create(path, clone_url, ref, sparse)
+                    self._count('misses')
+            else:
+                shutil.rmtree(path, ignore_errors=True)
+                self._create(path, clone_url, ref, sparse)
+                self._count('misses')
+
+            os.utime(os.path.join(self.root, key + '.lock'))
+            try:
+                yield path
+            finally:
+                # Measured once here, with the build outputs in place, so
+                # eviction never has to walk the other workspaces
+                self._record_size(key, path)
+
+        self._evict()
+
+    def _git(self, args, cwd, env=None, input=None):
+        return subprocess.run(['git'] + args, cwd=cwd, check=True, capture_output=True, env=env, input=input)
+
+    def _head(self, path):
+        try:
+            return self._git(['rev-parse', 'HEAD'], path).stdout.decode().strip()
+        except subprocess.CalledProcessError:
+            return None
+
+    def _create(self, path, clone_url, ref, sparse=None):
+        os.makedirs(path, exist_ok=True)
+        try:
+            self._git(['init', '-q'], path)
+            # 'origin' is a promisor remote: blobs missing locally are fetched
+            # from it on demand. Its URL is only ever supplied per command.
+            self._git(['config', 'extensions.partialClone', 'origin'], path)
+            self._git(['config', 'remote.origin.promisor', 'true'], path)
+            self._git(['config', 'remote.origin.partialclonefilter', 'blob:none'], path)
+            self._update(path, clone_url, ref, sparse=sparse)
+        except subprocess.CalledProcessError:
+            shutil.rmtree(path, ignore_errors=True)
+            raise
+
+    def _update(self, path, clone_url, ref, fetch=True, sparse=None):
+        env = _remote_env(clone_url)
+        target = 'HEAD'
+        if fetch:
+            self._git(['fetch', '-q', '--depth', '1', '--filter=blob:none', 'origin', ref], path, env)
+            target = 'FETCH_HEAD'
+        if sparse:
+            if self._sparse_patterns(path) is None:
+                # New (or so far full) checkout - don't let checkout fetch every blob
+                self._set_sparse(path, sparse(path, self.tree_paths(path, target)), env)
+            self._git(['checkout', '-q', '--force', target], path, env)
+            self.widen(path, clone_url, sparse)
+        else:
+            self._git(['checkout', '-q', '--force', target], path, env)
+            if self._sparse_patterns(path) is not None:
+                self._git(['sparse-checkout', 'disable'], path, env)
+                # disable leaves a match-all pattern file behind
+                os.remove(os.path.join(path, '.git', 'info', 'sparse-checkout'))
+        # Drop build outputs and anything else left behind by the last compile
+        self._git(['clean', '-q', '-ffdx'], path)
+
+    def widen(self, path, clone_url, sparse):
+        """Grow a sparse checkout until it holds every path sparse() asks for.
+
+        Call again after changing files in the workspace or telling sparse
+        about missing inputs. Returns True if files were added.
+        """
+        env = _remote_env(clone_url)
+        tree_paths = self.tree_paths(path, 'HEAD')
+        current = set(self._sparse_patterns(path) or [])
+        widened = False
+        for _ in range(10):
+            needed = sparse(path, tree_paths) - current
+            if not needed:
+                break
+            current |= needed
+            # Each round checks out a whole level of \input's in one batched fetch
+            self._set_sparse(path, current, env)
+            widened = True
+        return widened
+
+    def tree_paths(self, path, ref='HEAD'):
+        # Trees are always local in a blob:none clone - no network involved
+        names = self._git(['ls-tree', '-r', '-z', '--name-only', ref], path).stdout
+        return set(names.decode('utf-8', errors='surrogateescape').split('\0')) - {''}
+
+    def _sparse_patterns(self, path):
+        try:
+            with open(os.path.join(path, '.git', 'info', 'sparse-checkout'), encoding='utf-8') as f:
+                patterns = [line.rstrip('\n') for line in f if line.strip()]
+        except OSError:
+            return None
+        return [_unescape_pattern(pattern) for pattern in patterns]
+
+    def _set_sparse(self, path, paths, env):
+        patterns = ''.join(_escape_pattern(p) + '\n' for p in sorted(paths))
+        self._git(['sparse-checkout', 'set', '--no-cone', '--stdin'], path, env, input=patterns.encode('utf-8'))
+
+    def _count(self, name):
+        with self._stats_lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def _record_size(self, key, path):
+        size = _dir_size(path)
+        write_atomically(os.path.join(self.root, key + '.size'), str(size).encode('ascii'))
+        return size
+
+    def _recorded_size(self, key, path):
+        try:
+            with open(os.path.join(self.root, key + '.size'), encoding='ascii') as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            pass
+        # Workspace from before sizes were recorded - measure it this once
+        with self._lock(key, blocking=False) as acquired:
+            if not acquired:
+                return 0
+            return self._record_size(key, path) if os.path.isdir(path) else 0
+
+    def _workspaces(self):
+        entries = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if '.' in name or not os.path.isdir(path):
+                continue
+            try:
+                last_used = os.path.getmtime(path + '.lock')
+            except OSError:
+                last_used = 0
+            entries.append((last_used, name, path, self._recorded_size(name, path)))
+        return entries
+
+    def _evict(self):
+        entries = sorted(self._workspaces())
+        total = sum(entry[3] for entry in entries)
+        for last_used, key, path, size in entries:
+            if total <= self.max_bytes:
+                break
+            # Skip workspaces another compile is currently using
+            with self._lock(key, blocking=False) as acquired:
+                if not acquired:
+                    continue
+                shutil.rmtree(path, ignore_errors=True)
+                remove(path + '.size')
+                remove(path + '.lock')
+            total -= size
+            self._count('evictions')
+
+    def stats(self):
+        entries = self._workspaces()
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'workspaces': len(entries),
+            'bytes': sum(entry[3] for entry in entries),
+            'max_bytes': self.max_bytes,
+        }
+
+
+def _remote_env(clone_url):
+    # The token only ever lives in the URL passed in the environment of
+    # each git command, never in the workspace's .git/config
+    env = os.environ.copy()
+    env.update({
+        'GIT_CONFIG_COUNT': '1',
+        'GIT_CONFIG_KEY_0': 'remote.origin.url',
+        'GIT_CONFIG_VALUE_0': clone_url,
+        'GIT_TERMINAL_PROMPT': '0',
+    })
+    return env
+
+
+def _escape_pattern(path):
+    # Non-cone patterns are gitignore syntax - anchor them and escape globs
+    return '/' + ''.join('\\' + c if c in '*?[]\\!#' else c for c in path)
+
+
+def _unescape_pattern(pattern):
+    return re.sub(r'\\(.)', r'\1', pattern.lstrip('/'))
+
+
+def _dir_size(path):
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, filename)).st_size
+            except OSError:
+                pass
+    return total